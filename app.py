@@ -1,6 +1,12 @@
 # ==============================================================================
 # ONLINE DO'KON - E-COMMERCE WEB APPLICATION
 # ==============================================================================
+# Ishga tushirish — yagona kirish nuqtasi app:create_app():
+#   gunicorn -c gunicorn.conf.py
+#   flask --app 'app:create_app()' run
+#   python app.py
+# Modul darajasidagi 'app' fabrikasiz ham ishlaydi (sxema birinchi ulanishda
+# yangilanadi), lekin CORS va server sessiyalari faqat create_app()'da o'rnatiladi.
 
 # ------------------------------------------------------------------------------
 # IMPORT QISMI - Kerakli kutubxonalar
@@ -9,155 +15,1906 @@
 # Flask va asosiy extensionlar
 from flask import (
     Flask, render_template, request, redirect,
-    url_for, session, jsonify, send_file, abort, session
+    url_for, session, jsonify, send_file, abort, session, g,
+    has_app_context, Response, stream_with_context
 )
 from flask_cors import CORS
-from flask_session import Session
-from markupsafe import Markup
+from flask.sessions import SessionInterface, SecureCookieSession, SecureCookieSessionInterface
+from markupsafe import Markup, escape
 from werkzeug.utils import secure_filename
+from werkzeug.security import safe_join
+from werkzeug.http import is_resource_modified
 
 # Standart Python kutubxonalari
 import os
 import re
 import uuid
 import json
+import math
+import heapq
 import random
+import time
 import base64
+import secrets
+import shutil
+import fcntl
 import sqlite3
-import requests
+import csv
+import socket
+import ipaddress
+import gzip
+import hashlib
+import mimetypes
+import glob as globmod
+import threading
+import queue
+import atexit
 from io import BytesIO
-from datetime import datetime
-from mistralai import Mistral
+from datetime import datetime, timezone
+from array import array
+from bisect import bisect_left
+from contextlib import contextmanager
+from itertools import accumulate
+from collections import namedtuple, Counter, defaultdict, OrderedDict
 from uuid import uuid4
+from functools import lru_cache, wraps
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, TimeoutError as FutureTimeout
+from types import SimpleNamespace
+from urllib.parse import urlsplit, urljoin
 from dotenv import load_dotenv, find_dotenv
 
-# PDF va QR kod uchun kutubxonalar
+# Ixtiyoriy: brotli bo'lmasa faqat gzip nusxalar yaratiladi
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+import click
+
+# Og'ir kutubxonalar birinchi ishlatilganda yuklanadi (worker tez ishga tushadi):
+#   mistralai          -> get_mistral_client()
+#   reportlab, qrcode  -> pdf_stack()
+#   PIL                -> ImagePipeline.generate()
+#   requests           -> ReverseGeocoder.http
 # import ollama
-import qrcode
-from reportlab.pdfgen import canvas
-from reportlab.lib.units import mm
-from reportlab.lib.utils import ImageReader
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-from reportlab.pdfbase.pdfmetrics import stringWidth
-from reportlab.lib.colors import black
 
 
-# ==============================================================================
-# ILOVANI SOZLASH - Configuration
-# ==============================================================================
-load_dotenv(find_dotenv())  # .env faylidan o'qish
+# ==============================================================================
+# ILOVANI SOZLASH - Configuration
+# ==============================================================================
+load_dotenv(find_dotenv())  # .env faylidan o'qish
+
+app = Flask(__name__)
+app.secret_key = os.getenv("DATABASE_KEY")
+
+# Sessiya: 'sqlite' (server tomonida, default) yoki 'cookie' (imzolangan cookie)
+app.config['SESSION_BACKEND'] = os.getenv('SESSION_BACKEND', 'sqlite')
+app.config['SESSION_DB_PATH'] = os.getenv('SESSION_DB_PATH', 'database/sessions.db')
+app.config['SESSION_IDLE_TIMEOUT'] = int(os.getenv('SESSION_IDLE_TIMEOUT', 7 * 24 * 3600))
+app.config['SESSION_SWEEP_INTERVAL'] = int(os.getenv('SESSION_SWEEP_INTERVAL', 600))
+app.config['SESSION_PERMANENT'] = False
+
+# === Mistral API sozlamalari ===
+MISTRAL_API_KEY = os.getenv("MISTRAL")
+model = "mistral-large-latest"
+
+# LLM_BACKEND=fake — tarmoqsiz test va benchmark uchun soxta mijoz
+app.config['LLM_BACKEND'] = os.getenv('LLM_BACKEND', 'mistral')
+app.config['FAKE_LLM_TOKEN_DELAY'] = float(os.getenv('FAKE_LLM_TOKEN_DELAY', 0.0))
+
+# Fayl yuklash sozlamalari
+UPLOAD_FOLDER = 'static/images'
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+ALLOWED_VIDEO_EXTENSIONS = {'mp4', 'mov', 'webm', 'mkv'}
+app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+
+# PDF uchun fontlar: fayllar hozir tekshiriladi, reportlab'da ro'yxatdan
+# o'tkazish esa birinchi chekda (pdf_stack) yoki preload paytida
+FONT_DIR = os.path.join(app.root_path, 'static', 'fonts')
+FONT_FILES = {
+    'DejaVuSans': os.path.join(FONT_DIR, 'DejaVuSans.ttf'),
+    'NotoSans': os.path.join(FONT_DIR, 'NotoSans-Regular.ttf')
+}
+
+REGISTERED_FONTS = {short: path for short, path in FONT_FILES.items() if os.path.exists(path)}
+
+
+# ==============================================================================
+# METRIKALAR - Instrumentation & /metrics
+# ==============================================================================
+
+app.config['METRICS_ENABLED'] = os.getenv('METRICS_ENABLED', '1') == '1'
+# 0 — o'chirilgan; aks holda shundan sekin so'rovlar SQL ro'yxati bilan log qilinadi
+app.config['SLOW_REQUEST_MS'] = float(os.getenv('SLOW_REQUEST_MS', 0))
+app.config['SLOW_REQUEST_MAX_SQL'] = int(os.getenv('SLOW_REQUEST_MAX_SQL', 50))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SQL_COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100, 500)
+
+
+class Histogram:
+    """Prometheus uslubidagi gistogramma (kumulyativ emas — render paytida yig'iladi)"""
+
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self, size):
+        self.counts = [0] * (size + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+class MetricsRegistry:
+    """
+    Jarayon ichidagi hisoblagich va gistogrammalar. Yozish bitta qulf ostida
+    bir necha ro'yxat amali; matn formati faqat /metrics so'ralganda quriladi.
+    Har bir worker o'z qiymatlarini beradi (label'da pid yo'q).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {}        # nom -> (tur, yordam, bucket'lar)
+        self._values = {}      # nom -> {label'lar: qiymat yoki Histogram}
+
+    def counter(self, name, help_text):
+        self._meta[name] = ('counter', help_text, None)
+        self._values[name] = {}
+
+    def histogram(self, name, help_text, buckets):
+        self._meta[name] = ('histogram', help_text, buckets)
+        self._values[name] = {}
+
+    def _inc(self, name, labels, value):
+        series = self._values[name]
+        series[labels] = series.get(labels, 0) + value
+
+    def _observe(self, name, labels, value):
+        series = self._values[name]
+        hist = series.get(labels)
+        if hist is None:
+            hist = series[labels] = Histogram(len(self._meta[name][2]))
+        hist.counts[bisect_left(self._meta[name][2], value)] += 1
+        hist.sum += value
+        hist.count += 1
+
+    def inc(self, name, labels, value=1):
+        with self._lock:
+            self._inc(name, labels, value)
+
+    def observe(self, name, labels, value):
+        with self._lock:
+            self._observe(name, labels, value)
+
+    def record_request(self, endpoint, method, status, duration, stats):
+        """So'rov oxirida barcha yozuvlar bitta qulf ostida"""
+        key = (endpoint, method)
+        with self._lock:
+            self._observe('webshop_http_request_duration_seconds', key, duration)
+            self._inc('webshop_http_requests_total', (endpoint, method, str(status)), 1)
+            self._observe('webshop_request_sql_statements', (endpoint,), stats.sql_count)
+            if stats.sql_count:
+                self._inc('webshop_sql_statements_total', (endpoint,), stats.sql_count)
+                self._inc('webshop_sql_duration_seconds_total', (endpoint,), stats.sql_time)
+
+    @staticmethod
+    def _labels(names, values):
+        if not names:
+            return ''
+        parts = []
+        for n, v in zip(names, values):
+            v = str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+            parts.append(f'{n}="{v}"')
+        return ','.join(parts)
+
+    def render(self, label_names, extra_lines=()):
+        """Prometheus text exposition formati (0.0.4)"""
+        lines = []
+        with self._lock:
+            snapshot = {
+                name: {k: (v if not isinstance(v, Histogram) else (list(v.counts), v.sum, v.count))
+                       for k, v in series.items()}
+                for name, series in self._values.items()
+            }
+        for name, (kind, help_text, buckets) in self._meta.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            names = label_names[name]
+            for labels, value in sorted(snapshot[name].items()):
+                base = self._labels(names, labels)
+                if kind == 'counter':
+                    lines.append(f'{name}{{{base}}} {value}' if base else f'{name} {value}')
+                    continue
+                counts, total, count = value
+                cumulative = 0
+                sep = ',' if base else ''
+                for bound, n in zip(list(buckets) + ['+Inf'], counts):
+                    cumulative += n
+                    lines.append(f'{name}_bucket{{{base}{sep}le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_sum{{{base}}} {total}' if base else f'{name}_sum {total}')
+                lines.append(f'{name}_count{{{base}}} {count}' if base else f'{name}_count {count}')
+        lines.extend(extra_lines)
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
+metrics.histogram('webshop_http_request_duration_seconds', "So'rov davomiyligi (endpoint bo'yicha)", LATENCY_BUCKETS)
+metrics.counter('webshop_http_requests_total', "So'rovlar soni (endpoint, metod, status)")
+metrics.histogram('webshop_request_sql_statements', "Bitta so'rovdagi SQL buyruqlar soni", SQL_COUNT_BUCKETS)
+metrics.counter('webshop_sql_statements_total', "Bajarilgan SQL buyruqlar (endpoint bo'yicha)")
+metrics.counter('webshop_sql_duration_seconds_total', "SQL buyruqlariga ketgan vaqt (endpoint bo'yicha)")
+metrics.histogram('webshop_external_call_duration_seconds', "Tashqi xizmat chaqiruvlari (Mistral, Nominatim)", LATENCY_BUCKETS)
+METRIC_LABELS = {
+    'webshop_http_request_duration_seconds': ('endpoint', 'method'),
+    'webshop_http_requests_total': ('endpoint', 'method', 'status'),
+    'webshop_request_sql_statements': ('endpoint',),
+    'webshop_sql_statements_total': ('endpoint',),
+    'webshop_sql_duration_seconds_total': ('endpoint',),
+    'webshop_external_call_duration_seconds': ('service', 'outcome'),
+}
+
+# Joriy so'rov hisoblagichlari (oqim bo'yicha); fon oqimlarida None
+_metrics_local = threading.local()
+
+
+class RequestStats:
+    __slots__ = ('started', 'sql_count', 'sql_time', 'statements', 'external', 'status')
+
+    def __init__(self, capture_sql):
+        self.started = time.perf_counter()
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.statements = [] if capture_sql else None
+        self.external = {}
+        self.status = 500
+
+
+def record_sql(sql, duration):
+    """Har bir SQL buyrug'i uchun (TimedCursor chaqiradi)"""
+    stats = getattr(_metrics_local, 'current', None)
+    if stats is None:
+        if app.config['METRICS_ENABLED']:
+            metrics.inc('webshop_sql_statements_total', ('background',))
+            metrics.inc('webshop_sql_duration_seconds_total', ('background',), duration)
+        return
+    stats.sql_count += 1
+    stats.sql_time += duration
+    if stats.statements is not None and len(stats.statements) < app.config['SLOW_REQUEST_MAX_SQL']:
+        stats.statements.append((duration, ' '.join(sql.split())[:300]))
+
+
+@contextmanager
+def external_call(service):
+    """Tashqi chaqiruv vaqtini o'lchash: with external_call('mistral'): ..."""
+    started = time.perf_counter()
+    outcome = 'ok'
+    try:
+        yield
+    except BaseException:
+        outcome = 'error'
+        raise
+    finally:
+        record_external(service, outcome, time.perf_counter() - started)
+
+
+def external_stream(service, open_stream):
+    """
+    Oqimli tashqi chaqiruv: open_stream() elementlarini uzatadi, lekin faqat
+    manbadan o'qish vaqti o'lchanadi — iste'molchi (sekin mijoz) kutgan vaqt
+    kirmaydi. Iste'molchi oqimni yopsa natija 'cancelled' bo'ladi.
+    """
+    elapsed = 0.0
+    outcome = 'ok'
+    started = time.perf_counter()
+    try:
+        for item in open_stream():
+            elapsed += time.perf_counter() - started
+            started = None
+            yield item
+            started = time.perf_counter()
+    except GeneratorExit:
+        outcome = 'cancelled'
+        raise
+    except BaseException:
+        outcome = 'error'
+        raise
+    finally:
+        if started is not None:
+            elapsed += time.perf_counter() - started
+        record_external(service, outcome, elapsed)
+
+
+def record_external(service, outcome, duration):
+    """Tashqi chaqiruv davomiyligini metrikaga va joriy so'rov statistikasiga yozish"""
+    if app.config['METRICS_ENABLED']:
+        metrics.observe('webshop_external_call_duration_seconds', (service, outcome), duration)
+    stats = getattr(_metrics_local, 'current', None)
+    if stats is not None:
+        stats.external[service] = stats.external.get(service, 0.0) + duration
+
+
+@app.before_request
+def start_request_metrics():
+    if app.config['METRICS_ENABLED']:
+        _metrics_local.current = RequestStats(app.config['SLOW_REQUEST_MS'] > 0)
+
+
+@app.after_request
+def capture_response_status(response):
+    stats = getattr(_metrics_local, 'current', None)
+    if stats is not None:
+        stats.status = response.status_code
+    return response
+
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    stats = getattr(_metrics_local, 'current', None)
+    if stats is None:
+        return
+    _metrics_local.current = None
+    duration = time.perf_counter() - stats.started
+    endpoint = request.endpoint or 'unmatched'
+    metrics.record_request(endpoint, request.method, stats.status, duration, stats)
+
+    slow_ms = app.config['SLOW_REQUEST_MS']
+    if slow_ms and duration * 1000 >= slow_ms:
+        external = ', '.join(f"{k}={v * 1000:.1f}ms" for k, v in stats.external.items()) or '-'
+        lines = [f"Slow request: {request.method} {request.path} ({endpoint}) {duration * 1000:.1f}ms, "
+                 f"status={stats.status}, sql={stats.sql_count} / {stats.sql_time * 1000:.1f}ms, external: {external}"]
+        lines += [f"    {d * 1000:7.2f}ms  {sql}" for d, sql in stats.statements or ()]
+        app.logger.warning('\n'.join(lines))
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus text formatidagi metrikalar (shu worker uchun)"""
+    extra = []
+    for cache_name, snapshot in _cache_snapshots():
+        for event, value in sorted(snapshot.items()):
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                extra.append(f'webshop_cache{{cache="{cache_name}",stat="{event}"}} {value}')
+    if extra:
+        extra.insert(0, '# TYPE webshop_cache gauge')
+        extra.insert(0, '# HELP webshop_cache Kesh va navbat hisoblagichlari')
+    body = metrics.render(METRIC_LABELS, extra)
+    return Response(body, mimetype='text/plain; version=0.0.4')
+
+
+def _cache_snapshots():
+    """Mavjud kesh/navbat obyektlarining hisoblagichlari (/metrics uchun)"""
+    yield 'write_queue', dict(write_queue.stats)
+    yield 'product_page', product_page_cache.snapshot()
+    yield 'chat_answer', answer_cache.snapshot()
+    yield 'receipt', dict(receipt_cache.stats)
+    yield 'geocode', dict(geocoder.stats)
+
+
+# ==============================================================================
+# DATABASE FUNKSIYALARI
+# ==============================================================================
+
+# SQLite sozlamalari (env orqali o'zgartirish mumkin)
+app.config['DATABASE'] = os.getenv('DATABASE_PATH', 'database/shop.db')
+app.config['SQLITE_JOURNAL_MODE'] = os.getenv('SQLITE_JOURNAL_MODE', 'WAL')
+app.config['SQLITE_SYNCHRONOUS'] = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')
+app.config['SQLITE_BUSY_TIMEOUT_MS'] = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 5000))
+app.config['SQLITE_MMAP_SIZE'] = int(os.getenv('SQLITE_MMAP_SIZE', 64 * 1024 * 1024))
+app.config['SQLITE_CACHED_STATEMENTS'] = int(os.getenv('SQLITE_CACHED_STATEMENTS', 256))
+
+# Har bir worker oqimi uchun bitta doimiy ulanish
+_db_local = threading.local()
+_migrated_databases = set()  # shu jarayonda migratsiyasi tekshirilgan bazalar
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Har bir execute vaqtini metrikalarga yozuvchi kursor"""
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record_sql(sql, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            record_sql(sql, time.perf_counter() - started)
+
+    def executescript(self, sql_script):
+        started = time.perf_counter()
+        try:
+            return super().executescript(sql_script)
+        finally:
+            record_sql(sql_script, time.perf_counter() - started)
+
+
+class PooledConnection(sqlite3.Connection):
+    """
+    Oqimga biriktirilgan ulanish: close() ulanishni yopmaydi,
+    faqat tugallanmagan tranzaksiyani bekor qilib pool'ga qaytaradi.
+    Barcha buyruqlar TimedCursor orqali o'tadi (SQL metrikalari uchun).
+    """
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+    def close(self):
+        if self.in_transaction:
+            self.rollback()
+
+    def dispose(self):
+        """Ulanishni haqiqatan yopish"""
+        super().close()
+
+
+def _open_db_connection():
+    """Yangi ulanish ochish va PRAGMA'larni qo'llash"""
+    cfg = app.config
+    conn = sqlite3.connect(
+        cfg['DATABASE'],
+        timeout=cfg['SQLITE_BUSY_TIMEOUT_MS'] / 1000,
+        cached_statements=cfg['SQLITE_CACHED_STATEMENTS'],
+        factory=PooledConnection,
+    )
+    conn.row_factory = sqlite3.Row
+    conn.execute(f"PRAGMA journal_mode={cfg['SQLITE_JOURNAL_MODE']}")
+    conn.execute(f"PRAGMA synchronous={cfg['SQLITE_SYNCHRONOUS']}")
+    conn.execute(f"PRAGMA busy_timeout={cfg['SQLITE_BUSY_TIMEOUT_MS']}")
+    conn.execute(f"PRAGMA mmap_size={cfg['SQLITE_MMAP_SIZE']}")
+    return conn
+
+
+def get_db_connection():
+    """Ma'lumotlar bazasiga ulanish (oqim bo'yicha qayta ishlatiladi)"""
+    conn = getattr(_db_local, 'conn', None)
+    # fork'dan keyin (gunicorn --preload) ota-jarayon ulanishini ishlatmaslik
+    if conn is None or _db_local.pid != os.getpid() or _db_local.path != app.config['DATABASE']:
+        # create_app()'siz import qilinganda ham (flask run, app:app) sxema tayyor bo'ladi
+        if app.config['DATABASE'] not in _migrated_databases:
+            run_migrations()
+        conn = _open_db_connection()
+        _db_local.conn = conn
+        _db_local.pid = os.getpid()
+        _db_local.path = app.config['DATABASE']
+    if has_app_context():
+        g._db_conn = conn
+    return conn
+
+
+def close_db_connection():
+    """Joriy oqim ulanishini butunlay yopish (testlar va CLI uchun)"""
+    conn = getattr(_db_local, 'conn', None)
+    if conn is not None:
+        conn.dispose()
+        _db_local.conn = None
+
+
+@app.teardown_appcontext
+def release_db_connection(exc):
+    """So'rov oxirida ulanishni pool'ga qaytarish"""
+    conn = g.pop('_db_conn', None)
+    if conn is not None:
+        conn.close()
+
+
+def _is_busy(error):
+    """SQLITE_BUSY / 'database is locked' xatosimi"""
+    return isinstance(error, sqlite3.OperationalError) and (
+        'locked' in str(error) or 'busy' in str(error)
+    )
+
+
+# --- Write-behind: guruhlab commit qilish --------------------------------------
+
+app.config['WRITE_BEHIND'] = os.getenv('WRITE_BEHIND', '1') == '1'
+app.config['WRITE_BATCH_MAX'] = int(os.getenv('WRITE_BATCH_MAX', 128))
+app.config['WRITE_BATCH_LATENCY_MS'] = float(os.getenv('WRITE_BATCH_LATENCY_MS', 2))
+app.config['WRITE_ACK_TIMEOUT'] = float(os.getenv('WRITE_ACK_TIMEOUT', 30))
+app.config['WRITE_BUSY_RETRIES'] = int(os.getenv('WRITE_BUSY_RETRIES', 6))
+
+
+class WriteBehindQueue:
+    """
+    Jarayon bo'yicha yagona yozuvchi oqim. Navbatdagi ishlar (job(conn))
+    bitta tranzaksiyada guruhlab commit qilinadi — bitta fsync ko'p so'rovga
+    yetadi. Har bir ish o'z SAVEPOINT'ida bajariladi: biri xato bersa faqat
+    o'sha bekor qilinadi. submit() Future qaytaradi, u commit'dan keyin hal bo'ladi.
+    """
+
+    _STOP = object()
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = None
+        self._pid = None
+        self.stats = defaultdict(int)
+
+    def _ensure_started(self):
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                # fork'dan keyin ota-jarayon navbati va oqimi yaroqsiz
+                self._queue = queue.Queue()
+                self._thread = None
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+                self._pid = os.getpid()
+                self._thread.start()
+
+    def submit(self, job):
+        """Yozuv ishini navbatga qo'yish; natija (yoki xato) Future orqali"""
+        future = Future()
+        self._ensure_started()
+        self._queue.put((job, future))
+        return future
+
+    def flush(self, timeout=None):
+        """Shu paytgacha navbatga qo'yilgan barcha ishlar commit bo'lguncha kutish"""
+        self.submit(lambda conn: None).result(timeout)
+
+    def close(self, timeout=10):
+        """Navbatni bo'shatib, oqimni to'xtatish (jarayon tugashida)"""
+        thread = self._thread
+        if thread is None or self._pid != os.getpid() or not thread.is_alive():
+            return
+        self._queue.put(self._STOP)
+        thread.join(timeout)
+
+    def _collect(self):
+        """Birinchi ishni kutib, so'ng hajm yoki vaqt chegarasigacha yig'ish"""
+        first = self._queue.get()
+        if first is self._STOP:
+            return [], True
+        batch = [first]
+        deadline = time.monotonic() + app.config['WRITE_BATCH_LATENCY_MS'] / 1000
+        while len(batch) < app.config['WRITE_BATCH_MAX']:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is self._STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch, stop = self._collect()
+            if batch:
+                self._write_batch(batch)
+        close_db_connection()
+
+    @staticmethod
+    def _execute(conn, batch):
+        conn.execute('BEGIN IMMEDIATE')
+        results = []
+        for job, _ in batch:
+            conn.execute('SAVEPOINT job')
+            try:
+                results.append((True, job(conn)))
+                conn.execute('RELEASE SAVEPOINT job')
+            except Exception as e:
+                if _is_busy(e):
+                    raise
+                conn.execute('ROLLBACK TO SAVEPOINT job')
+                conn.execute('RELEASE SAVEPOINT job')
+                results.append((False, e))
+        conn.commit()
+        return results
+
+    def _write_batch(self, batch):
+        conn = get_db_connection()
+        retries = app.config['WRITE_BUSY_RETRIES']
+        for attempt in range(retries + 1):
+            try:
+                results = self._execute(conn, batch)
+                break
+            except Exception as e:
+                if conn.in_transaction:
+                    conn.rollback()
+                if not _is_busy(e) or attempt == retries:
+                    print(f"Write-behind batch error: {e}")
+                    self.stats['failed'] += len(batch)
+                    for _, future in batch:
+                        future.set_exception(e)
+                    return
+                time.sleep(min(0.25, 0.01 * 2 ** attempt) * random.uniform(0.5, 1.0))
+
+        self.stats['batches'] += 1
+        self.stats['jobs'] += len(batch)
+        self.stats['max_batch'] = max(self.stats['max_batch'], len(batch))
+        for (_, future), (ok, value) in zip(batch, results):
+            if ok:
+                future.set_result(value)
+            else:
+                self.stats['failed'] += 1
+                future.set_exception(value)
+
+
+write_queue = WriteBehindQueue()
+atexit.register(write_queue.close)
+
+
+# Katalog versiyasi: admin yozuvlarida oshadi, barcha worker'lar bazadan ko'radi
+app.config['CATALOG_VERSION_TTL'] = float(os.getenv('CATALOG_VERSION_TTL', 1.0))
+_catalog_state = {'version': None, 'updated_at': None, 'checked_at': 0.0}
+_catalog_count_cache = {'version': None, 'count': 0}
+
+
+def get_catalog_version():
+    """Joriy katalog versiyasi (jarayon ichida qisqa muddat keshlanadi)"""
+    now = time.monotonic()
+    if _catalog_state['version'] is None or now - _catalog_state['checked_at'] > app.config['CATALOG_VERSION_TTL']:
+        conn = get_db_connection()
+        row = conn.execute('SELECT version, updated_at FROM catalog_meta WHERE id = 1').fetchone()
+        conn.close()
+        _catalog_state['version'] = row['version']
+        _catalog_state['updated_at'] = row['updated_at']
+        _catalog_state['checked_at'] = now
+    return _catalog_state['version']
+
+
+def _bump_catalog_meta(conn, product_ids=()):
+    """
+    Ochiq tranzaksiya ichida katalog versiyasini oshirish. O'zgargan
+    mahsulotlarning products.version'i yangi katalog versiyasiga tenglanadi —
+    shuning uchun 'WHERE version > oxirgi_korilgan' shu versiyadan keyin
+    o'zgargan qatorlarni beradi (tavsiyalar, chat indeksi shunday yangilanadi).
+    """
+    conn.execute(
+        'UPDATE catalog_meta SET version = version + 1, updated_at = ? WHERE id = 1',
+        (datetime.now().strftime("%Y-%m-%d %H:%M:%S"),)
+    )
+    conn.executemany(
+        'UPDATE products SET version = (SELECT version FROM catalog_meta WHERE id = 1) WHERE id = ?',
+        [(pid,) for pid in product_ids]
+    )
+
+
+def changed_products(conn, since_version, columns='id'):
+    """since_version'dan keyin o'zgargan (qo'shilgan yoki tahrirlangan) qatorlar"""
+    return conn.execute(
+        f'SELECT {columns} FROM products WHERE version > ?', (since_version,)
+    ).fetchall()
+
+
+def bump_catalog_version(product_ids=()):
+    """Katalog versiyasini oshirish (boshqa worker'lar keshlari ham eskiradi)"""
+    conn = get_db_connection()
+    _bump_catalog_meta(conn, product_ids)
+    conn.commit()
+    conn.close()
+    _catalog_state['version'] = None
+
+
+def count_products():
+    """Mahsulotlar soni — katalog versiyasi o'zgarmaguncha keshdan"""
+    version = get_catalog_version()
+    if _catalog_count_cache['version'] != version:
+        conn = get_db_connection()
+        count = conn.execute('SELECT COUNT(*) FROM products').fetchone()[0]
+        conn.close()
+        _catalog_count_cache.update(version=version, count=count)
+    return _catalog_count_cache['count']
+
+
+# Katalog o'zgarganda xabardor qilinadigan funksiyalar (keshlar, indekslar)
+_catalog_listeners = []
+
+
+def on_catalog_change(func):
+    """Dekorator: katalog o'zgarishini tinglovchi funksiyani ro'yxatga olish"""
+    _catalog_listeners.append(func)
+    return func
+
+
+def notify_catalog_change(product_id):
+    """Admin yozuvlaridan keyin barcha tinglovchilarni chaqirish"""
+    notify_catalog_changes([product_id])
+
+
+def notify_catalog_changes(product_ids, bump=True):
+    """
+    Bir nechta mahsulot o'zgarganda (import, buyurtma): versiya bir marta
+    oshadi. bump=False — versiya yozish tranzaksiyasi ichida oshirilgan.
+    """
+    if bump:
+        bump_catalog_version(product_ids)
+    for listener in _catalog_listeners:
+        for product_id in product_ids:
+            try:
+                listener(product_id)
+            except Exception as e:
+                print(f"Catalog listener error ({listener.__name__}): {e}")
+
+
+# Shartli GET: ETag/Last-Modified katalog versiyasidan, 304 bazaga tegmasdan
+_build_token = {'value': None}
+
+
+def build_token():
+    """Shablonlar va kod o'zgarganda (deploy) ETag'lar ham o'zgarishi uchun"""
+    if _build_token['value'] is None:
+        h = hashlib.blake2b(digest_size=8)
+        paths = [os.path.abspath(__file__)] + sorted(globmod.glob(os.path.join(app.root_path, 'templates', '*.html')))
+        for path in paths:
+            st = os.stat(path)
+            h.update(f"{path}:{st.st_mtime_ns}:{st.st_size}".encode())
+        h.update((asset_manifest.digest('styles.css') or '').encode())
+        _build_token['value'] = h.hexdigest()
+    return _build_token['value']
+
+
+def catalog_last_modified():
+    """catalog_meta.updated_at (mahalliy vaqt) -> UTC datetime"""
+    get_catalog_version()
+    try:
+        local = datetime.strptime(_catalog_state['updated_at'], "%Y-%m-%d %H:%M:%S")
+    except (TypeError, ValueError):
+        return None
+    return local.astimezone(timezone.utc)
+
+
+def catalog_conditional(key_func=None, version_func=None):
+    """
+    Dekorator: javobga katalog versiyasidan kuchli ETag va Last-Modified
+    qo'shadi; If-None-Match/If-Modified-Since mos kelsa view umuman
+    chaqirilmaydi. key_func(**kwargs) javobni o'zgartiradigan qo'shimcha
+    qismlarni (masalan, gzip) qaytaradi. Javobdagi har qanday maydon
+    (zaxira ham) o'zgarganda katalog versiyasi oshishi shart.
+
+    version_func(**kwargs) berilsa (bitta mahsulot sahifasi), ETag global
+    versiya o'rniga shu qatorning products.version'idan quriladi — boshqa
+    mahsulot sotilganda sahifa keshi eskirmaydi. None qaytsa (mahsulot yo'q)
+    view shartsiz chaqiriladi.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if version_func is not None:
+                version = version_func(**kwargs)
+                if version is None:
+                    return view(*args, **kwargs)
+                prefix, last_modified = 'p', None
+            else:
+                version = get_catalog_version()
+                prefix, last_modified = 'c', catalog_last_modified()
+            parts = [version, build_token()]
+            if key_func is not None:
+                parts.extend(key_func(**kwargs))
+            digest = hashlib.blake2b(':'.join(map(str, parts)).encode(), digest_size=10).hexdigest()
+            etag = f"{prefix}{version}-{digest}"
+
+            if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+                response = Response(status=304)
+            else:
+                response = app.make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorator
+
+
+def get_all_products_from_db():
+    """Barcha mahsulotlarni olish"""
+    conn = get_db_connection()
+    products = conn.execute('SELECT * FROM products ORDER BY id DESC').fetchall()
+    conn.close()
+    return products
+
+
+# --- Sxema migratsiyalari ------------------------------------------------------
+# Har bir qadam bir marta, tartib bilan, alohida tranzaksiyada bajariladi va
+# 'schema_version' jadvaliga yoziladi. Ilova ishga tushganda (create_app) yoki
+# 'flask migrate' bilan chaqiriladi — so'rovlar yo'lida sxema tekshiruvi yo'q.
+
+Migration = namedtuple('Migration', 'version name apply')
+MIGRATIONS = []
+
+
+def migration(version, name):
+    """Dekorator: sxema qadamini ro'yxatga olish (versiyalar o'sib boradi)"""
+    def decorator(func):
+        MIGRATIONS.append(Migration(version, name, func))
+        MIGRATIONS.sort(key=lambda m: m.version)
+        return func
+    return decorator
+
+
+def _has_column(conn, table, column):
+    return any(r[1] == column for r in conn.execute(f"PRAGMA table_info({table})"))
+
+
+def _has_table(conn, name):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (name,)).fetchone() is not None
+
+
+@migration(1, "asosiy jadvallar")
+def _migrate_base_tables(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS products (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT,
+        price INTEGER,
+        image TEXT,
+        description TEXT,
+        stock INTEGER,
+        videos TEXT DEFAULT ''
+    )''')
+    if not _has_column(conn, 'products', 'videos'):
+        conn.execute("ALTER TABLE products ADD COLUMN videos TEXT DEFAULT ''")
+    conn.execute('''CREATE TABLE IF NOT EXISTS orders (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, phone TEXT, address TEXT, location TEXT,
+        products TEXT, total_price INTEGER, data_add TEXT, status TEXT DEFAULT ('YANGI')
+    )''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS chat_message (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_uuid TEXT NOT NULL,
+        user_name TEXT,
+        role TEXT NOT NULL,
+        content TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''')
+
+
+@migration(2, "catalog_meta")
+def _migrate_catalog_meta(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS catalog_meta (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        version INTEGER NOT NULL DEFAULT 1,
+        updated_at TEXT
+    )''')
+    conn.execute(
+        "INSERT OR IGNORE INTO catalog_meta (id, version, updated_at) VALUES (1, 1, ?)",
+        (datetime.now().strftime("%Y-%m-%d %H:%M:%S"),)
+    )
+
+
+@migration(3, "products.version")
+def _migrate_product_version(conn):
+    if not _has_column(conn, 'products', 'version'):
+        conn.execute("ALTER TABLE products ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
+
+
+@migration(4, "order_items")
+def _migrate_order_items(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS order_items (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        order_id INTEGER NOT NULL REFERENCES orders(id) ON DELETE CASCADE,
+        product_id INTEGER,
+        name TEXT NOT NULL,
+        unit_price INTEGER NOT NULL DEFAULT 0,
+        quantity INTEGER NOT NULL DEFAULT 1
+    )''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_order_items_order ON order_items(order_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_order_items_product ON order_items(product_id)')
+
+
+@migration(5, "products_fts qidiruv indeksi")
+def _migrate_search_index(conn):
+    # unicode61 lotin va kirill harflarini registrsiz taqqoslaydi,
+    # prefix indekslari 'tel*' kabi so'rovlarni tezlashtiradi
+    if _has_table(conn, 'products_fts'):
+        return
+    conn.execute('''CREATE VIRTUAL TABLE products_fts USING fts5(
+        name, description,
+        content='products', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2',
+        prefix='2 3'
+    )''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS products_fts_ai AFTER INSERT ON products BEGIN
+        INSERT INTO products_fts(rowid, name, description) VALUES (new.id, new.name, new.description);
+    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS products_fts_ad AFTER DELETE ON products BEGIN
+        INSERT INTO products_fts(products_fts, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS products_fts_au AFTER UPDATE OF name, description ON products BEGIN
+        INSERT INTO products_fts(products_fts, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+        INSERT INTO products_fts(rowid, name, description) VALUES (new.id, new.name, new.description);
+    END''')
+    conn.execute("INSERT INTO products_fts(products_fts, rank) VALUES ('rank', 'bm25(10.0, 1.0)')")
+    conn.execute("INSERT INTO products_fts(products_fts) VALUES ('rebuild')")
+
+
+@migration(6, "chat xotirasi")
+def _migrate_chat_memory(conn):
+    # (user_uuid, created_at) indeksi eski (user_uuid) indeksini to'liq qoplaydi
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_chat_message_user_created
+                    ON chat_message(user_uuid, created_at)''')
+    conn.execute('DROP INDEX IF EXISTS idx_chat_message_user_uuid')
+    conn.execute('''CREATE TABLE IF NOT EXISTS chat_summary (
+        user_uuid TEXT PRIMARY KEY,
+        summary TEXT NOT NULL DEFAULT '',
+        last_message_id INTEGER NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''')
+
+
+@migration(7, "kesh jadvallari")
+def _migrate_cache_tables(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS llm_answer_cache (
+        cache_key TEXT PRIMARY KEY,
+        answer TEXT NOT NULL,
+        product_ids TEXT NOT NULL DEFAULT '',
+        created_at REAL NOT NULL
+    )''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS geocode_cache (
+        cell TEXT PRIMARY KEY,
+        address TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''')
+
+
+@migration(8, "orders indekslari")
+def _migrate_order_indexes(conn):
+    # holat bo'yicha filtr + sana bo'yicha saralash, va sana oralig'i so'rovlari
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_orders_status_data_add ON orders(status, data_add)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_orders_data_add ON orders(data_add)')
+
+
+@migration(9, "products.sku (ommaviy import)")
+def _migrate_product_sku(conn):
+    # image_source — import faylidagi rasm manbalari: o'zgarmasa qayta yuklanmaydi
+    if not _has_column(conn, 'products', 'sku'):
+        conn.execute("ALTER TABLE products ADD COLUMN sku TEXT")
+    if not _has_column(conn, 'products', 'image_source'):
+        conn.execute("ALTER TABLE products ADD COLUMN image_source TEXT NOT NULL DEFAULT ''")
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_products_sku ON products(sku)')
+
+
+@migration(10, "products.version indeksi")
+def _migrate_product_version_index(conn):
+    # o'zgargan qatorlarni (version > N) jadvalni skanerlamasdan topish uchun
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_products_version ON products(version)')
+
+
+@migration(11, "chat_message (user_uuid, id) indeksi")
+def _migrate_chat_message_id_index(conn):
+    # xotira ikkala so'rovni ham id bo'yicha o'qiydi: oxirgi N ta (id DESC) va
+    # xulosaga qo'shiladigan oraliq (id > ? AND id < ?) — saralashsiz, skanersiz
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_chat_message_user_id ON chat_message(user_uuid, id)')
+    conn.execute('DROP INDEX IF EXISTS idx_chat_message_user_created')
+
+
+@migration(12, "import_jobs")
+def _migrate_import_jobs(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS import_jobs (
+        id TEXT PRIMARY KEY,
+        filename TEXT NOT NULL,
+        status TEXT NOT NULL,
+        report TEXT NOT NULL DEFAULT '{}',
+        created_at TEXT NOT NULL,
+        updated_at TEXT NOT NULL
+    )''')
+
+
+def schema_version(conn):
+    """Bazaga qo'llangan oxirgi migratsiya versiyasi (0 — hali hech narsa)"""
+    if not _has_table(conn, 'schema_version'):
+        return 0
+    return conn.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version').fetchone()[0]
+
+
+def run_migrations():
+    """
+    Qo'llanmagan qadamlarni tartib bilan bajarish; qo'llanganlar ro'yxatini
+    qaytaradi. BEGIN IMMEDIATE bir vaqtda ishga tushgan worker'larni
+    navbatga qo'yadi — har bir qadam faqat bir marta bajariladi.
+    """
+    conn = _open_db_connection()
+    conn.isolation_level = None
+    applied = []
+    try:
+        conn.execute('''CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TEXT NOT NULL
+        )''')
+        if schema_version(conn) >= MIGRATIONS[-1].version:
+            _migrated_databases.add(app.config['DATABASE'])
+            return applied
+        for step in MIGRATIONS:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                if schema_version(conn) >= step.version:
+                    conn.execute('ROLLBACK')
+                    continue
+                step.apply(conn)
+                conn.execute(
+                    'INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)',
+                    (step.version, step.name, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+                )
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            applied.append(step)
+            print(f"Migratsiya {step.version}: {step.name}")
+    finally:
+        conn.dispose()
+    _migrated_databases.add(app.config['DATABASE'])
+    return applied
+
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Ma'lumotlar bazasi sxemasini oxirgi versiyagacha yangilash"""
+    applied = run_migrations()
+    conn = _open_db_connection()
+    version = schema_version(conn)
+    conn.dispose()
+    print(f"Qo'llangan qadamlar: {len(applied)}, sxema versiyasi: {version}")
+
+
+# ==============================================================================
+# SESSIYALAR - Session Storage
+# ==============================================================================
+
+# Sessiyada saqlanadigan kalitlar; qolganlari so'rov davomida yashaydi xolos
+SESSION_KEYS = ('cart', 'user_uuid', 'user_name')
+_SESSION_ID_RE = re.compile(r'^[A-Za-z0-9_-]{43}$')
+
+
+class SessionStore:
+    """
+    Sessiyalar uchun alohida kichik SQLite bazasi (asosiy bazaning yozish
+    qulfi bilan raqobatlashmaydi). Muddati o'tganlarni fon oqimi tozalaydi.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._sweeper_pid = None
+
+    def _conn(self):
+        path = app.config['SESSION_DB_PATH']
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid() or self._local.path != path:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            conn = sqlite3.connect(path, timeout=app.config['SQLITE_BUSY_TIMEOUT_MS'] / 1000,
+                                   isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute('''CREATE TABLE IF NOT EXISTS sessions (
+                sid TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                expires REAL NOT NULL
+            ) WITHOUT ROWID''')
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions(expires)")
+            self._local.conn, self._local.pid, self._local.path = conn, os.getpid(), path
+        return conn
+
+    def load(self, sid):
+        """(data, expires) yoki None"""
+        row = self._conn().execute(
+            "SELECT data, expires FROM sessions WHERE sid = ?", (sid,)
+        ).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        return row
+
+    def save(self, sid, data, expires):
+        self._conn().execute(
+            "INSERT INTO sessions (sid, data, expires) VALUES (?, ?, ?) "
+            "ON CONFLICT(sid) DO UPDATE SET data = excluded.data, expires = excluded.expires",
+            (sid, data, expires)
+        )
+
+    def delete(self, sid):
+        self._conn().execute("DELETE FROM sessions WHERE sid = ?", (sid,))
+
+    def sweep(self):
+        """Muddati o'tgan sessiyalarni o'chirish; o'chirilganlar sonini qaytaradi"""
+        return self._conn().execute("DELETE FROM sessions WHERE expires < ?", (time.time(),)).rowcount
+
+    def start_sweeper(self):
+        """Har bir jarayonda bitta fon tozalovchi oqim"""
+        with self._lock:
+            if self._sweeper_pid == os.getpid():
+                return
+            self._sweeper_pid = os.getpid()
+        threading.Thread(target=self._sweep_loop, name='session-sweeper', daemon=True).start()
+
+    def _sweep_loop(self):
+        while True:
+            time.sleep(app.config['SESSION_SWEEP_INTERVAL'])
+            try:
+                self.sweep()
+            except sqlite3.Error as e:
+                print(f"Session sweep error: {e}")
+
+
+class StoredSession(SecureCookieSession):
+    """Bazadan yuklangan sessiya: o'zgarish faqat JSON taqqoslash orqali aniqlanadi"""
+
+    def __init__(self, initial=None, sid=None, snapshot=None, expires=0.0):
+        super().__init__(initial)
+        self.sid = sid
+        self.snapshot = snapshot
+        self.expires = expires
+
+
+class SqliteSessionInterface(SessionInterface):
+    """
+    Cookie'da faqat tasodifiy sessiya id; ma'lumot SQLite'da JSON ko'rinishida.
+    Yozish faqat savat/chat maydonlari haqiqatan o'zgarganda yoki muddat
+    yarmidan o'tganda (sliding expiry) bajariladi.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    @staticmethod
+    def serialize(session):
+        payload = {k: session[k] for k in SESSION_KEYS if k in session}
+        if not payload:
+            return None
+        return json.dumps(payload, separators=(',', ':'), sort_keys=True, ensure_ascii=False)
+
+    def open_session(self, app, request):
+        self.store.start_sweeper()
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid and _SESSION_ID_RE.match(sid):
+            row = self.store.load(sid)
+            if row is not None:
+                return StoredSession(json.loads(row[0]), sid, row[0], row[1])
+        return StoredSession()
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.accessed:
+            response.vary.add('Cookie')
+
+        data = self.serialize(session)
+        if data is None:
+            if session.sid is not None:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        now = time.time()
+        ttl = app.config['SESSION_IDLE_TIMEOUT']
+        if data == session.snapshot and session.expires - now > ttl / 2:
+            return
+
+        new_sid = session.sid is None
+        if new_sid:
+            session.sid = secrets.token_urlsafe(32)
+        self.store.save(session.sid, data, now + ttl)
+        if new_sid:
+            response.set_cookie(
+                name, session.sid,
+                expires=self.get_expiration_time(app, session),
+                httponly=self.get_cookie_httponly(app),
+                domain=domain, path=path,
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app),
+            )
+
+
+session_store = SessionStore()
+
+
+def make_session_interface():
+    """SESSION_BACKEND bo'yicha sessiya interfeysi (create_app'da o'rnatiladi)"""
+    if app.config['SESSION_BACKEND'] == 'cookie':
+        # Kichik savatlar uchun: serverda hech narsa saqlanmaydi
+        return SecureCookieSessionInterface()
+    return SqliteSessionInterface(session_store)
+
+
+@app.cli.command('sweep-sessions')
+def sweep_sessions_command():
+    """Muddati o'tgan sessiyalarni o'chirish"""
+    print(f"O'chirilgan sessiyalar: {session_store.sweep()}")
+
+
+# ==============================================================================
+# YORDAMCHI FUNKSIYALAR - Utility Functions
+# ==============================================================================
+
+# O'zbek apostrof variantlari (o‘, g‘, oʻ, ...) bitta belgiga keltiriladi
+# (FTS qidiruv so'rovlari va chat tokenizatsiyasi uchun umumiy)
+_APOSTROPHES = str.maketrans({c: "'" for c in "‘’ʻʼ`´"})
+
+
+def allowed_file(filename):
+    """Rasm fayli to'g'ri formatda ekanligini tekshirish"""
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+
+def allowed_video(filename):
+    """Video fayli to'g'ri formatda ekanligini tekshirish"""
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_VIDEO_EXTENSIONS
+
+
+def normalize_cart(cart):
+    """Savatni dictionary formatiga o'zgartirish"""
+    if isinstance(cart, list):
+        return {str(pid): 1 for pid in cart}
+    return cart
+
+
+def encode_cursor(product_id):
+    """Oxirgi mahsulot id'sini shaffof bo'lmagan kursor tokeniga aylantirish"""
+    return base64.urlsafe_b64encode(f"id:{product_id}".encode()).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    """Kursor tokenidan id olish (noto'g'ri bo'lsa None)"""
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode()
+        prefix, _, value = raw.partition(':')
+        return int(value) if prefix == 'id' else None
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+def get_page_cursor(args):
+    """So'rovdagi 'cursor' yoki 'after_id' parametridan id olish"""
+    if args.get('cursor'):
+        return decode_cursor(args['cursor'])
+    if args.get('after_id'):
+        try:
+            return int(args['after_id'])
+        except ValueError:
+            return None
+    return None
+
+
+def render_description(raw_text):
+    """
+    Tavsif matnidagi {fayl.jpg} larni <img> tegiga aylantirish
+    va qator bo'linishlarini <br> bilan almashtirish
+    """
+    def replace_image(match):
+        filename = match.group(1).strip()
+        img_url = url_for('static', filename=f'images/{filename}')
+        return f'<img src="{img_url}" alt="Rasm" style="max-width:100%;height:auto;">'
+    
+    html = re.sub(r'\{([^}]+)\}', replace_image, raw_text)
+    html = html.replace('\n', '<br>')
+    return Markup(html)
+
+
+# ==============================================================================
+# STATIK FAYLLAR - Fingerprinted Static Assets
+# ==============================================================================
+
+app.config['ASSET_HASHING'] = os.getenv('ASSET_HASHING', '1') == '1'
+app.config['ASSET_MANIFEST'] = os.path.join(app.static_folder, 'asset-manifest.json')
+ASSET_MAX_AGE = 365 * 24 * 3600
+ASSET_HASH_LENGTH = 10
+# Oldindan siqiladigan (matnli) fayl turlari; rasmlar allaqachon siqilgan
+COMPRESSIBLE_EXTENSIONS = {'.css', '.js', '.svg', '.ico', '.json', '.txt', '.ttf', '.html', '.map'}
+_HASHED_NAME_RE = re.compile(r'^(.*)\.([0-9a-f]{%d})(\.[^./]+)$' % ASSET_HASH_LENGTH)
+
+
+class AssetManifest:
+    """
+    Statik fayllar uchun kontent xeshlari: url_for('static') 'styles.<xesh>.css'
+    ko'rinishidagi nomni beradi, bunday so'rovlar esa 'immutable' sarlavha bilan
+    uzoq muddat keshlanadi. Yozuv fayl (mtime, hajm) o'zgarsa qayta hisoblanadi.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = None
+
+    def _load(self):
+        entries = {}
+        try:
+            with open(app.config['ASSET_MANIFEST']) as f:
+                entries = {k: tuple(v) for k, v in json.load(f).items()}
+        except (OSError, ValueError):
+            pass
+        self._entries = entries
+
+    @staticmethod
+    def _digest(path):
+        h = hashlib.blake2b(digest_size=16)
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 16), b''):
+                h.update(block)
+        return h.hexdigest()[:ASSET_HASH_LENGTH]
+
+    def digest(self, filename):
+        """Fayl xeshi (fayl topilmasa None)"""
+        if self._entries is None:
+            with self._lock:
+                if self._entries is None:
+                    self._load()
+        path = os.path.join(app.static_folder, filename)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        entry = self._entries.get(filename)
+        if entry is not None and entry[1] == st.st_mtime_ns and entry[2] == st.st_size:
+            return entry[0]
+        return self.register(filename, st)
+
+    def register(self, filename, st=None):
+        """Yangi (yoki o'zgargan) faylni manifestga qo'shish"""
+        path = os.path.join(app.static_folder, filename)
+        st = st or os.stat(path)
+        digest = self._digest(path)
+        with self._lock:
+            if self._entries is None:
+                self._load()
+            self._entries[filename] = (digest, st.st_mtime_ns, st.st_size)
+        return digest
+
+    def forget(self, filename):
+        with self._lock:
+            if self._entries is not None:
+                self._entries.pop(filename, None)
+
+    def hashed_name(self, filename):
+        """'css/app.css' -> 'css/app.<xesh>.css'"""
+        digest = self.digest(filename)
+        if digest is None:
+            return filename
+        stem, ext = os.path.splitext(filename)
+        return f"{stem}.{digest}{ext}"
+
+    def resolve(self, filename):
+        """So'ralgan nomdan haqiqiy faylni topish: (nom, xesh_mos_kelgani)"""
+        match = _HASHED_NAME_RE.match(filename)
+        if match:
+            original = match.group(1) + match.group(3)
+            if self.digest(original) == match.group(2):
+                return original, True
+        return filename, False
+
+    def save(self):
+        """Manifestni diskka yozish"""
+        with self._lock:
+            data = {k: list(v) for k, v in (self._entries or {}).items()}
+        tmp = app.config['ASSET_MANIFEST'] + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f, indent=0, sort_keys=True)
+        os.replace(tmp, app.config['ASSET_MANIFEST'])
+
+
+asset_manifest = AssetManifest()
+
+
+def register_upload(filename):
+    """Yuklangan faylni (UPLOAD_FOLDER ichida) manifestga qo'shish"""
+    folder = os.path.abspath(app.config['UPLOAD_FOLDER'])
+    static_root = os.path.abspath(app.static_folder)
+    if os.path.commonpath([folder, static_root]) == static_root:
+        asset_manifest.register(os.path.relpath(os.path.join(folder, filename), static_root))
+
+
+@app.url_defaults
+def hashed_static_url(endpoint, values):
+    """url_for('static', ...) ni xeshlangan nomga aylantirish"""
+    if endpoint == 'static' and app.config['ASSET_HASHING'] and 'filename' in values:
+        values['filename'] = asset_manifest.hashed_name(values['filename'])
+
+
+def serve_static(filename):
+    """Statik fayl: xeshlangan nom uchun immutable kesh, oldindan siqilgan variantlar"""
+    real_name, fingerprinted = asset_manifest.resolve(filename)
+    path = safe_join(app.static_folder, real_name)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+
+    send_path, encoding = path, None
+    if os.path.splitext(real_name)[1].lower() in COMPRESSIBLE_EXTENSIONS:
+        accepted = request.accept_encodings
+        for ext, name in (('.br', 'br'), ('.gz', 'gzip')):
+            sibling = path + ext
+            # Eskirgan (asl fayldan eski) variant ishlatilmaydi
+            if accepted[name] and os.path.exists(sibling) and os.path.getmtime(sibling) >= os.path.getmtime(path):
+                send_path, encoding = sibling, name
+                break
+
+    mimetype = mimetypes.guess_type(real_name)[0] or 'application/octet-stream'
+    response = send_file(send_path, mimetype=mimetype, conditional=True)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    if fingerprinted:
+        response.headers['Cache-Control'] = f'public, max-age={ASSET_MAX_AGE}, immutable'
+    return response
+
+
+app.view_functions['static'] = serve_static
+
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    """Statik fayllar manifestini va .gz/.br siqilgan nusxalarini yaratish"""
+    count = compressed = 0
+    for root, _, files in os.walk(app.static_folder):
+        for name in files:
+            path = os.path.join(root, name)
+            rel = os.path.relpath(path, app.static_folder).replace(os.sep, '/')
+            if name.endswith(('.gz', '.br', '.tmp')) or path == app.config['ASSET_MANIFEST']:
+                continue
+            asset_manifest.register(rel)
+            count += 1
+            if os.path.splitext(name)[1].lower() not in COMPRESSIBLE_EXTENSIONS:
+                continue
+            with open(path, 'rb') as f:
+                data = f.read()
+            with open(path + '.gz', 'wb') as f:
+                f.write(gzip.compress(data, compresslevel=9, mtime=0))
+            if brotli is not None:
+                with open(path + '.br', 'wb') as f:
+                    f.write(brotli.compress(data, quality=11))
+            compressed += 1
+    asset_manifest.save()
+    print(f"Manifest: {count} ta fayl, {compressed} tasi siqildi"
+          + ("" if brotli is not None else " (brotli o'rnatilmagan — faqat gzip)"))
+
+
+# ==============================================================================
+# RASMLAR - Responsive Image Variants
+# ==============================================================================
+
+app.config['IMAGE_VARIANT_WIDTHS'] = tuple(
+    int(w) for w in os.getenv('IMAGE_VARIANT_WIDTHS', '160,320,640,1024').split(',')
+)
+app.config['IMAGE_VARIANT_DIR'] = 'variants'  # UPLOAD_FOLDER ichida
+app.config['IMAGE_WORKERS'] = int(os.getenv('IMAGE_WORKERS', 2))
+IMAGE_JPEG_QUALITY = 82
+IMAGE_WEBP_QUALITY = 80
+IMAGE_VARIANT_NEGATIVE_TTL = 60  # variantlari yo'q rasmlar qancha vaqt eslab qolinadi
+
+
+class ImagePipeline:
+    """
+    Yuklangan rasmlardan bir nechta kenglikdagi WebP/JPEG variantlarini
+    cheklangan fon oqimlari hovuzida yaratadi (admin so'rovi kutib qolmaydi).
+    """
+
+    def __init__(self):
+        self._executor = None
+        self._lock = threading.Lock()
+        self._known = {}
+        self._pending = set()
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=app.config['IMAGE_WORKERS'], thread_name_prefix='image-variants'
+                )
+            return self._executor
+
+    def variant_name(self, filename, width, ext):
+        stem = os.path.splitext(filename)[0]
+        return f"{app.config['IMAGE_VARIANT_DIR']}/{stem}_{width}w.{ext}"
+
+    def _path(self, name):
+        return os.path.join(app.config['UPLOAD_FOLDER'], name)
+
+    def generate(self, filename, force=False):
+        """Rasm variantlarini sinxron yaratish; yaratilgan kengliklarni qaytaradi"""
+        src = self._path(filename)
+        os.makedirs(self._path(app.config['IMAGE_VARIANT_DIR']), exist_ok=True)
+        from PIL import Image, ImageOps
+        widths = []
+        with Image.open(src) as img:
+            img = ImageOps.exif_transpose(img)
+            has_alpha = img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
+            img = img.convert('RGBA' if has_alpha else 'RGB')
+            for width in sorted(app.config['IMAGE_VARIANT_WIDTHS']):
+                if width >= img.width:
+                    break  # kattalashtirmaymiz
+                webp_path = self._path(self.variant_name(filename, width, 'webp'))
+                jpg_path = self._path(self.variant_name(filename, width, 'jpg'))
+                if force or not os.path.exists(webp_path) or not os.path.exists(jpg_path):
+                    height = round(img.height * width / img.width)
+                    resized = img.resize((width, height), Image.LANCZOS)
+                    resized.save(webp_path, 'WEBP', quality=IMAGE_WEBP_QUALITY, method=4)
+                    if has_alpha:
+                        flat = Image.new('RGB', resized.size, (255, 255, 255))
+                        flat.paste(resized, mask=resized.getchannel('A'))
+                        resized = flat
+                    resized.save(jpg_path, 'JPEG', quality=IMAGE_JPEG_QUALITY, optimize=True, progressive=True)
+                    register_upload(self.variant_name(filename, width, 'webp'))
+                    register_upload(self.variant_name(filename, width, 'jpg'))
+                widths.append(width)
+        self._known[filename] = (tuple(widths), None)
+        return widths
+
+    def _generate_logged(self, filename, force=False):
+        try:
+            widths = self.generate(filename, force)
+        except Exception as e:
+            print(f"Image variant error ({filename}): {e}")
+            return []
+        finally:
+            with self._lock:
+                self._pending.discard(filename)
+        if widths:
+            self._variants_ready(filename)
+        return widths
+
+    def _variants_ready(self, filename):
+        """Rasmni ishlatadigan mahsulotlar versiyasini oshirish: keshlangan sahifalar srcset bilan qayta quriladi"""
+        conn = get_db_connection()
+        ids = [r['id'] for r in conn.execute(
+            "SELECT id FROM products WHERE instr(',' || image || ',', ?) > 0", (f',{filename},',)
+        )]
+        conn.close()
+        if ids:
+            notify_catalog_changes(ids)
+
+    def submit(self, filename):
+        """Variantlarni fonda yaratish uchun navbatga qo'yish"""
+        with self._lock:
+            self._pending.add(filename)
+        return self.executor.submit(self._generate_logged, filename)
+
+    def pending(self, filenames):
+        """Shu jarayonda variantlari hali yaratilayotgan rasm bormi"""
+        with self._lock:
+            return any(f in self._pending for f in filenames)
+
+    def forget_missing(self, filenames):
+        """'Variant yo'q' deb eslab qolingan yozuvlarni tashlash (diskdan qayta tekshiriladi)"""
+        for f in filenames:
+            known = self._known.get(f)
+            if known is not None and known[1] is not None:
+                self._known.pop(f, None)
+
+    def remove(self, filename):
+        """Rasm o'chirilganda uning variantlarini ham o'chirish"""
+        self._known.pop(filename, None)
+        for width in app.config['IMAGE_VARIANT_WIDTHS']:
+            for ext in ('webp', 'jpg'):
+                path = self._path(self.variant_name(filename, width, ext))
+                if os.path.exists(path):
+                    try:
+                        os.remove(path)
+                    except OSError as e:
+                        print(f"Variant delete error: {e}")
+
+    def widths(self, filename):
+        """Diskda mavjud variant kengliklari (natija keshlanadi)"""
+        known = self._known.get(filename)
+        if known is not None and (known[1] is None or time.monotonic() < known[1]):
+            return known[0]
+        widths = tuple(
+            w for w in sorted(app.config['IMAGE_VARIANT_WIDTHS'])
+            if os.path.exists(self._path(self.variant_name(filename, w, 'webp')))
+        )
+        expires = None if widths else time.monotonic() + IMAGE_VARIANT_NEGATIVE_TTL
+        self._known[filename] = (widths, expires)
+        return widths
+
+
+image_pipeline = ImagePipeline()
+
+
+@app.template_global('image_url')
+def image_url(filename, width=None, ext='jpg'):
+    """Kerakli kenglikdagi variant URL'i (variant bo'lmasa — asl rasm)"""
+    filename = (filename or '').strip()
+    if not filename:
+        return url_for('static', filename='images/default-product.jpg')
+    if width:
+        widths = image_pipeline.widths(filename)
+        fit = [w for w in widths if w >= width] or widths[-1:]
+        if fit:
+            return url_for('static', filename='images/' + image_pipeline.variant_name(filename, fit[0], ext))
+    return url_for('static', filename='images/' + filename)
+
+
+@app.template_global('image_srcset')
+def image_srcset(filename, ext='webp'):
+    """<img srcset> uchun WebP variantlar ro'yxati"""
+    filename = (filename or '').strip()
+    return ', '.join(
+        f"{url_for('static', filename='images/' + image_pipeline.variant_name(filename, w, ext))} {w}w"
+        for w in image_pipeline.widths(filename)
+    ) if filename else ''
+
+
+@app.cli.command('build-image-variants')
+@click.option('--force', is_flag=True, help="Mavjud variantlarni ham qayta yaratish")
+def build_image_variants_command(force):
+    """Mavjud rasmlar uchun variantlarni yaratish (backfill)"""
+    folder = app.config['UPLOAD_FOLDER']
+    names = [n for n in sorted(os.listdir(folder)) if os.path.isfile(os.path.join(folder, n)) and allowed_file(n)]
+    futures = [image_pipeline.executor.submit(image_pipeline._generate_logged, n, force) for n in names]
+    for i, future in enumerate(as_completed(futures), 1):
+        future.result()
+        if i % 10 == 0 or i == len(futures):
+            print(f"... {i}/{len(futures)} ta rasm")
+
+
+# ==============================================================================
+# TAVSIYALAR - Home Page Recommendations
+# ==============================================================================
+
+# Bosh sahifa kartalari uchun kerakli ustunlar
+RECOMMEND_COLUMNS = ('id', 'name', 'price', 'image', 'stock')
+app.config['RECOMMEND_COUNT'] = int(os.getenv('RECOMMEND_COUNT', 6))
+app.config['RECOMMEND_WEIGHTING'] = os.getenv('RECOMMEND_WEIGHTING', 'none')  # none | stock | recency
+app.config['RECOMMEND_REFRESH_SECONDS'] = int(os.getenv('RECOMMEND_REFRESH_SECONDS', 300))
+RECOMMEND_STOCK_WEIGHT_CAP = 50  # katta zaxirali mahsulotlar ustun kelib ketmasligi uchun
+
+
+class RecommendationSampler:
+    """
+    Sotuvda bor mahsulotlar id'larining ixcham massivi.
+    Admin o'zgarishlarida faqat bitta element yangilanadi (swap-remove).
+    Boshqa worker'lardagi o'zgarishlar katalog versiyasi oshganda faqat
+    o'zgargan qatorlar (changed_products) bo'yicha qo'llanadi; to'liq qayta
+    yuklash davriy (RECOMMEND_REFRESH_SECONDS) — u boshqa worker'da
+    o'chirilgan mahsulotlarni ham tozalaydi.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = array('q')
+        self._weights = array('l')
+        self._pos = {}
+        self._cum_weights = None
+        self._loaded_at = 0.0
+        self._version = None
+
+    def _weight(self, product_id, stock):
+        mode = app.config['RECOMMEND_WEIGHTING']
+        if mode == 'stock':
+            return max(1, min(int(stock or 0), RECOMMEND_STOCK_WEIGHT_CAP))
+        if mode == 'recency':
+            return max(1, int(product_id))
+        return 1
+
+    def _eligible(self, stock):
+        return (stock or 0) > 0
+
+    def reload(self):
+        """Barcha mos id'larni bazadan qayta yuklash"""
+        version = get_catalog_version()
+        conn = get_db_connection()
+        rows = conn.execute('SELECT id, stock FROM products WHERE stock > 0').fetchall()
+        conn.close()
+        with self._lock:
+            self._ids = array('q', (r['id'] for r in rows))
+            self._weights = array('l', (self._weight(r['id'], r['stock']) for r in rows))
+            self._pos = {pid: i for i, pid in enumerate(self._ids)}
+            self._cum_weights = None
+            self._loaded_at = time.monotonic()
+            self._version = version
+
+    def _ensure_fresh(self):
+        if self._version is None or time.monotonic() - self._loaded_at > app.config['RECOMMEND_REFRESH_SECONDS']:
+            self.reload()
+            return
+        version = get_catalog_version()
+        if version != self._version:
+            self._apply_changes(version)
+
+    def _apply_changes(self, version):
+        """Oxirgi ko'rilgan versiyadan keyin o'zgargan qatorlarni qo'llash"""
+        conn = get_db_connection()
+        rows = changed_products(conn, self._version, 'id, stock')
+        conn.close()
+        for r in rows:
+            self.update(r['id'], r['stock'])
+        with self._lock:
+            self._version = max(self._version, version)
 
-app = Flask(__name__)
-CORS(app)  # CORS - boshqa domenlardan so'rovlarga ruxsat
-app.secret_key = os.getenv("DATABASE_KEY")
-print(f"Secret Key: {app.secret_key}")
+    def _remove(self, product_id):
+        i = self._pos.pop(product_id, None)
+        if i is None:
+            return
+        last = len(self._ids) - 1
+        if i != last:
+            moved = self._ids[last]
+            self._ids[i] = moved
+            self._weights[i] = self._weights[last]
+            self._pos[moved] = i
+        self._ids.pop()
+        self._weights.pop()
 
-app.config['SESSION_TYPE'] = 'filesystem'  # Faylda saqlansin (sqlite yoki redis ham bo‘lishi mumkin)
-app.config['SESSION_FILE_DIR'] = './sessions'
-app.config['SESSION_PERMANENT'] = False
-app.config['SESSION_USE_SIGNER'] = True
-app.secret_key = os.getenv("DATABASE_KEY")
+    def update(self, product_id, stock):
+        """Bitta mahsulot holatini yangilash (stock=None — o'chirilgan)"""
+        with self._lock:
+            if stock is None or not self._eligible(stock):
+                self._remove(product_id)
+            elif product_id in self._pos:
+                self._weights[self._pos[product_id]] = self._weight(product_id, stock)
+            else:
+                self._pos[product_id] = len(self._ids)
+                self._ids.append(product_id)
+                self._weights.append(self._weight(product_id, stock))
+            self._cum_weights = None
 
-Session(app)
+    def sample_ids(self, k):
+        """k ta tasodifiy (takrorlanmas) id qaytarish"""
+        self._ensure_fresh()
+        with self._lock:
+            n = len(self._ids)
+            if n <= k:
+                return list(self._ids)
+            if app.config['RECOMMEND_WEIGHTING'] == 'none':
+                return random.sample(self._ids, k)
+            if self._cum_weights is None:
+                self._cum_weights = list(accumulate(self._weights))
+            chosen = []
+            seen = set()
+            # Og'irlikli tanlash; takrorlar tashlab yuboriladi
+            for _ in range(k * 10):
+                pid = random.choices(self._ids, cum_weights=self._cum_weights)[0]
+                if pid not in seen:
+                    seen.add(pid)
+                    chosen.append(pid)
+                    if len(chosen) == k:
+                        break
+            return chosen
 
-# === Mistral API sozlamalari ===
-MISTRAL_API_KEY = os.getenv("MISTRAL")
-print(f"Mistral API Key: {MISTRAL_API_KEY}")
-model = "mistral-large-latest"
-client = Mistral(api_key=MISTRAL_API_KEY)
+    def sample(self, k):
+        """Tanlangan mahsulotlarning faqat kerakli ustunlarini olish"""
+        ids = self.sample_ids(k)
+        if not ids:
+            return []
+        conn = get_db_connection()
+        placeholders = ','.join('?' * len(ids))
+        rows = conn.execute(
+            f"SELECT {', '.join(RECOMMEND_COLUMNS)} FROM products WHERE id IN ({placeholders})", ids
+        ).fetchall()
+        conn.close()
+        order = {pid: i for i, pid in enumerate(ids)}
+        return sorted(rows, key=lambda r: order[r['id']])
 
-# Fayl yuklash sozlamalari
-UPLOAD_FOLDER = 'static/images'
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
-ALLOWED_VIDEO_EXTENSIONS = {'mp4', 'mov', 'webm', 'mkv'}
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
-# PDF uchun fontlarni ro'yxatdan o'tkazish
-FONT_DIR = os.path.join(app.root_path, 'static', 'fonts')
-FONT_FILES = {
-    'DejaVuSans': os.path.join(FONT_DIR, 'DejaVuSans.ttf'),
-    'NotoSans': os.path.join(FONT_DIR, 'NotoSans-Regular.ttf')
-}
+recommendations = RecommendationSampler()
 
-REGISTERED_FONTS = {}
-for short, path in FONT_FILES.items():
-    if os.path.exists(path):
-        try:
-            pdfmetrics.registerFont(TTFont(short, path))
-            REGISTERED_FONTS[short] = path
-        except Exception as e:
-            print(f"Font register error: {short}, {e}")
+
+@on_catalog_change
+def _refresh_recommendation(product_id):
+    conn = get_db_connection()
+    row = conn.execute('SELECT stock FROM products WHERE id = ?', (product_id,)).fetchone()
+    conn.close()
+    recommendations.update(product_id, row['stock'] if row else None)
 
 
 # ==============================================================================
-# DATABASE FUNKSIYALARI
+# SAHIFA KESHI - Rendered Product Page Cache
 # ==============================================================================
 
-def get_db_connection():
-    """Ma'lumotlar bazasiga ulanish"""
-    conn = sqlite3.connect('database/shop.db')
-    conn.row_factory = sqlite3.Row
-    return conn
+app.config['PAGE_CACHE_MAX_BYTES'] = int(os.getenv('PAGE_CACHE_MAX_BYTES', 16 * 1024 * 1024))
+app.config['PAGE_CACHE_TTL'] = float(os.getenv('PAGE_CACHE_TTL', 600))
+# Sahifalarni gzip holatida saqlash: xotira ~5 barobar kam, gzip qabul
+# qiluvchi mijozlarga esa baytlar qayta siqilmasdan yuboriladi
+app.config['PAGE_CACHE_COMPRESS'] = os.getenv('PAGE_CACHE_COMPRESS', '1') == '1'
 
 
-def get_all_products_from_db():
-    """Barcha mahsulotlarni olish"""
-    conn = get_db_connection()
-    products = conn.execute('SELECT * FROM products ORDER BY id DESC').fetchall()
-    conn.close()
-    return products
+def get_product_version(conn, product_id):
+    """Mahsulotning joriy versiyasi (mahsulot yo'q bo'lsa None)"""
+    row = conn.execute('SELECT version FROM products WHERE id = ?', (product_id,)).fetchone()
+    return row['version'] if row else None
 
 
-def ensure_products_videos_column():
-    """'products' jadvaliga 'videos' ustuni qo'shish (agar yo'q bo'lsa)"""
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("PRAGMA table_info(products)")
-        cols = [r[1] for r in cur.fetchall()]
-        if 'videos' not in cols:
-            cur.execute("ALTER TABLE products ADD COLUMN videos TEXT DEFAULT ''")
-            conn.commit()
-        conn.close()
-    except Exception as e:
-        print(f"Schema migration (videos) failed: {e}")
+class ProductPageCache:
+    """
+    Tayyor HTML bo'laklari keshi: kalit (tur, mahsulot id, versiya).
+    Hajm baytlarda cheklangan LRU; versiya bazada saqlangani uchun boshqa
+    worker'dagi admin o'zgarishi ham eski nusxani darhol yaroqsiz qiladi.
+    """
 
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (value, size, compressed, created_at)
+        self._by_product = defaultdict(set)
+        self._bytes = 0
+        self.stats = defaultdict(int)
 
-# ==============================================================================
-# YORDAMCHI FUNKSIYALAR - Utility Functions
-# ==============================================================================
+    def _evict(self, key):
+        _, size, _, _ = self._entries.pop(key)
+        self._bytes -= size
+        self._by_product[key[1]].discard(key)
 
-def allowed_file(filename):
-    """Rasm fayli to'g'ri formatda ekanligini tekshirish"""
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    def get(self, kind, product_id, version):
+        """(qiymat, siqilganmi) yoki None"""
+        key = (kind, product_id, version)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[3] <= app.config['PAGE_CACHE_TTL']:
+                self._entries.move_to_end(key)
+                self.stats[f'{kind}_hits'] += 1
+                return entry[0], entry[2]
+            if entry is not None:
+                self._evict(key)
+            self.stats[f'{kind}_misses'] += 1
+            return None
 
+    def put(self, kind, product_id, version, value, compressed=False):
+        key = (kind, product_id, version)
+        size = len(value)
+        limit = app.config['PAGE_CACHE_MAX_BYTES']
+        if size > limit:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._evict(key)
+            # Eski versiyalar endi hech qachon so'ralmaydi
+            for old in [k for k in self._by_product[product_id] if k[0] == kind]:
+                self._evict(old)
+            self._entries[key] = (value, size, compressed, time.monotonic())
+            self._by_product[product_id].add(key)
+            self._bytes += size
+            while self._bytes > limit:
+                self._evict(next(iter(self._entries)))
+                self.stats['evictions'] += 1
 
-def allowed_video(filename):
-    """Video fayli to'g'ri formatda ekanligini tekshirish"""
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_VIDEO_EXTENSIONS
+    def invalidate_product(self, product_id):
+        with self._lock:
+            keys = list(self._by_product.get(product_id, ()))
+            for key in keys:
+                self._evict(key)
+            self._by_product.pop(product_id, None)
+            self.stats['invalidations'] += len(keys)
 
+    def snapshot(self):
+        """Hisoblagichlar, hajm va har bir tur uchun hit ratio"""
+        with self._lock:
+            data = dict(self.stats, entries=len(self._entries), bytes=self._bytes)
+        for kind in ('page', 'description'):
+            hits, misses = data.get(f'{kind}_hits', 0), data.get(f'{kind}_misses', 0)
+            data[f'{kind}_hit_ratio'] = round(hits / (hits + misses), 4) if hits + misses else 0.0
+        return data
 
-def normalize_cart(cart):
-    """Savatni dictionary formatiga o'zgartirish"""
-    if isinstance(cart, list):
-        return {str(pid): 1 for pid in cart}
-    return cart
 
+product_page_cache = ProductPageCache()
 
-def render_description(raw_text):
-    """
-    Tavsif matnidagi {fayl.jpg} larni <img> tegiga aylantirish
-    va qator bo'linishlarini <br> bilan almashtirish
-    """
-    def replace_image(match):
-        filename = match.group(1).strip()
-        img_url = url_for('static', filename=f'images/{filename}')
-        return f'<img src="{img_url}" alt="Rasm" style="max-width:100%;height:auto;">'
-    
-    html = re.sub(r'\{([^}]+)\}', replace_image, raw_text)
-    html = html.replace('\n', '<br>')
-    return Markup(html)
+
+@on_catalog_change
+def _invalidate_product_page(product_id):
+    # products.version notify_catalog_changes / buyurtma tranzaksiyasida oshadi
+    product_page_cache.invalidate_product(product_id)
+
+
+def cached_description(product_id, version, raw_text):
+    """render_description() natijasi, (id, versiya) bo'yicha keshlangan"""
+    if not raw_text:
+        return Markup("")
+    hit = product_page_cache.get('description', product_id, version)
+    if hit is not None:
+        return Markup(hit[0])
+    html = render_description(raw_text)
+    product_page_cache.put('description', product_id, version, str(html))
+    return html
+
+
+@app.route('/api/product-cache-stats')
+def api_product_cache_stats():
+    """API: Mahsulot sahifalari keshi hisoblagichlari"""
+    return jsonify(product_page_cache.snapshot())
 
 
 # ==============================================================================
@@ -167,14 +1924,12 @@ def render_description(raw_text):
 @app.route('/')
 def index():
     """Bosh sahifa - tavsiya etilgan mahsulotlar bilan"""
-    conn = get_db_connection()
-    products = conn.execute('SELECT * FROM products').fetchall()
-    conn.close()
-    recommended = random.sample(products, min(6, len(products)))
+    recommended = recommendations.sample(app.config['RECOMMEND_COUNT'])
     return render_template('index.html', recommended=recommended)
 
 
 @app.route('/products')
+@catalog_conditional(lambda: (len(session.get('cart', {})),))
 def products_list():
     """Mahsulotlar ro'yxati - sahifalash bilan"""
     try:
@@ -185,15 +1940,23 @@ def products_list():
     except ValueError:
         page, per_page = 1, 24
 
+    after_id = get_page_cursor(request.args)
     offset = (page - 1) * per_page
+    total_products = count_products()
     conn = get_db_connection()
     cur = conn.cursor()
-    cur.execute('SELECT COUNT(*) FROM products')
-    total_products = cur.fetchone()[0]
-    cur.execute('SELECT * FROM products ORDER BY id DESC LIMIT ? OFFSET ?', (per_page, offset))
+    if after_id is not None:
+        # Kursor rejimi: OFFSET o'rniga indeks bo'yicha sakrash
+        cur.execute('SELECT * FROM products WHERE id < ? ORDER BY id DESC LIMIT ?', (after_id, per_page + 1))
+    else:
+        cur.execute('SELECT * FROM products ORDER BY id DESC LIMIT ? OFFSET ?', (per_page + 1, offset))
     rows = cur.fetchall()
     conn.close()
 
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    next_cursor = encode_cursor(rows[-1]['id']) if has_more and rows else None
+
     total_pages = (total_products + per_page - 1) // per_page if per_page else 1
     return render_template(
         'products.html',
@@ -201,44 +1964,238 @@ def products_list():
         page=page,
         per_page=per_page,
         total_pages=total_pages,
-        total_products=total_products
+        total_products=total_products,
+        next_cursor=next_cursor
     )
 
 
+def _product_etag_version(product_id):
+    conn = get_db_connection()
+    version = get_product_version(conn, product_id)
+    conn.close()
+    return version
+
+
 @app.route('/product/<int:product_id>')
+@catalog_conditional(lambda product_id: (
+    product_id, app.config['PAGE_CACHE_COMPRESS'] and 'gzip' in request.accept_encodings
+), version_func=_product_etag_version)
 def product(product_id):
-    """Mahsulot tafsilotlari sahifasi"""
+    """Mahsulot tafsilotlari sahifasi (versiya bo'yicha keshlangan HTML)"""
     conn = get_db_connection()
-    product = conn.execute('SELECT * FROM products WHERE id = ?', (product_id,)).fetchone()
-    conn.close()
-    
-    if product is None:
+    version = get_product_version(conn, product_id)
+    if version is None:
+        conn.close()
         return "Mahsulot topilmadi", 404
-    
-    rendered_description = render_description(product['description']) if product and product['description'] else Markup("")
-    return render_template('product.html', product=product, rendered_description=rendered_description)
+
+    hit = product_page_cache.get('page', product_id, version)
+    if hit is None:
+        product = conn.execute('SELECT * FROM products WHERE id = ?', (product_id,)).fetchone()
+        conn.close()
+        if product is None:
+            return "Mahsulot topilmadi", 404
+        rendered_description = cached_description(product_id, version, product['description'])
+        images = [f.strip() for f in (product['image'] or '').split(',') if f.strip()]
+        # Boshqa worker'da yaratilgan variantlar eski "yo'q" yozuvi bilan yashirinmasin
+        image_pipeline.forget_missing(images)
+        html = render_template('product.html', product=product, rendered_description=rendered_description)
+        compress = app.config['PAGE_CACHE_COMPRESS']
+        body = gzip.compress(html.encode(), compresslevel=6) if compress else html.encode()
+        # Variantlar tayyor bo'lmaguncha keshlanmaydi; tayyor bo'lganda versiya oshadi
+        if not image_pipeline.pending(images):
+            product_page_cache.put('page', product_id, version, body, compress)
+        hit = (body, compress)
+    else:
+        conn.close()
+
+    body, compressed = hit
+    response = Response(mimetype='text/html')
+    if compressed and 'gzip' in request.accept_encodings:
+        response.set_data(body)
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response.set_data(gzip.decompress(body) if compressed else body)
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+# ==============================================================================
+# QIDIRUV - Full-Text Product Search (FTS5)
+# ==============================================================================
+
+SEARCH_PAGE_SIZE = 24
+SEARCH_SNIPPET_TOKENS = 16
+# Belgilash uchun vaqtinchalik belgilar (HTML escape'dan keyin <mark> bo'ladi)
+_MARK_OPEN, _MARK_CLOSE = '\x02', '\x03'
+_SEARCH_WORD_RE = re.compile(r'[^\W_]+')
+
+
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index_command():
+    """FTS5 qidiruv indeksini products jadvalidan qayta qurish"""
+    run_migrations()
+    conn = get_db_connection()
+    conn.execute("INSERT INTO products_fts(products_fts) VALUES ('rebuild')")
+    conn.commit()
+    conn.close()
+    print("Qidiruv indeksi qayta qurildi")
+
+
+def build_fts_query(text):
+    """Foydalanuvchi matnidan xavfsiz FTS5 so'rovi: har bir so'z prefiks bilan, AND"""
+    text = (text or '').translate(_APOSTROPHES).replace("'", ' ')
+    words = _SEARCH_WORD_RE.findall(text.lower())[:8]
+    return ' '.join(f'"{w}"*' for w in words)
+
+
+def highlight_markup(text):
+    """FTS5 belgilangan matnini xavfsiz HTML'ga aylantirish"""
+    escaped = str(escape(text or ''))
+    return Markup(escaped.replace(_MARK_OPEN, '<mark>').replace(_MARK_CLOSE, '</mark>'))
+
+
+def encode_search_cursor(rank, product_id):
+    """Qidiruv natijalari uchun (rank, id) kursori"""
+    return base64.urlsafe_b64encode(f"s:{rank!r}:{product_id}".encode()).decode().rstrip('=')
+
+
+def decode_search_cursor(token):
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode()
+        prefix, rank, product_id = raw.split(':')
+        return (float(rank), int(product_id)) if prefix == 's' else None
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+def search_products(query, limit=SEARCH_PAGE_SIZE, cursor=None):
+    """
+    BM25 bo'yicha saralangan qidiruv: (natijalar, keyingi_kursor).
+    Kursor (rank, id) juftligi bo'lib, OFFSET'siz keyingi sahifaga o'tadi.
+    """
+    fts_query = build_fts_query(query)
+    if not fts_query:
+        return [], None
+    after = decode_search_cursor(cursor) if cursor else None
+    conn = get_db_connection()
+    where, params = 'products_fts MATCH ?', [fts_query]
+    if after is not None:
+        where += ' AND (rank > ? OR (rank = ? AND p.id > ?))'
+        params += [after[0], after[0], after[1]]
+    rows = conn.execute(f'''
+        SELECT p.id, p.name, p.price, p.image, p.stock, rank,
+               highlight(products_fts, 0, ?, ?) AS name_hl,
+               snippet(products_fts, 1, ?, ?, '…', ?) AS snippet
+        FROM products_fts JOIN products p ON p.id = products_fts.rowid
+        WHERE {where}
+        ORDER BY rank, p.id
+        LIMIT ?
+    ''', [_MARK_OPEN, _MARK_CLOSE, _MARK_OPEN, _MARK_CLOSE, SEARCH_SNIPPET_TOKENS] + params + [limit + 1]).fetchall()
+    conn.close()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    results = []
+    for r in rows:
+        item = {k: r[k] for k in ('id', 'name', 'price', 'image', 'stock')}
+        item['name_html'] = highlight_markup(r['name_hl'])
+        # {rasm.jpg} joylashtirishlari snippet'da ko'rinmasin
+        item['snippet_html'] = highlight_markup(re.sub(r'\{[^}]*\}', '', r['snippet'] or ''))
+        results.append(item)
+    next_cursor = encode_search_cursor(rows[-1]['rank'], rows[-1]['id']) if has_more and rows else None
+    return results, next_cursor
+
+
+@app.route('/search')
+def search():
+    """Qidiruv sahifasi"""
+    query = request.args.get('q', '').strip()
+    results, next_cursor = search_products(query, cursor=request.args.get('cursor'))
+    return render_template('search.html', query=query, results=results, next_cursor=next_cursor)
+
+
+@app.route('/api/search')
+def api_search():
+    """API: Mahsulot qidiruvi (BM25, prefiks, belgilangan snippet, kursor)"""
+    query = request.args.get('q', '').strip()
+    try:
+        limit = max(1, min(int(request.args.get('limit', SEARCH_PAGE_SIZE)), 60))
+    except ValueError:
+        limit = SEARCH_PAGE_SIZE
+    results, next_cursor = search_products(query, limit, request.args.get('cursor'))
+    base_url = request.host_url.rstrip('/')
+    items = []
+    for r in results:
+        first = (r['image'] or '').split(',')[0].strip()
+        items.append({
+            'id': r['id'],
+            'name': r['name'],
+            'price': r['price'],
+            'stock': r['stock'],
+            'thumbnail': base_url + image_url(first, 320, 'webp') if first else None,
+            'name_html': str(r['name_html']),
+            'snippet_html': str(r['snippet_html']),
+        })
+    return jsonify({'query': query, 'items': items, 'next_cursor': next_cursor, 'has_more': bool(next_cursor)})
 
 
 # ==============================================================================
 # SAVAT BOSHQARUVI - Cart Management
 # ==============================================================================
 
+# Savat sahifalari uchun kerakli ustunlar (description kabi og'ir maydonlarsiz)
+CART_PRODUCT_COLUMNS = ('id', 'name', 'price', 'image', 'stock')
+CART_QUERY_CHUNK = 500  # SQLite parametrlar chegarasidan oshmaslik uchun
+
+HydratedCart = namedtuple('HydratedCart', ['items', 'total'])
+
+
+def hydrate_cart(cart, conn=None):
+    """
+    Savatdagi mahsulotlarni bitta IN (...) so'rovi bilan yuklash.
+    Qator summalari va umumiy summa bir o'tishda hisoblanadi;
+    natija savat tartibida qaytariladi.
+    """
+    quantities = {}
+    for pid, qty in normalize_cart(cart or {}).items():
+        try:
+            quantities[int(pid)] = int(qty)
+        except (TypeError, ValueError):
+            continue
+    if not quantities:
+        return HydratedCart([], 0)
+
+    own_conn = conn is None
+    if own_conn:
+        conn = get_db_connection()
+    columns = ', '.join(CART_PRODUCT_COLUMNS)
+    ids = list(quantities)
+    rows = {}
+    for i in range(0, len(ids), CART_QUERY_CHUNK):
+        chunk = ids[i:i + CART_QUERY_CHUNK]
+        placeholders = ','.join('?' * len(chunk))
+        for row in conn.execute(f'SELECT {columns} FROM products WHERE id IN ({placeholders})', chunk):
+            rows[row['id']] = row
+    if own_conn:
+        conn.close()
+
+    items, total = [], 0
+    for pid, qty in quantities.items():
+        row = rows.get(pid)
+        if row is None:
+            continue
+        item = dict(row)
+        item['quantity'] = qty
+        item['total_price'] = (item['price'] or 0) * qty
+        total += item['total_price']
+        items.append(item)
+    return HydratedCart(items, total)
+
+
 @app.route('/cart')
 def cart():
     """Savat sahifasi"""
-    cart = normalize_cart(session.get('cart', {}))
-    conn = get_db_connection()
-    products = []
-    
-    for pid, quantity in cart.items():
-        product = conn.execute('SELECT * FROM products WHERE id = ?', (int(pid),)).fetchone()
-        if product:
-            product = dict(product)
-            product['quantity'] = quantity
-            product['total_price'] = product['price'] * quantity
-            products.append(product)
-    
-    conn.close()
+    products, _ = hydrate_cart(session.get('cart', {}))
     return render_template('cart.html', products=products)
 
 
@@ -301,52 +2258,406 @@ def update_cart(product_id):
 # BUYURTMA VA TO'LOV - Checkout & Orders
 # ==============================================================================
 
-@app.route('/checkout', methods=['GET', 'POST'])
-def checkout():
-    """Buyurtmani rasmiylashtirish sahifasi"""
-    cart = normalize_cart(session.get('cart', {}))
+# Eski 'orders.products' matnidagi "(#12 Nomi x 3)" elementlari
+LEGACY_ORDER_ITEM_RE = re.compile(r'\(#(\d+)\s+(.*?)\s+x\s+(\d+)\)')
+ORDER_BACKFILL_CHUNK = 500
+
+
+def insert_order_items(conn, order_id, products):
+    """Savat qatorlarini (xarid paytidagi narx bilan) bitta executemany bilan yozish"""
+    conn.executemany(
+        'INSERT INTO order_items (order_id, product_id, name, unit_price, quantity) VALUES (?, ?, ?, ?, ?)',
+        [(order_id, p['id'], p['name'], p['price'] or 0, p['quantity']) for p in products]
+    )
+
+
+def load_order_items(conn, order):
+    """
+    Buyurtma qatorlarini order_items'dan bitta indeksli so'rov bilan olish.
+    Hali ko'chirilmagan eski buyurtmalar uchun matn parsing qilinadi.
+    """
+    rows = conn.execute(
+        'SELECT product_id, name, unit_price, quantity FROM order_items WHERE order_id = ? ORDER BY id',
+        (order['id'],)
+    ).fetchall()
+    if rows:
+        return [{'id': str(r['product_id'] or ''), 'name': r['name'], 'qty': r['quantity'], 'price': r['unit_price']}
+                for r in rows]
+
+    raw_products = order['products'] or ''
+    parsed = LEGACY_ORDER_ITEM_RE.findall(raw_products)
+    if parsed:
+        prices = current_prices(conn, [int(pid) for pid, _, _ in parsed])
+        return [{'id': pid, 'name': name.strip(), 'qty': int(qty), 'price': prices.get(int(pid), 0)}
+                for pid, name, qty in parsed]
+    return [{'id': '', 'name': p, 'qty': '', 'price': 0}
+            for p in [x.strip() for x in re.split(r',|\n', raw_products) if x.strip()]]
+
+
+def current_prices(conn, product_ids):
+    """Mahsulotlarning joriy narxlari bitta IN so'rovi bilan"""
+    ids = list(set(product_ids))
+    if not ids:
+        return {}
+    prices = {}
+    for i in range(0, len(ids), CART_QUERY_CHUNK):
+        chunk = ids[i:i + CART_QUERY_CHUNK]
+        placeholders = ','.join('?' * len(chunk))
+        for r in conn.execute(f'SELECT id, price FROM products WHERE id IN ({placeholders})', chunk):
+            prices[r['id']] = int(r['price'] or 0)
+    return prices
+
+
+def backfill_order_items(chunk_size=ORDER_BACKFILL_CHUNK, progress=None):
+    """
+    Eski buyurtmalarni bo'laklab order_items'ga ko'chirish.
+    Har bir bo'lak alohida tranzaksiya; qayta ishga tushirish xavfsiz.
+    Bitta mahsulotli buyurtmada narx total_price'dan aniq tiklanadi,
+    qolganlarida mahsulotning joriy narxi olinadi.
+    """
     conn = get_db_connection()
-    products, total = [], 0
-    
-    # Savatdagi mahsulotlarni hisoblash
-    for pid, quantity in cart.items():
-        product = conn.execute('SELECT * FROM products WHERE id = ?', (int(pid),)).fetchone()
-        if product:
-            product = dict(product)
-            product['quantity'] = quantity
-            product['total_price'] = product['price'] * quantity
-            total += product['total_price']
-            products.append(product)
-    
-    if request.method == 'POST':
-        name = request.form['name']
-        phone = request.form['phone']
-        address = request.form['address']
-        location = request.form.get('location', '')
-        
-        product_list = ', '.join(
-            [f"(#{p['id']} {p['name']} x {p['quantity']})" for p in products]
+    last_id, migrated = 0, 0
+    while True:
+        orders = conn.execute('''
+            SELECT id, products, total_price FROM orders
+            WHERE id > ? AND NOT EXISTS (SELECT 1 FROM order_items oi WHERE oi.order_id = orders.id)
+            ORDER BY id LIMIT ?
+        ''', (last_id, chunk_size)).fetchall()
+        if not orders:
+            break
+        parsed = {o['id']: LEGACY_ORDER_ITEM_RE.findall(o['products'] or '') for o in orders}
+        prices = current_prices(conn, [int(pid) for items in parsed.values() for pid, _, _ in items])
+        rows = []
+        for o in orders:
+            items = parsed[o['id']]
+            for pid, name, qty in items:
+                qty = int(qty)
+                if len(items) == 1 and o['total_price'] and qty:
+                    price = int(o['total_price']) // qty
+                else:
+                    price = prices.get(int(pid), 0)
+                rows.append((o['id'], int(pid), name.strip(), price, qty))
+        conn.executemany(
+            'INSERT INTO order_items (order_id, product_id, name, unit_price, quantity) VALUES (?, ?, ?, ?, ?)',
+            rows
         )
-        
-        # Hozirgi vaqtni olish
-        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        
-        c = conn.cursor()
-        c.execute(
-            '''INSERT INTO orders (name, phone, address, location, products, total_price, data_add)
-               VALUES (?, ?, ?, ?, ?, ?, ?)''',
-            (name, phone, address, location, product_list, total, now)
+        conn.commit()
+        last_id = orders[-1]['id']
+        migrated += len(orders)
+        if progress:
+            progress(migrated, last_id)
+    conn.close()
+    return migrated
+
+
+@app.cli.command('backfill-order-items')
+def backfill_order_items_command():
+    """Eski buyurtmalar matnidan order_items jadvalini to'ldirish"""
+    run_migrations()
+    total = backfill_order_items(progress=lambda n, last: print(f"... {n} ta buyurtma (oxirgi id: {last})"))
+    print(f"Tayyor: {total} ta buyurtma ko'chirildi")
+
+
+# --- Buyurtma berish (atomar) --------------------------------------------------
+
+app.config['CHECKOUT_MAX_RETRIES'] = int(os.getenv('CHECKOUT_MAX_RETRIES', 6))
+app.config['CHECKOUT_BACKOFF_BASE'] = float(os.getenv('CHECKOUT_BACKOFF_BASE', 0.01))
+app.config['CHECKOUT_BACKOFF_MAX'] = float(os.getenv('CHECKOUT_BACKOFF_MAX', 0.25))
+
+
+class CheckoutError(Exception):
+    """Buyurtmani rasmiylashtirib bo'lmadi"""
+
+
+class OutOfStock(CheckoutError):
+    """Bir yoki bir nechta qator uchun zaxira yetarli emas"""
+
+    def __init__(self, shortfalls):
+        super().__init__("Zaxira yetarli emas")
+        self.shortfalls = shortfalls  # [{'id', 'name', 'requested', 'available'}]
+
+
+class OrderPending(CheckoutError):
+    """Yozuvchi oqim WRITE_ACK_TIMEOUT ichida javob bermadi — buyurtma keyinroq yozilishi mumkin"""
+
+    def __init__(self):
+        super().__init__("Buyurtmangiz hali qayta ishlanmoqda. Iltimos, qayta yubormang — "
+                         "bir necha daqiqadan so'ng operator siz bilan bog'lanadi.")
+
+
+def _write_order(conn, customer, cart):
+    """
+    Ochiq yozish tranzaksiyasi ichida: narx/zaxirani o'qish, kamaytirish,
+    buyurtmani yozish. Commit chaqiruvchining ishi.
+    """
+    # Narx va zaxira yozish qulfi ostida qayta o'qiladi
+    products, total = hydrate_cart(cart, conn)
+    if not products:
+        raise CheckoutError("Savat bo'sh")
+
+    shortfalls = []
+    for p in products:
+        if p['quantity'] <= 0:
+            raise CheckoutError("Noto'g'ri miqdor")
+        cur = conn.execute(
+            'UPDATE products SET stock = stock - ? WHERE id = ? AND stock >= ?',
+            (p['quantity'], p['id'], p['quantity'])
         )
-        order_id = c.lastrowid
+        if cur.rowcount == 0:
+            shortfalls.append({'id': p['id'], 'name': p['name'],
+                               'requested': p['quantity'], 'available': max(p['stock'] or 0, 0)})
+    if shortfalls:
+        raise OutOfStock(shortfalls)
+
+    product_list = ', '.join(f"(#{p['id']} {p['name']} x {p['quantity']})" for p in products)
+    cur = conn.execute(
+        '''INSERT INTO orders (name, phone, address, location, products, total_price, data_add)
+           VALUES (?, ?, ?, ?, ?, ?, ?)''',
+        (customer['name'], customer['phone'], customer['address'], customer.get('location', ''),
+         product_list, total, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    )
+    order_id = cur.lastrowid
+    insert_order_items(conn, order_id, products)
+    # Zaxira o'zgardi: ETag'lar va sahifa versiyalari shu commit bilan birga eskiradi
+    _bump_catalog_meta(conn, [p['id'] for p in products])
+    return order_id, products
+
+
+def _place_order_once(conn, customer, cart):
+    """Bitta BEGIN IMMEDIATE tranzaksiyasi (write-behind o'chirilganda)"""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        result = _write_order(conn, customer, cart)
         conn.commit()
-        conn.close()
-        
+    except BaseException:
+        conn.rollback()
+        raise
+    return result
+
+
+def _place_order_with_retries(conn, customer, cart):
+    """To'g'ridan-to'g'ri yozish: SQLITE_BUSY'da cheklangan backoff bilan qayta urinish"""
+    cfg = app.config
+    for attempt in range(cfg['CHECKOUT_MAX_RETRIES'] + 1):
+        try:
+            return _place_order_once(conn, customer, cart)
+        except sqlite3.OperationalError as e:
+            if not _is_busy(e) or attempt == cfg['CHECKOUT_MAX_RETRIES']:
+                raise
+            delay = min(cfg['CHECKOUT_BACKOFF_MAX'], cfg['CHECKOUT_BACKOFF_BASE'] * (2 ** attempt))
+            time.sleep(delay * random.uniform(0.5, 1.0))
+
+
+def place_order(customer, cart, conn=None):
+    """
+    Savatdan buyurtma yaratish: butun buyurtma bitta yozish tranzaksiyasida,
+    zaxira shartli UPDATE bilan kamaytiriladi (ortiqcha sotuv bo'lmaydi).
+    WRITE_BEHIND yoqilgan bo'lsa buyurtma yozuvchi oqim orqali boshqa
+    buyurtmalar bilan bitta commit'da yoziladi va commit'gacha kutiladi.
+    Aks holda SQLITE_BUSY bo'lsa cheklangan eksponensial kutish bilan qayta uriniladi.
+    Qaytaradi: order_id. Xatolar: OutOfStock, OrderPending, CheckoutError.
+    """
+    cart = dict(cart or {})
+    own_conn = conn is None
+    if own_conn:
+        conn = get_db_connection()
+    cfg = app.config
+    try:
+        if own_conn and cfg['WRITE_BEHIND']:
+            future = write_queue.submit(lambda c: _write_order(c, customer, cart))
+            try:
+                order_id, products = future.result(cfg['WRITE_ACK_TIMEOUT'])
+            except FutureTimeout:
+                # Ish navbatda qoladi va keyin commit bo'lishi mumkin: xato (500) emas
+                raise OrderPending()
+        else:
+            order_id, products = _place_order_with_retries(conn, customer, cart)
+    finally:
+        if own_conn:
+            conn.close()
+    _catalog_state['version'] = None
+
+    # Versiya buyurtma bilan birga oshgan; tinglovchilar (tavsiyalar, sahifa va
+    # javob keshlari) sotilgan har bir mahsulot uchun yangilanadi
+    notify_catalog_changes([p['id'] for p in products], bump=False)
+    return order_id
+
+
+@app.route('/checkout', methods=['GET', 'POST'])
+def checkout():
+    """Buyurtmani rasmiylashtirish sahifasi"""
+    if request.method == 'POST':
+        customer = {
+            'name': request.form['name'],
+            'phone': request.form['phone'],
+            'address': request.form['address'],
+            'location': request.form.get('location', ''),
+        }
+        try:
+            order_id = place_order(customer, session.get('cart', {}))
+        except OutOfStock as e:
+            products, total = hydrate_cart(session.get('cart', {}))
+            return render_template('checkout.html', cart_items=products, total=total,
+                                   error=str(e), shortfalls=e.shortfalls), 409
+        except OrderPending as e:
+            # Savat tozalanmaydi: buyurtma yozilmagan bo'lishi ham mumkin
+            products, total = hydrate_cart(session.get('cart', {}))
+            return render_template('checkout.html', cart_items=products, total=total, error=str(e)), 202
+        except CheckoutError as e:
+            products, total = hydrate_cart(session.get('cart', {}))
+            return render_template('checkout.html', cart_items=products, total=total, error=str(e)), 400
+
         session['cart'] = {}
         return redirect(url_for('success', order_id=order_id))
-    
-    conn.close()
+
+    products, total = hydrate_cart(session.get('cart', {}))
     return render_template('checkout.html', cart_items=products, total=total)
 
+# --- Reverse geocoding keshi ---------------------------------------------------
+
+app.config['NOMINATIM_URL'] = os.getenv('NOMINATIM_URL', 'https://nominatim.openstreetmap.org/reverse')
+app.config['GEOCODE_PRECISION'] = int(os.getenv('GEOCODE_PRECISION', 4))  # ~11 m katak
+app.config['GEOCODE_CACHE_SIZE'] = int(os.getenv('GEOCODE_CACHE_SIZE', 4096))
+app.config['GEOCODE_MIN_INTERVAL'] = float(os.getenv('GEOCODE_MIN_INTERVAL', 1.0))  # Nominatim: 1 so'rov/soniya
+app.config['GEOCODE_TIMEOUT'] = float(os.getenv('GEOCODE_TIMEOUT', 10))
+
+
+class GeocodeError(Exception):
+    """Nominatim'dan manzil olib bo'lmadi"""
+
+
+class GeocodeTimeout(GeocodeError):
+    """Shu katak uchun boshqa so'rov boshlagan chaqiruv vaqtida tugamadi"""
+
+
+class ReverseGeocoder:
+    """
+    Koordinatalarni katakka yaxlitlab manzilni keshlash: xotiradagi LRU,
+    ortida doimiy SQLite jadvali. Bir katak uchun parallel so'rovlar bitta
+    tashqi chaqiruvga birlashtiriladi, tashqi chaqiruvlar esa tezlik
+    cheklovidan o'tadi.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rate_lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._last_call = 0.0
+        self._http = None
+        self._http_pid = None
+        self.stats = {'hits': 0, 'disk_hits': 0, 'coalesced': 0, 'upstream': 0}
+
+    @property
+    def http(self):
+        """requests sessiyasi: birinchi tashqi so'rovda, har bir jarayonda alohida"""
+        if self._http is None or self._http_pid != os.getpid():
+            import requests
+            self._http = requests.Session()
+            self._http.headers['User-Agent'] = 'webshop/1.0'
+            self._http_pid = os.getpid()
+        return self._http
+
+    def cell(self, lat, lon):
+        """Koordinatalarni sozlangan aniqlikkacha yaxlitlash (noto'g'ri bo'lsa ValueError)"""
+        lat, lon = float(lat), float(lon)
+        # nan/inf va diapazondan tashqari qiymatlar keshni ham, Nominatim'ni ham ifloslamasin
+        if not (math.isfinite(lat) and math.isfinite(lon)) or abs(lat) > 90 or abs(lon) > 180:
+            raise ValueError("Koordinata diapazondan tashqarida")
+        precision = app.config['GEOCODE_PRECISION']
+        return f"{round(lat, precision):.{precision}f},{round(lon, precision):.{precision}f}"
+
+    def _remember(self, cell, address):
+        with self._lock:
+            self._entries[cell] = address
+            self._entries.move_to_end(cell)
+            while len(self._entries) > app.config['GEOCODE_CACHE_SIZE']:
+                self._entries.popitem(last=False)
+
+    def _wait_for_slot(self):
+        """
+        Tashqi chaqiruvlar orasida kamida GEOCODE_MIN_INTERVAL soniya: navbatdagi
+        vaqt qulf ostida band qilinadi, kutish esa qulfdan tashqarida.
+        """
+        with self._rate_lock:
+            now = time.monotonic()
+            slot = max(now, self._last_call + app.config['GEOCODE_MIN_INTERVAL'])
+            self._last_call = slot
+        if slot > now:
+            time.sleep(slot - now)
+
+    def _fetch(self, cell):
+        import requests
+        lat, lon = cell.split(',')
+        self._wait_for_slot()
+        with self._lock:
+            self.stats['upstream'] += 1
+        try:
+            with external_call('nominatim'):
+                r = self.http.get(
+                    app.config['NOMINATIM_URL'],
+                    params={'format': 'json', 'lat': lat, 'lon': lon, 'zoom': 18, 'addressdetails': 1},
+                    timeout=app.config['GEOCODE_TIMEOUT']
+                )
+        except requests.exceptions.RequestException as e:
+            raise GeocodeError(f"So'rov xatosi: {e}")
+        if r.status_code != 200:
+            raise GeocodeError(f"Nominatim xatosi: {r.status_code}")
+        if not r.text.strip():
+            raise GeocodeError('Bo\'sh javob keldi')
+        try:
+            return r.json().get("display_name")
+        except ValueError as e:
+            raise GeocodeError(f"JSON xatosi: {e}")
+
+    def lookup(self, lat, lon):
+        """Koordinata uchun manzil (keshdan yoki Nominatim'dan)"""
+        cell = self.cell(lat, lon)
+        with self._lock:
+            if cell in self._entries:
+                self._entries.move_to_end(cell)
+                self.stats['hits'] += 1
+                return self._entries[cell]
+            future = self._inflight.get(cell)
+            leader = future is None
+            if leader:
+                future = self._inflight[cell] = Future()
+            else:
+                self.stats['coalesced'] += 1
+        if not leader:
+            try:
+                return future.result(timeout=app.config['GEOCODE_TIMEOUT'] * 2)
+            except FutureTimeout:
+                raise GeocodeTimeout("Manzil so'rovi vaqti tugadi")
+
+        try:
+            conn = get_db_connection()
+            row = conn.execute('SELECT address FROM geocode_cache WHERE cell = ?', (cell,)).fetchone()
+            if row is not None:
+                address = row['address']
+                with self._lock:
+                    self.stats['disk_hits'] += 1
+            else:
+                address = self._fetch(cell)
+                if address:
+                    conn.execute('INSERT OR REPLACE INTO geocode_cache (cell, address) VALUES (?, ?)', (cell, address))
+                    conn.commit()
+            conn.close()
+            address = address or "Manzil topilmadi"
+            self._remember(cell, address)
+            future.set_result(address)
+            return address
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(cell, None)
+
+
+geocoder = ReverseGeocoder()
+
+
 @app.route('/reverse', methods=['GET'])
 def reverse():
     """Koordinatalarni manzilga aylantirish (reverse geocoding)"""
@@ -357,24 +2668,14 @@ def reverse():
         return jsonify({'error': 'Koordinata topilmadi'}), 400
     
     try:
-        url = f"https://nominatim.openstreetmap.org/reverse?format=json&lat={lat}&lon={lon}&zoom=18&addressdetails=1"
-        headers = {"User-Agent": "webshop/1.0"}
-        r = requests.get(url, headers=headers, timeout=10)
-        
-        if r.status_code != 200:
-            return jsonify({'error': f"Nominatim xatosi: {r.status_code}"}), 500
-        
-        if not r.text.strip():
-            return jsonify({'error': 'Bo\'sh javob keldi'}), 500
-        
-        data = r.json()
-        address = data.get("display_name", "Manzil topilmadi")
+        address = geocoder.lookup(lat, lon)
         return jsonify({'address': address})
-    
-    except requests.exceptions.RequestException as e:
-        return jsonify({'error': f"So'rov xatosi: {e}"}), 500
-    except ValueError as e:
-        return jsonify({'error': f"JSON xatosi: {e}"}), 500
+    except ValueError:
+        return jsonify({'error': 'Koordinata noto\'g\'ri'}), 400
+    except GeocodeTimeout as e:
+        return jsonify({'error': str(e)}), 504
+    except GeocodeError as e:
+        return jsonify({'error': str(e)}), 500
 
 
 @app.route('/success/<int:order_id>')
@@ -382,42 +2683,112 @@ def success(order_id):
     """Buyurtma muvaffaqiyatli sahifasi"""
     conn = get_db_connection()
     order = conn.execute('SELECT * FROM orders WHERE id = ?', (order_id,)).fetchone()
-    conn.close()
-    
     products = []
-    if order and order['products']:
-        raw_items = re.split(r'\),\s*\(', order['products'])
-        products = [item.strip("() ").strip() for item in raw_items]
+    if order:
+        products = [
+            f"#{it['id']} {it['name']} x {it['qty']}" if it['id'] else it['name']
+            for it in load_order_items(conn, order)
+        ]
+    conn.close()
     
     return render_template('success.html', order=order, products=products)
 
 
-@app.route('/download_receipt/<int:order_id>')
-def download_receipt(order_id):
-    """PDF chek — yumshoq spacing, chiroyli jadval va dinamik uzunlik bilan"""
-    requested_font = request.args.get('font', 'DejaVuSans')
-    font_name = requested_font if requested_font in REGISTERED_FONTS else 'DejaVuSans'
-    font_size = 7  # optimal ko‘rinish uchun
+# --- PDF chek: keshlash va render ---------------------------------------------
 
-    conn = get_db_connection()
-    order = conn.execute('SELECT * FROM orders WHERE id = ?', (order_id,)).fetchone()
-    if not order:
-        conn.close()
-        return abort(404, "Order not found")
+app.config['RECEIPT_CACHE_SIZE'] = int(os.getenv('RECEIPT_CACHE_SIZE', 256))
+app.config['RECEIPT_CACHE_DIR'] = os.getenv('RECEIPT_CACHE_DIR', 'cache/receipts')
 
-    # === Mahsulotlarni parsing qilish ===
-    raw_products = order['products'] or ''
-    parsed = re.findall(r'\(#(\d+)\s+(.*?)\s+x\s+(\d+)\)', raw_products)
-    items = []
-    if parsed:
-        for pid, name, qty in parsed:
-            prow = conn.execute('SELECT price FROM products WHERE id = ?', (int(pid),)).fetchone()
-            price = int(prow['price']) if prow and prow['price'] else 0
-            items.append({'id': pid, 'name': name.strip(), 'qty': int(qty), 'price': price})
-    else:
-        for p in [x.strip() for x in re.split(r',|\n', raw_products) if x.strip()]:
-            items.append({'id': '', 'name': p, 'qty': '', 'price': 0})
-    conn.close()
+
+_pdf_state = {'stack': None, 'lock': threading.Lock()}
+
+
+def pdf_stack():
+    """
+    reportlab, qrcode va TTF shriftlarni bir marta yuklash. Keshdagi chek
+    uchun umuman chaqirilmaydi; preload rejimida master jarayonda yuklanib,
+    worker'larga copy-on-write bo'lib o'tadi.
+    """
+    stack = _pdf_state['stack']
+    if stack is not None:
+        return stack
+    with _pdf_state['lock']:
+        if _pdf_state['stack'] is None:
+            import qrcode
+            from reportlab.pdfgen import canvas
+            from reportlab.lib.units import mm
+            from reportlab.pdfbase import pdfmetrics
+            from reportlab.pdfbase.ttfonts import TTFont
+            from reportlab.lib.colors import black, white
+            for short, path in list(REGISTERED_FONTS.items()):
+                try:
+                    pdfmetrics.registerFont(TTFont(short, path))
+                except Exception as e:
+                    print(f"Font register error: {short}, {e}")
+                    REGISTERED_FONTS.pop(short, None)
+            _pdf_state['stack'] = SimpleNamespace(
+                qrcode=qrcode, canvas=canvas, mm=mm, pdfmetrics=pdfmetrics, black=black, white=white
+            )
+    return _pdf_state['stack']
+
+
+@lru_cache(maxsize=16384)
+def text_width(text, font, size):
+    """stringWidth natijasini yodda saqlash"""
+    return pdf_stack().pdfmetrics.stringWidth(text, font, size)
+
+
+@lru_cache(maxsize=4096)
+def wrap_text(text, font, size, max_width):
+    """So‘zni qatorlarga ajratish"""
+    words, lines, cur = text.split(), [], ""
+    for w in words:
+        test = (cur + " " + w).strip()
+        if text_width(test, font, size) <= max_width:
+            cur = test
+        else:
+            if cur:
+                lines.append(cur)
+            cur = w
+    if cur:
+        lines.append(cur)
+    return tuple(lines) or ("",)
+
+
+def draw_qr(c, data, x, y, size):
+    """QR kodni PNG'siz, to'g'ridan-to'g'ri vektor to'rtburchaklar bilan chizish"""
+    pdf = pdf_stack()
+    qr = pdf.qrcode.QRCode(border=4)
+    qr.add_data(data)
+    qr.make(fit=True)
+    matrix = qr.get_matrix()
+    module = size / len(matrix)
+    c.saveState()
+    c.setFillColor(pdf.white)
+    c.rect(x, y, size, size, stroke=0, fill=1)
+    c.setFillColor(pdf.black)
+    path = c.beginPath()
+    for r, row in enumerate(matrix):
+        top = y + size - (r + 1) * module
+        col = 0
+        # Qatordagi ketma-ket qora modullar bitta to'rtburchakka birlashtiriladi
+        while col < len(row):
+            if row[col]:
+                start = col
+                while col < len(row) and row[col]:
+                    col += 1
+                path.rect(x + start * module, top, (col - start) * module, module)
+            else:
+                col += 1
+    c.drawPath(path, stroke=0, fill=1)
+    c.restoreState()
+
+
+def render_receipt_pdf(order, items, font_name):
+    """PDF chek — yumshoq spacing, chiroyli jadval va dinamik uzunlik bilan"""
+    pdf = pdf_stack()
+    mm = pdf.mm
+    font_size = 7  # optimal ko‘rinish uchun
 
     # === PDF sozlamalari ===
     page_width = 80 * mm
@@ -425,21 +2796,6 @@ def download_receipt(order_id):
     right_margin = 5 * mm
     content_width = page_width - left_margin - right_margin
 
-    def wrap_text(text, font, size, max_width):
-        """So‘zni qatorlarga ajratish"""
-        words, lines, cur = text.split(), [], ""
-        for w in words:
-            test = (cur + " " + w).strip()
-            if stringWidth(test, font, size) <= max_width:
-                cur = test
-            else:
-                if cur:
-                    lines.append(cur)
-                cur = w
-        if cur:
-            lines.append(cur)
-        return lines or [""]
-
     # === Dinamik balandlikni hisoblash ===
     line_height = font_size * 1.75  # kengroq qator oralig‘i (oldingidan yumshoqroq)
     qr_size = 45 * mm
@@ -447,11 +2803,14 @@ def download_receipt(order_id):
     bottom_margin = 5 * mm
     col_gap = 32 * mm
 
+    # Chek sanasi — buyurtma vaqti (kesh qayta ishlatilganda ham o'zgarmaydi)
+    order_date = (order['data_add'] or '')[:16] or datetime.now().strftime('%Y-%m-%d %H:%M')
+
     lines_count = 0
     header_lines = [
         "ONLINE DO'KON / ОНЛАЙН МАГАЗИН",
         f"Check / Чек: {order['id']}",
-        f"Sana / Дата: {datetime.now().strftime('%Y-%m-%d %H:%M')}"
+        f"Sana / Дата: {order_date}"
     ]
     customer_lines = [
         f"Ism / Имя: {order['name']}",
@@ -472,7 +2831,7 @@ def download_receipt(order_id):
 
     # === PDF yaratish ===
     buffer = BytesIO()
-    c = canvas.Canvas(buffer, pagesize=(page_width, height_pts))
+    c = pdf.canvas.Canvas(buffer, pagesize=(page_width, height_pts))
     y = height_pts - top_margin
 
     # === Header ===
@@ -492,7 +2851,7 @@ def download_receipt(order_id):
     y -= 6
 
     # === Jadval sarlavhasi ===
-    dash_line = "-" * int(content_width / stringWidth("-", font_name, font_size))
+    dash_line = "-" * int(content_width / text_width("-", font_name, font_size))
     c.drawString(left_margin, y, dash_line)
     y -= line_height
     c.drawString(left_margin + 1, y, "l  Nomi / Товар")
@@ -518,67 +2877,867 @@ def download_receipt(order_id):
         c.drawString(left_margin, y, dash_line)
         y -= line_height * 0.8  # bo‘sh joy (chiziqdan keyin)
 
-    # === Jami ===
-    y -= 5
-    c.setFont(font_name, font_size + 2)
-    c.drawString(left_margin + 8 * mm, y, f"JAMI / ИТОГО: {int(order['total_price']):,} so'm")
-    y -= line_height * 1.8
-    c.setFont(font_name, font_size)
+    # === Jami ===
+    y -= 5
+    c.setFont(font_name, font_size + 2)
+    c.drawString(left_margin + 8 * mm, y, f"JAMI / ИТОГО: {int(order['total_price']):,} so'm")
+    y -= line_height * 1.8
+    c.setFont(font_name, font_size)
+
+    # === QR kod ===
+    qr_payload = {
+        "order": order['id'],
+        "name": order['name'],
+        "items": [{"id": it['id'], "qty": it['qty']} for it in items if it['id']],
+        "total": int(order['total_price'])
+    }
+    encoded = base64.urlsafe_b64encode(json.dumps(qr_payload).encode()).decode()
+    qr_x = (page_width - qr_size) / 2
+    qr_y = y - qr_size - 3
+    draw_qr(c, encoded, qr_x, qr_y, qr_size)
+    y = qr_y - 6
+
+    # === Rahmat matni ===
+    thanks = "Buyurtma berganingiz uchun rahmat! / Спасибо за покупку!"
+    for line in wrap_text(thanks, font_name, font_size, content_width - 10 * mm):
+        c.drawCentredString(page_width / 2, y, line)
+        y -= line_height
+
+    y -= 1.5 * mm  # pastda kichik oraliq
+
+    # === Yakunlash ===
+    c.showPage()
+    c.save()
+    return buffer.getvalue()
+
+
+def receipt_fingerprint(order, items, font_name):
+    """Buyurtma qatori, mahsulotlar va shrift bo'yicha kontent xeshi"""
+    payload = json.dumps([dict(order), items, font_name], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()[:20]
+
+
+class ReceiptCache:
+    """
+    Tayyor PDF cheklar keshi: xotiradagi LRU + diskdagi fayllar.
+    Kalit buyurtma id'si, shrift va kontent xeshidan iborat — buyurtma
+    qatori o'zgarsa xesh ham o'zgaradi va eski nusxa ishlatilmaydi.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.stats = {'hits': 0, 'disk_hits': 0, 'renders': 0}
+
+    def _path(self, order_id, font_name, digest):
+        return os.path.join(app.config['RECEIPT_CACHE_DIR'], f"{order_id}_{font_name}_{digest}.pdf")
+
+    def get_or_render(self, order, items, font_name):
+        """Keshdagi PDF baytlari yoki yangi render"""
+        digest = receipt_fingerprint(order, items, font_name)
+        key = (order['id'], font_name)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == digest:
+                self._entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return entry[1]
+
+        path = self._path(order['id'], font_name, digest)
+        try:
+            with open(path, 'rb') as f:
+                pdf = f.read()
+            self.stats['disk_hits'] += 1
+        except OSError:
+            pdf = render_receipt_pdf(order, items, font_name)
+            self.stats['renders'] += 1
+            self._write(order['id'], font_name, path, pdf)
+
+        with self._lock:
+            self._entries[key] = (digest, pdf)
+            self._entries.move_to_end(key)
+            while len(self._entries) > app.config['RECEIPT_CACHE_SIZE']:
+                self._entries.popitem(last=False)
+        return pdf
+
+    def _write(self, order_id, font_name, path, pdf):
+        """Faylni atomik yozish va shu buyurtmaning eski nusxalarini o'chirish"""
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            for old in globmod.glob(self._path(order_id, font_name, '*')):
+                if old != path:
+                    os.remove(old)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, 'wb') as f:
+                f.write(pdf)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"Receipt cache write error: {e}")
+
+
+receipt_cache = ReceiptCache()
+
+
+@app.route('/download_receipt/<int:order_id>')
+def download_receipt(order_id):
+    """PDF chek (tayyor nusxa keshdan beriladi)"""
+    requested_font = request.args.get('font', 'DejaVuSans')
+    font_name = requested_font if requested_font in REGISTERED_FONTS else 'DejaVuSans'
+
+    conn = get_db_connection()
+    order = conn.execute('SELECT * FROM orders WHERE id = ?', (order_id,)).fetchone()
+    if not order:
+        conn.close()
+        return abort(404, "Order not found")
+
+    # === Buyurtma qatorlari (xarid paytidagi narx bilan) ===
+    items = load_order_items(conn, order)
+    conn.close()
+
+    pdf = receipt_cache.get_or_render(order, items, font_name)
+
+    response = send_file(
+        BytesIO(pdf),
+        as_attachment=True,
+        download_name=f"chek_{order_id}.pdf",
+        mimetype="application/pdf"
+    )
+    response.headers.update({
+        "X-Content-Type-Options": "nosniff",
+        "Content-Security-Policy": "sandbox",
+        "Cache-Control": "no-store, no-cache, must-revalidate, max-age=0",
+        "Pragma": "no-cache"
+    })
+    return response
+
+
+# ==============================================================================
+# ADMIN PANEL - Administrator Routes
+# ==============================================================================
+
+# --- Bo'laklab (davom ettiriladigan) video yuklash ----------------------------
+
+app.config['UPLOAD_TMP_DIR'] = os.getenv('UPLOAD_TMP_DIR', 'cache/uploads')
+app.config['UPLOAD_CHUNK_SIZE'] = int(os.getenv('UPLOAD_CHUNK_SIZE', 4 * 1024 * 1024))
+app.config['UPLOAD_SESSION_TTL'] = int(os.getenv('UPLOAD_SESSION_TTL', 24 * 3600))
+app.config['USE_X_SENDFILE'] = os.getenv('USE_X_SENDFILE', '0') == '1'  # nginx/apache orqali zero-copy
+UPLOAD_STREAM_BLOCK = 1024 * 1024
+_CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+_UPLOAD_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+
+def unique_upload_name(original):
+    """save_files bilan bir xil noyob nom: sana-vaqt + tasodifiy qo'shimcha"""
+    ext = os.path.splitext(original)[1]
+    unique_filename = datetime.now().strftime('%Y%m%d%H%M%S%f') + '_' + uuid.uuid4().hex[:6] + ext
+    return secure_filename(unique_filename)
+
+
+def _upload_paths(upload_id):
+    if not _UPLOAD_ID_RE.match(upload_id or ''):
+        abort(404)
+    base = os.path.join(app.config['UPLOAD_TMP_DIR'], upload_id)
+    return base + '.part', base + '.json'
+
+
+def _read_upload_meta(upload_id):
+    _, meta_path = _upload_paths(upload_id)
+    try:
+        with open(meta_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        abort(404)
+
+
+def _write_upload_meta(upload_id, meta):
+    _, meta_path = _upload_paths(upload_id)
+    tmp = meta_path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp, meta_path)
+
+
+@contextmanager
+def _upload_lock(part_path):
+    """
+    Bitta yuklash uchun jarayonlararo qulf (flock): ochiq fayl yoki, boshqa
+    so'rov shu yuklashga yozayotgan bo'lsa, None beradi.
+    """
+    with open(part_path, 'r+b') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield None
+            return
+        yield f
+
+
+def sweep_stale_uploads():
+    """
+    Muddati o'tgan yuklashlarni tozalash: tugallanmaganlar ham, yakunlanib
+    forma tomonidan bog'lanmaganlar ham (ular vaqtinchalik papkada turadi).
+    """
+    folder = app.config['UPLOAD_TMP_DIR']
+    cutoff = time.time() - app.config['UPLOAD_SESSION_TTL']
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+@app.route('/admin/uploads', methods=['POST'])
+def admin_upload_start():
+    """Admin: Yangi bo'laklab yuklash sessiyasini ochish"""
+    data = request.get_json(silent=True) or {}
+    filename = data.get('filename', '')
+    try:
+        size = int(data.get('size', 0))
+    except (TypeError, ValueError):
+        size = 0
+    if not allowed_video(filename) or size <= 0:
+        return jsonify({'error': "Fayl nomi yoki hajmi noto'g'ri"}), 400
+
+    os.makedirs(app.config['UPLOAD_TMP_DIR'], exist_ok=True)
+    sweep_stale_uploads()
+    upload_id = uuid.uuid4().hex
+    part_path, _ = _upload_paths(upload_id)
+    open(part_path, 'wb').close()
+    _write_upload_meta(upload_id, {'filename': filename, 'size': size, 'stored_name': None})
+    return jsonify({'upload_id': upload_id, 'chunk_size': app.config['UPLOAD_CHUNK_SIZE'], 'received': 0}), 201
+
+
+@app.route('/admin/uploads/<upload_id>', methods=['GET'])
+def admin_upload_status(upload_id):
+    """Admin: Yuklash holati (davom ettirish uchun qabul qilingan baytlar)"""
+    meta = _read_upload_meta(upload_id)
+    part_path, _ = _upload_paths(upload_id)
+    received = meta['size'] if meta['stored_name'] else os.path.getsize(part_path)
+    return jsonify({'upload_id': upload_id, 'received': received, 'size': meta['size'],
+                    'chunk_size': app.config['UPLOAD_CHUNK_SIZE'], 'complete': bool(meta['stored_name'])})
+
+
+@app.route('/admin/uploads/<upload_id>', methods=['PUT'])
+def admin_upload_chunk(upload_id):
+    """Admin: Bitta bo'lakni (Content-Range bilan) to'g'ridan-to'g'ri diskka yozish"""
+    meta = _read_upload_meta(upload_id)
+    part_path, _ = _upload_paths(upload_id)
+    if meta['stored_name']:
+        return jsonify({'error': 'Yuklash allaqachon yakunlangan'}), 409
+
+    match = _CONTENT_RANGE_RE.match(request.headers.get('Content-Range', ''))
+    if not match:
+        return jsonify({'error': 'Content-Range sarlavhasi kerak'}), 400
+    start, end, total = (int(x) for x in match.groups())
+    length = end - start + 1
+    if total != meta['size'] or end >= total or length <= 0 or length > app.config['UPLOAD_CHUNK_SIZE']:
+        return jsonify({'error': "Bo'lak chegaralari noto'g'ri"}), 400
+
+    written = 0
+    try:
+        with _upload_lock(part_path) as f:
+            received = os.path.getsize(part_path)
+            if f is None:
+                # Shu yuklashga boshqa PUT yozmoqda — bir offsetga aralash yozuv bo'lmasin
+                return jsonify({'error': "Boshqa bo'lak yozilmoqda", 'received': received}), 409
+            if _read_upload_meta(upload_id)['stored_name']:
+                return jsonify({'error': 'Yuklash allaqachon yakunlangan'}), 409
+            if start != received:
+                # Mijoz qayerdan davom ettirishni bilishi uchun
+                return jsonify({'error': 'Offset mos emas', 'received': received}), 409
+            f.seek(start)
+            while written < length:
+                block = request.stream.read(min(UPLOAD_STREAM_BLOCK, length - written))
+                if not block:
+                    break
+                f.write(block)
+                written += len(block)
+            f.truncate(start + written)
+    except FileNotFoundError:
+        abort(404)  # muddati o'tib tozalangan
+    if written != length:
+        return jsonify({'error': "Bo'lak to'liq kelmadi", 'received': start + written}), 400
+    return jsonify({'upload_id': upload_id, 'received': start + written, 'size': total})
+
+
+@app.route('/admin/uploads/<upload_id>/complete', methods=['POST'])
+def admin_upload_complete(upload_id):
+    """
+    Admin: Yuklashni yakunlash — saqlanadigan nom band qilinadi, fayl esa
+    mahsulot formasi uni bog'lagunicha (claim_completed_uploads) vaqtinchalik
+    papkada qoladi; bog'lanmasa sweep_stale_uploads muddatidan keyin o'chiradi.
+    """
+    meta = _read_upload_meta(upload_id)
+    part_path, _ = _upload_paths(upload_id)
+    if not meta['stored_name']:
+        try:
+            with _upload_lock(part_path) as f:
+                received = os.path.getsize(part_path)
+                if f is None:
+                    return jsonify({'error': "Boshqa bo'lak yozilmoqda", 'received': received}), 409
+                if received != meta['size']:
+                    return jsonify({'error': "Fayl to'liq yuklanmagan", 'received': received}), 409
+                meta['stored_name'] = unique_upload_name(meta['filename'])
+                _write_upload_meta(upload_id, meta)
+        except FileNotFoundError:
+            abort(404)
+    return jsonify({'upload_id': upload_id, 'filename': meta['stored_name']})
+
+
+def claim_completed_uploads(raw_ids):
+    """
+    Formadagi upload id'larini (original nom, saqlangan nom) juftlariga
+    aylantirish; yakunlangan fayllar shu yerda UPLOAD_FOLDER'ga ko'chiriladi.
+    """
+    claimed = []
+    for upload_id in [x.strip() for x in (raw_ids or '').split(',') if x.strip()]:
+        if not _UPLOAD_ID_RE.match(upload_id):
+            continue
+        part_path, meta_path = _upload_paths(upload_id)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if not meta.get('stored_name'):
+            continue
+        try:
+            shutil.move(part_path, os.path.join(app.config['UPLOAD_FOLDER'], meta['stored_name']))
+        except FileNotFoundError:
+            continue  # boshqa so'rov allaqachon bog'lagan yoki muddati o'tgan
+        os.remove(meta_path)
+        register_upload(meta['stored_name'])
+        claimed.append((meta['filename'], meta['stored_name']))
+    return claimed
+
+
+# --- Ommaviy katalog importi (CSV/JSONL) ---------------------------------------
+# Fayl oqim bilan o'qiladi, qatorlar bo'laklab SKU bo'yicha upsert qilinadi.
+# Rasmlar (URL yoki lokal yo'l) cheklangan oqimlar pulida parallel olinadi.
+
+app.config['IMPORT_BATCH_SIZE'] = int(os.getenv('IMPORT_BATCH_SIZE', 500))
+app.config['IMPORT_IMAGE_WORKERS'] = int(os.getenv('IMPORT_IMAGE_WORKERS', 8))
+app.config['IMPORT_IMAGE_TIMEOUT'] = float(os.getenv('IMPORT_IMAGE_TIMEOUT', 15))
+app.config['IMPORT_IMAGE_MAX_BYTES'] = int(os.getenv('IMPORT_IMAGE_MAX_BYTES', 10 * 1024 * 1024))
+# /admin/import orqali lokal rasm yo'llari faqat shu papka ichidan (bo'sh — taqiqlangan)
+app.config['IMPORT_IMAGE_ROOT'] = os.getenv('IMPORT_IMAGE_ROOT', '')
+# Rasm URL'lari uchun ruxsat etilgan hostlar ('cdn.example.com', '.example.com' —
+# barcha subdomenlar). /admin/import uchun bo'sh ro'yxat URL'larni taqiqlaydi,
+# CLI uchun esa istalgan ommaviy hostga ruxsat beradi
+app.config['IMPORT_IMAGE_HOSTS'] = [h.strip().lower() for h in os.getenv('IMPORT_IMAGE_HOSTS', '').split(',') if h.strip()]
+app.config['IMPORT_IMAGE_SCHEMES'] = [x.strip() for x in os.getenv('IMPORT_IMAGE_SCHEMES', 'https,http').split(',') if x.strip()]
+app.config['IMPORT_IMAGES_MAX_TOTAL_BYTES'] = int(os.getenv('IMPORT_IMAGES_MAX_TOTAL_BYTES', 1024 * 1024 * 1024))
+app.config['IMPORT_MAX_ROWS'] = int(os.getenv('IMPORT_MAX_ROWS', 20000))
+app.config['IMPORT_MAX_FILE_BYTES'] = int(os.getenv('IMPORT_MAX_FILE_BYTES', 50 * 1024 * 1024))
+# /admin/import fayllari fon vazifasi tugaguncha shu yerda turadi
+app.config['IMPORT_JOB_DIR'] = os.getenv('IMPORT_JOB_DIR', 'cache/imports')
+IMPORT_MAX_REDIRECTS = 3
+IMPORT_FORMATS = {'.csv': 'csv', '.jsonl': 'jsonl', '.ndjson': 'jsonl'}
+IMPORT_MAX_ERRORS = 1000  # hisobotdagi xatolar ro'yxati chegarasi (hisoblagichlar to'liq)
+_IMAGE_REF_SPLIT_RE = re.compile(r'\s*[,;|]\s*')
+
+UPSERT_PRODUCT_SQL = '''
+    INSERT INTO products (sku, name, price, description, stock, image, image_source, videos)
+    VALUES (?, ?, ?, ?, ?, ?, ?, '')
+    ON CONFLICT(sku) DO UPDATE SET
+        name = excluded.name, price = excluded.price, description = excluded.description,
+        stock = excluded.stock, image = excluded.image, image_source = excluded.image_source
+'''
+
+
+def import_format(filename):
+    """Fayl kengaytmasidan format ('csv' yoki 'jsonl'); noma'lum bo'lsa None"""
+    return IMPORT_FORMATS.get(os.path.splitext(filename or '')[1].lower())
+
+
+def iter_import_records(stream, fmt):
+    """(qator raqami, yozuv, xato) uchliklarini fayldan oqim bilan o'qish"""
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record, None
+        return
+    for line_no, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield line_no, None, f"JSON xato: {e}"
+            continue
+        if isinstance(record, dict):
+            yield line_no, record, None
+        else:
+            yield line_no, None, "qator JSON obyekt bo'lishi kerak"
+
+
+def _import_int(record, field, default=None):
+    value = record.get(field)
+    if value is None or str(value).strip() == '':
+        if default is None:
+            raise ValueError(f"'{field}' majburiy")
+        return default
+    try:
+        number = int(str(value).strip())
+    except ValueError:
+        raise ValueError(f"'{field}' butun son emas: {value!r}")
+    if number < 0:
+        raise ValueError(f"'{field}' manfiy bo'lishi mumkin emas")
+    return number
+
+
+def validate_import_record(record):
+    """Yozuvni tekshirib mahsulot maydonlariga aylantirish (xato bo'lsa ValueError)"""
+    sku = str(record.get('sku') or '').strip()
+    name = str(record.get('name') or '').strip()
+    if not sku:
+        raise ValueError("'sku' majburiy")
+    if len(sku) > 64:
+        raise ValueError("'sku' 64 belgidan uzun")
+    if not name:
+        raise ValueError("'name' majburiy")
+    images = record.get('images') or ''
+    if isinstance(images, str):
+        images = [ref for ref in _IMAGE_REF_SPLIT_RE.split(images.strip()) if ref]
+    elif isinstance(images, list):
+        images = [str(ref).strip() for ref in images if str(ref).strip()]
+    else:
+        raise ValueError("'images' satr yoki ro'yxat bo'lishi kerak")
+    return {
+        'sku': sku,
+        'name': name,
+        'price': _import_int(record, 'price'),
+        'stock': _import_int(record, 'stock', 0),
+        'description': str(record.get('description') or '').replace('\r\n', '\n'),
+        'images': list(dict.fromkeys(images)),
+    }
+
+
+class ImageFetchPolicy:
+    """
+    Import rasmlari qayerdan va qancha hajmda olinishi mumkin: lokal papka,
+    URL sxemalari va hostlari, butun import uchun umumiy bayt chegarasi.
+    Ichki tarmoq (private, loopback, link-local) manzillari har doim rad etiladi;
+    ulanish tekshirilgan manzilning o'ziga qilinadi (DNS qayta so'ralmaydi).
+    """
+
+    def __init__(self, base_dir=None, hosts=None):
+        self.base_dir = base_dir
+        self.hosts = hosts  # None — istalgan ommaviy host
+        self.schemes = set(app.config['IMPORT_IMAGE_SCHEMES'])
+        self._lock = threading.Lock()
+        self._remaining = app.config['IMPORT_IMAGES_MAX_TOTAL_BYTES']
+
+    def _host_allowed(self, host):
+        if self.hosts is None:
+            return True
+        return any(host == h or (h.startswith('.') and host.endswith(h)) for h in self.hosts)
+
+    def check_url(self, url):
+        """
+        URL'ni tekshirish: sxema, host ro'yxati va host manzillari ommaviy
+        bo'lishi. Ulanish uchun tekshirilgan IP manzilni qaytaradi.
+        """
+        parts = urlsplit(url)
+        host = (parts.hostname or '').lower()
+        if parts.scheme not in self.schemes or not host:
+            raise ValueError(f"URL sxemasi ruxsat etilmagan: {url}")
+        if not self._host_allowed(host):
+            raise ValueError(f"host ruxsat etilmagan: {host}")
+        try:
+            infos = socket.getaddrinfo(host, parts.port or (443 if parts.scheme == 'https' else 80),
+                                       proto=socket.IPPROTO_TCP)
+        except (socket.gaierror, UnicodeError):
+            raise ValueError(f"host topilmadi: {host}")
+        addresses = [info[4][0].split('%')[0] for info in infos]
+        for address in addresses:
+            if not ipaddress.ip_address(address).is_global:
+                raise ValueError(f"ichki tarmoq manziliga ruxsat yo'q: {host}")
+        return addresses[0]
+
+    def consume(self, size):
+        """Umumiy bayt chegarasidan ayirish (oshib ketsa ValueError)"""
+        with self._lock:
+            if size > self._remaining:
+                raise ValueError("import uchun rasmlar hajmi chegarasi tugadi")
+            self._remaining -= size
+
+
+@contextmanager
+def _pinned_get(url, address):
+    """
+    URL'ni check_url tekshirgan IP manzilga ulanib olish: so'rov IP'ga
+    yuboriladi, Host sarlavhasi, TLS SNI va sertifikat tekshiruvi esa asl host
+    nomi bilan — DNS rebinding tekshiruv va ulanish orasida manzilni almashtira
+    olmaydi. Muhitdagi proksi sozlamalari ishlatilmaydi (ular hostni o'zi hal qiladi).
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    parts = urlsplit(url)
+    hostname = parts.hostname
+
+    class PinnedAdapter(HTTPAdapter):
+        def build_connection_pool_key_attributes(self, request, verify, cert=None):
+            host_params, pool_kwargs = super().build_connection_pool_key_attributes(request, verify, cert)
+            if host_params['scheme'] == 'https':
+                pool_kwargs['server_hostname'] = hostname
+                pool_kwargs['assert_hostname'] = hostname
+            return host_params, pool_kwargs
+
+    netloc = f'[{address}]' if ':' in address else address
+    if parts.port:
+        netloc += f':{parts.port}'
+    with requests.Session() as http:
+        http.trust_env = False
+        http.mount('http://', PinnedAdapter())
+        http.mount('https://', PinnedAdapter())
+        with external_call('image_import'):
+            resp = http.get(parts._replace(netloc=netloc).geturl(), stream=True, allow_redirects=False,
+                            headers={'Host': parts.netloc.rsplit('@', 1)[-1]},
+                            timeout=app.config['IMPORT_IMAGE_TIMEOUT'])
+        with resp:
+            yield resp
+
+
+def _download_import_image(url, folder, policy):
+    # Yo'naltirishlar qo'lda kuzatiladi — har bir manzil qayta tekshiriladi
+    for _ in range(IMPORT_MAX_REDIRECTS + 1):
+        with _pinned_get(url, policy.check_url(url)) as resp:
+            if resp.is_redirect:
+                url = urljoin(url, resp.headers['Location'])
+                continue
+            return _save_import_image(url, resp, folder, policy)
+    raise ValueError(f"yo'naltirishlar juda ko'p: {url}")
+
+
+def _save_import_image(url, resp, folder, policy):
+    """Javob tanasini hajm chegaralari bilan UPLOAD_FOLDER'ga yozish"""
+    resp.raise_for_status()
+    ext = os.path.splitext(urlsplit(url).path)[1].lower()
+    if not allowed_file(ext):
+        content_type = resp.headers.get('Content-Type', '').split(';')[0].strip()
+        ext = mimetypes.guess_extension(content_type) or ''
+    if not allowed_file(ext):
+        raise ValueError(f"rasm formati qo'llab-quvvatlanmaydi: {url}")
+    stored = unique_upload_name('image' + ext)
+    path = os.path.join(folder, stored)
+    size = 0
+    try:
+        with open(path, 'wb') as f:
+            for block in resp.iter_content(UPLOAD_STREAM_BLOCK):
+                size += len(block)
+                if size > app.config['IMPORT_IMAGE_MAX_BYTES']:
+                    raise ValueError(f"rasm juda katta: {url}")
+                policy.consume(len(block))
+                f.write(block)
+    except BaseException:
+        os.remove(path)
+        raise
+    return stored
+
+
+def fetch_import_image(ref, policy):
+    """
+    Bitta rasmni URL'dan yuklab olish yoki policy.base_dir ichidan nusxalash;
+    save_files bilan bir xil noyob nom bilan saqlab, nomni qaytaradi.
+    """
+    folder = app.config['UPLOAD_FOLDER']
+    if '://' in ref:
+        stored = _download_import_image(ref, folder, policy)
+    else:
+        if not policy.base_dir:
+            raise ValueError(f"lokal rasm yo'llari ruxsat etilmagan: {ref}")
+        root = os.path.realpath(policy.base_dir)
+        source = os.path.realpath(os.path.join(root, ref))
+        if os.path.commonpath([root, source]) != root:
+            raise ValueError(f"rasm yo'li papkadan tashqarida: {ref}")
+        if not allowed_file(source):
+            raise ValueError(f"rasm formati qo'llab-quvvatlanmaydi: {ref}")
+        if not os.path.isfile(source):
+            raise ValueError(f"rasm topilmadi: {ref}")
+        policy.consume(os.path.getsize(source))
+        stored = unique_upload_name(source)
+        shutil.copyfile(source, os.path.join(folder, stored))
+    register_upload(stored)
+    image_pipeline.submit(stored)
+    return stored
+
+
+def _remove_upload(filename):
+    path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    if os.path.exists(path):
+        try:
+            os.remove(path)
+        except Exception as e:
+            print(f"File delete error: {e}")
+    image_pipeline.remove(filename)
+
+
+def _import_error(report, line_no, sku, message):
+    if len(report['errors']) < IMPORT_MAX_ERRORS:
+        report['errors'].append({'line': line_no, 'sku': sku or None, 'error': message})
+
+
+def _import_batch(batch, pool, policy, report):
+    """Bir bo'lak: rasmlarni parallel olish, keyin bitta tranzaksiyada executemany upsert"""
+    conn = get_db_connection()
+    placeholders = ','.join('?' * len(batch))
+    existing = {r['sku']: r for r in conn.execute(
+        f'SELECT id, sku, name, price, description, stock, image, image_source FROM products '
+        f'WHERE sku IN ({placeholders})', list(batch)
+    )}
+
+    # Rasm manbalari o'zgarmagan mahsulotlar uchun qayta yuklanmaydi; bir xil
+    # URL ikki mahsulotda bo'lsa ham fayllar alohida (o'chirishda bir-biriga tegmaydi)
+    futures = {}
+    for sku, (line_no, row) in batch.items():
+        source = '\n'.join(row['images'])
+        old = existing.get(sku)
+        if old is not None and source == old['image_source']:
+            row['image'], row['image_source'] = old['image'] or '', source
+        else:
+            futures[sku] = [pool.submit(fetch_import_image, ref, policy) for ref in row['images']]
+
+    fetched = []
+    for sku, row_futures in futures.items():
+        line_no, row = batch[sku]
+        stored = []
+        for ref, future in zip(row['images'], row_futures):
+            try:
+                stored.append(future.result())
+            except Exception as e:
+                report['images_failed'] += 1
+                _import_error(report, line_no, sku, f"rasm olinmadi ({ref}): {e}")
+        report['images_fetched'] += len(stored)
+        fetched.extend(stored)
+        row['image'] = ','.join(stored)
+        # Biror rasm olinmasa manba saqlanmaydi — keyingi importda qayta urinadi
+        row['image_source'] = '\n'.join(row['images']) if len(stored) == len(row['images']) else ''
+
+    values, replaced = [], []
+    for sku, (line_no, row) in batch.items():
+        old = existing.get(sku)
+        fields = (row['name'], row['price'], row['description'], row['stock'], row['image'], row['image_source'])
+        if old is not None and fields == (old['name'], old['price'], old['description'], old['stock'],
+                                          old['image'] or '', old['image_source']):
+            report['unchanged'] += 1
+            continue
+        values.append((sku,) + fields)
+        if old is None:
+            report['inserted'] += 1
+        else:
+            report['updated'] += 1
+            kept = set(row['image'].split(','))
+            replaced.extend(n for n in (old['image'] or '').split(',') if n and n not in kept)
+    if not values:
+        conn.close()
+        return
+
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.executemany(UPSERT_PRODUCT_SQL, values)
+        changed = [v[0] for v in values]
+        ids = [r['id'] for r in conn.execute(
+            f"SELECT id FROM products WHERE sku IN ({','.join('?' * len(changed))})", changed
+        )]
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        for name in fetched:
+            _remove_upload(name)
+        raise
+    conn.close()
+    for name in replaced:
+        _remove_upload(name)
+    notify_catalog_changes(ids)
+
+
+def import_catalog(stream, fmt, policy, progress=None):
+    """
+    Katalogni CSV/JSONL oqimidan SKU bo'yicha import qilish (qayta import
+    xavfsiz). Ustunlar: sku, name, price, stock, description, images
+    (vergul bilan yoki JSON ro'yxat); rasmlar policy (ImageFetchPolicy)
+    doirasida olinadi. Xato qatorlar o'tkazib yuboriladi va hisobotga
+    yoziladi; IMPORT_MAX_ROWS'dan keyingi qatorlar o'qilmaydi.
+    progress(report) har bir bo'lakdan keyin chaqiriladi.
+    """
+    report = {'rows': 0, 'inserted': 0, 'updated': 0, 'unchanged': 0, 'failed': 0,
+              'images_fetched': 0, 'images_failed': 0, 'errors': []}
+    batch = OrderedDict()
+    with ThreadPoolExecutor(max_workers=app.config['IMPORT_IMAGE_WORKERS'],
+                            thread_name_prefix='catalog-import') as pool:
+        try:
+            for line_no, record, error in iter_import_records(stream, fmt):
+                if report['rows'] >= app.config['IMPORT_MAX_ROWS']:
+                    _import_error(report, line_no, None,
+                                  f"qatorlar chegarasi ({app.config['IMPORT_MAX_ROWS']}): qolganlari o'qilmadi")
+                    break
+                report['rows'] += 1
+                if error is None:
+                    try:
+                        row = validate_import_record(record)
+                    except ValueError as e:
+                        error = str(e)
+                if error is not None:
+                    report['failed'] += 1
+                    _import_error(report, line_no, (record or {}).get('sku'), error)
+                    continue
+                # Fayl ichida takrorlangan SKU: oxirgi qator yutadi
+                batch.pop(row['sku'], None)
+                batch[row['sku']] = (line_no, row)
+                if len(batch) >= app.config['IMPORT_BATCH_SIZE']:
+                    _import_batch(batch, pool, policy, report)
+                    batch.clear()
+                    if progress:
+                        progress(report)
+        except (UnicodeDecodeError, csv.Error) as e:
+            report['failed'] += 1
+            _import_error(report, None, None, f"fayl o'qilmadi: {e}")
+        if batch:
+            _import_batch(batch, pool, policy, report)
+            if progress:
+                progress(report)
+    return report
+
+
+@app.cli.command('import-catalog')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), help="Standart: fayl kengaytmasidan")
+@click.option('--images-dir', type=click.Path(exists=True, file_okay=False),
+              help="Lokal rasm yo'llari uchun papka (standart: fayl joylashgan papka)")
+def import_catalog_command(path, fmt, images_dir):
+    """CSV/JSONL faylidan mahsulotlarni SKU bo'yicha import qilish"""
+    fmt = fmt or import_format(path)
+    if fmt is None:
+        raise click.BadParameter("format aniqlanmadi, --format bering", param_hint='PATH')
+    run_migrations()
+    started = time.perf_counter()
+    with open(path, encoding='utf-8-sig', newline='') as f:
+        report = import_catalog(
+            f, fmt, ImageFetchPolicy(base_dir=images_dir or os.path.dirname(os.path.abspath(path)),
+                                     hosts=app.config['IMPORT_IMAGE_HOSTS'] or None),
+            progress=lambda r: print(f"... {r['rows']} qator: +{r['inserted']} yangi, "
+                                     f"{r['updated']} yangilandi, {r['failed']} xato")
+        )
+    for e in report['errors']:
+        print(f"  qator {e['line'] or '-'} [{e['sku'] or '-'}]: {e['error']}")
+    print(f"Tayyor ({time.perf_counter() - started:.1f} s): {report['inserted']} yangi, "
+          f"{report['updated']} yangilandi, {report['unchanged']} o'zgarmagan, {report['failed']} xato qator; "
+          f"rasmlar: {report['images_fetched']} olindi, {report['images_failed']} xato")
+
+
+class ImportJobs:
+    """
+    /admin/import fon vazifalari: fayl IMPORT_JOB_DIR'ga saqlanadi, import
+    bitta fon oqimida navbat bilan bajariladi (so'rov worker'i band bo'lmaydi).
+    Holat va hisobot 'import_jobs' jadvalida — uni istalgan worker o'qiy oladi.
+    Holatlar: queued -> running -> done | failed.
+    """
+
+    def __init__(self):
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='catalog-import-job')
+            return self._executor
+
+    @staticmethod
+    def _save(job_id, status, report):
+        conn = get_db_connection()
+        conn.execute(
+            'UPDATE import_jobs SET status = ?, report = ?, updated_at = ? WHERE id = ?',
+            (status, json.dumps(report, ensure_ascii=False), datetime.now().strftime("%Y-%m-%d %H:%M:%S"), job_id)
+        )
+        conn.commit()
+        conn.close()
+
+    def submit(self, upload, fmt, policy):
+        """Yuklangan faylni saqlab, importni navbatga qo'yish; vazifa id'sini qaytaradi"""
+        job_id = uuid.uuid4().hex
+        os.makedirs(app.config['IMPORT_JOB_DIR'], exist_ok=True)
+        path = os.path.join(app.config['IMPORT_JOB_DIR'], f'{job_id}.{fmt}')
+        upload.save(path)
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        conn = get_db_connection()
+        conn.execute(
+            "INSERT INTO import_jobs (id, filename, status, created_at, updated_at) VALUES (?, ?, 'queued', ?, ?)",
+            (job_id, upload.filename, now, now)
+        )
+        conn.commit()
+        conn.close()
+        self.executor.submit(self._run, job_id, path, fmt, policy)
+        return job_id
 
-    # === QR kod ===
-    qr_payload = {
-        "order": order['id'],
-        "name": order['name'],
-        "items": [{"id": it['id'], "qty": it['qty']} for it in items if it['id']],
-        "total": int(order['total_price'])
-    }
-    encoded = base64.urlsafe_b64encode(json.dumps(qr_payload).encode()).decode()
-    qr_img = qrcode.make(encoded)
-    qr_buf = BytesIO()
-    qr_img.save(qr_buf, format="PNG")
-    qr_reader = ImageReader(qr_buf)
-    qr_x = (page_width - qr_size) / 2
-    qr_y = y - qr_size - 3
-    c.drawImage(qr_reader, qr_x, qr_y, width=qr_size, height=qr_size)
-    y = qr_y - 6
+    def _run(self, job_id, path, fmt, policy):
+        try:
+            self._save(job_id, 'running', {})
+            with open(path, encoding='utf-8-sig', newline='') as f:
+                report = import_catalog(f, fmt, policy, progress=lambda r: self._save(job_id, 'running', r))
+            self._save(job_id, 'done', report)
+        except Exception as e:
+            print(f"Import job error ({job_id}): {e}")
+            self._save(job_id, 'failed', {'error': str(e)})
+        finally:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            close_db_connection()
 
-    # === Rahmat matni ===
-    thanks = "Buyurtma berganingiz uchun rahmat! / Спасибо за покупку!"
-    for line in wrap_text(thanks, font_name, font_size, content_width - 10 * mm):
-        c.drawCentredString(page_width / 2, y, line)
-        y -= line_height
+    @staticmethod
+    def get(job_id):
+        """Vazifa holati va hisoboti (topilmasa None)"""
+        conn = get_db_connection()
+        row = conn.execute('SELECT * FROM import_jobs WHERE id = ?', (job_id,)).fetchone()
+        conn.close()
+        if row is None:
+            return None
+        return {'job_id': row['id'], 'filename': row['filename'], 'status': row['status'],
+                'report': json.loads(row['report']), 'created_at': row['created_at'],
+                'updated_at': row['updated_at']}
 
-    y -= 1.5 * mm  # pastda kichik oraliq
 
-    # === Yakunlash ===
-    c.showPage()
-    c.save()
-    buffer.seek(0)
+import_jobs = ImportJobs()
 
-    response = send_file(
-        buffer,
-        as_attachment=True,
-        download_name=f"chek_{order_id}.pdf",
-        mimetype="application/pdf"
-    )
-    response.headers.update({
-        "X-Content-Type-Options": "nosniff",
-        "Content-Security-Policy": "sandbox",
-        "Cache-Control": "no-store, no-cache, must-revalidate, max-age=0",
-        "Pragma": "no-cache"
-    })
-    return response
 
+@app.route('/admin/import', methods=['POST'])
+def admin_import_catalog():
+    """Admin: CSV/JSONL faylidan ommaviy import — fon vazifasi sifatida (202 + vazifa id)"""
+    if request.content_length is None or request.content_length > app.config['IMPORT_MAX_FILE_BYTES']:
+        return jsonify({'error': f"Fayl hajmi {app.config['IMPORT_MAX_FILE_BYTES']} baytdan oshmasligi kerak"}), 413
+    upload = request.files.get('file')
+    if upload is None or not upload.filename:
+        return jsonify({'error': "Fayl tanlanmagan"}), 400
+    fmt = request.form.get('format') or import_format(upload.filename)
+    if fmt not in ('csv', 'jsonl'):
+        return jsonify({'error': "Faqat CSV yoki JSONL fayllar qabul qilinadi"}), 400
+    # Rasm URL'lari faqat sozlangan hostlardan, lokal yo'llar faqat IMPORT_IMAGE_ROOT ichidan
+    policy = ImageFetchPolicy(base_dir=app.config['IMPORT_IMAGE_ROOT'] or None,
+                              hosts=app.config['IMPORT_IMAGE_HOSTS'])
+    job_id = import_jobs.submit(upload, fmt, policy)
+    return jsonify({'job_id': job_id, 'status': 'queued',
+                    'status_url': url_for('admin_import_status', job_id=job_id)}), 202
+
+
+@app.route('/admin/import/<job_id>', methods=['GET'])
+def admin_import_status(job_id):
+    """Admin: Import vazifasi holati va hisoboti"""
+    job = import_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Vazifa topilmadi'}), 404
+    return jsonify(job)
 
-# ==============================================================================
-# ADMIN PANEL - Administrator Routes
-# ==============================================================================
 
 @app.route('/admin/add', methods=['GET', 'POST'])
 def admin_add_product():
     """Admin: Yangi mahsulot qo'shish"""
-    ensure_products_videos_column()
-    
     if request.method == 'POST':
         name = request.form['name']
         price = int(request.form['price'])
@@ -604,6 +3763,8 @@ def admin_add_product():
                     secure_name = secure_filename(unique_filename)
                     filepath = os.path.join(app.config['UPLOAD_FOLDER'], secure_name)
                     file.save(filepath)
+                    register_upload(secure_name)
+                    image_pipeline.submit(secure_name)
                     original_to_unique[file.filename] = secure_name
         
         save_files(request.files.getlist('images'))
@@ -617,8 +3778,13 @@ def admin_add_product():
                 secure_name = secure_filename(unique_filename)
                 vpath = os.path.join(app.config['UPLOAD_FOLDER'], secure_name)
                 vfile.save(vpath)
+                register_upload(secure_name)
                 original_video_to_unique[vfile.filename] = secure_name
         
+        # Bo'laklab yuklangan videolar (forma faqat upload id'larini yuboradi)
+        for original, stored in claim_completed_uploads(request.form.get('video_upload_ids')):
+            original_video_to_unique[original] = stored
+        
         # Tartib bo'yicha birlashtirish (faqat mahsulot rasmlari)
         ordered_images = []
         for orig in ordered_product:
@@ -639,18 +3805,13 @@ def admin_add_product():
         
         # Ma'lumotlar bazasiga saqlash
         conn = get_db_connection()
-        try:
-            conn.execute(
-                'INSERT INTO products (name, price, description, stock, image, videos) VALUES (?, ?, ?, ?, ?, ?)',
-                (name, price, description, stock, images_str, videos_str)
-            )
-        except Exception:
-            conn.execute(
-                'INSERT INTO products (name, price, description, stock, image) VALUES (?, ?, ?, ?, ?)',
-                (name, price, description, stock, images_str)
-            )
+        cur = conn.execute(
+            'INSERT INTO products (name, price, description, stock, image, videos) VALUES (?, ?, ?, ?, ?, ?)',
+            (name, price, description, stock, images_str, videos_str)
+        )
         conn.commit()
         conn.close()
+        notify_catalog_change(cur.lastrowid)
         
         return redirect(url_for('index'))
     
@@ -667,7 +3828,6 @@ def admin_edit_product(product_id):
     cur = conn.cursor()
     
     if request.method == 'POST':
-        ensure_products_videos_column()
         name = request.form['name']
         price = int(request.form['price']) if request.form.get('price') else 0
         description = request.form['description']
@@ -686,6 +3846,8 @@ def admin_edit_product(product_id):
                 secure_name = secure_filename(unique_filename)
                 filepath = os.path.join(app.config['UPLOAD_FOLDER'], secure_name)
                 file.save(filepath)
+                register_upload(secure_name)
+                image_pipeline.submit(secure_name)
                 ordered_images.append(secure_name)
         
         # Yangi tavsifnoma rasmlari (faqat description ichida ishlatiladi)
@@ -697,6 +3859,8 @@ def admin_edit_product(product_id):
                 secure_name = secure_filename(unique_filename)
                 filepath = os.path.join(app.config['UPLOAD_FOLDER'], secure_name)
                 file.save(filepath)
+                register_upload(secure_name)
+                image_pipeline.submit(secure_name)
                 desc_mapping[file.filename] = secure_name
         
         # description ichidagi {original} ni {unique} ga almashtirish
@@ -711,8 +3875,13 @@ def admin_edit_product(product_id):
                 secure_name = secure_filename(unique_filename)
                 vpath = os.path.join(app.config['UPLOAD_FOLDER'], secure_name)
                 vfile.save(vpath)
+                register_upload(secure_name)
                 ordered_videos.append(secure_name)
         
+        # Bo'laklab yuklangan yangi videolar
+        for _, stored in claim_completed_uploads(request.form.get('video_upload_ids')):
+            ordered_videos.append(stored)
+        
         # O'chirilgan fayllarni diskdan o'chirish
         cur.execute("SELECT image, videos FROM products WHERE id=?", (product_id,))
         row = cur.fetchone()
@@ -728,6 +3897,7 @@ def admin_edit_product(product_id):
                     os.remove(fpath)
                 except Exception as e:
                     print(f"File delete error: {e}")
+            image_pipeline.remove(fname)
         
         cur.execute(
             '''UPDATE products
@@ -737,6 +3907,7 @@ def admin_edit_product(product_id):
         )
         conn.commit()
         conn.close()
+        notify_catalog_change(product_id)
         return redirect(url_for("admin_add_product", product_id=product_id))
     
     cur.execute("SELECT * FROM products WHERE id=?", (product_id,))
@@ -761,10 +3932,12 @@ def admin_delete_product(product_id):
                     os.remove(img_path)
                 except Exception as e:
                     print(f"Rasmni o'chirishda xato: {e}")
+            image_pipeline.remove(img_name)
         
         # Ma'lumotlar bazasidan o'chirish
         conn.execute('DELETE FROM products WHERE id = ?', (product_id,))
         conn.commit()
+        notify_catalog_change(product_id)
     
     conn.close()
     return redirect(url_for('admin_add_product'))
@@ -773,6 +3946,464 @@ def admin_delete_product(product_id):
 # CHATBOT - AI Chatbot Integration
 # ==============================================================================
 
+# --- LLM mijozi ---------------------------------------------------------------
+
+class FakeLLMClient:
+    """
+    Mistral mijozining oflayn o'rnini bosuvchi: chat.complete va chat.stream
+    bilan bir xil shakldagi javob qaytaradi (testlar va benchmark uchun)
+    """
+
+    def __init__(self, reply=None, token_delay=0.0):
+        self.reply = reply
+        self.token_delay = token_delay
+        self.calls = 0
+        self.chat = self
+
+    def _reply_for(self, messages):
+        if self.reply is not None:
+            return self.reply
+        # Promptdagi birinchi mahsulot qatorini qaytaramiz
+        prompt = messages[-1]['content']
+        match = re.search(r"- id: (\d+) \| nomi: ([^|]+)\|", prompt)
+        if match:
+            pid, name = match.group(1), match.group(2).strip()
+            return f"{name}. <button class='chat-btn' data-url='/product/{pid}'>Mahsulotni ko‘rish</button>"
+        return "Bunday mahsulot bizda yo‘q."
+
+    def complete(self, model=None, messages=(), **kwargs):
+        self.calls += 1
+        text = self._reply_for(messages)
+        time.sleep(self.token_delay * len(text.split()))
+        message = SimpleNamespace(content=text)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+    def stream(self, model=None, messages=(), **kwargs):
+        self.calls += 1
+        for piece in re.findall(r'\S+\s*', self._reply_for(messages)):
+            time.sleep(self.token_delay)
+            delta = SimpleNamespace(content=piece)
+            yield SimpleNamespace(data=SimpleNamespace(choices=[SimpleNamespace(delta=delta)]))
+
+
+_mistral_state = {'client': None, 'pid': None, 'lock': threading.Lock()}
+
+
+def get_mistral_client():
+    """Mistral mijozi birinchi chat so'rovida yaratiladi (mistralai importi og'ir)"""
+    with _mistral_state['lock']:
+        if _mistral_state['client'] is None or _mistral_state['pid'] != os.getpid():
+            from mistralai import Mistral
+            _mistral_state['client'] = Mistral(api_key=MISTRAL_API_KEY)
+            _mistral_state['pid'] = os.getpid()
+        return _mistral_state['client']
+
+
+def get_llm_client():
+    """Sozlamaga ko'ra LLM mijozini tanlash (app.config['LLM_CLIENT'] ustun)"""
+    override = app.config.get('LLM_CLIENT')
+    if override is not None:
+        return override
+    if app.config['LLM_BACKEND'] == 'fake':
+        app.config['LLM_CLIENT'] = FakeLLMClient(token_delay=app.config['FAKE_LLM_TOKEN_DELAY'])
+        return app.config['LLM_CLIENT']
+    return get_mistral_client()
+
+
+# --- Mahsulot qidiruv indeksi (BM25) ------------------------------------------
+
+app.config['CHAT_CONTEXT_TOP_K'] = int(os.getenv('CHAT_CONTEXT_TOP_K', 8))
+app.config['CHAT_DESCRIPTION_CHARS'] = int(os.getenv('CHAT_DESCRIPTION_CHARS', 300))
+
+_TOKEN_RE = re.compile(r"[^\W_]+(?:'[^\W_]+)*")
+TOKEN_STEM_LENGTH = 6  # qo'shimchalarni (-lar, -ni, -ов, -ами) kesish uchun prefiks uzunligi
+
+
+def tokenize(text):
+    """
+    Lotin va kirill (o'zbek/rus) matnini tokenlarga ajratish.
+    Har bir uzun so'z uchun prefiks-o'zak ham qo'shiladi, shunda
+    'telefonlar' va 'телефоны' kabi shakllar ham mos keladi.
+    """
+    text = (text or '').lower().translate(_APOSTROPHES).replace('ё', 'е')
+    tokens = []
+    for tok in _TOKEN_RE.findall(text):
+        tok = tok.replace("'", '')
+        tokens.append(tok)
+        if len(tok) > TOKEN_STEM_LENGTH:
+            tokens.append(tok[:TOKEN_STEM_LENGTH] + '*')
+    return tokens
+
+
+class ProductSearchIndex:
+    """
+    Mahsulot nomi va tavsifi bo'yicha xotiradagi BM25 indeksi.
+    Bir marta quriladi, admin o'zgarishlarida bitta hujjat yangilanadi;
+    katalog versiyasi oshganda faqat o'zgargan qatorlar (changed_products)
+    qayta indekslanadi, boshqa worker'da o'chirilganlar esa mahsulotlar soni
+    mos kelmaganda id'lar ro'yxati bilan solishtirib olib tashlanadi.
+    """
+
+    K1 = 1.5
+    B = 0.75
+    NAME_BOOST = 3  # nomdagi so'zlar tavsifdagidan muhimroq
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._postings = {}
+        self._doc_terms = {}
+        self._doc_len = {}
+        self._total_len = 0
+        self.version = None
+
+    def _terms(self, name, description):
+        terms = Counter()
+        for tok in tokenize(name):
+            terms[tok] += self.NAME_BOOST
+        # {rasm.jpg} joylashtirishlari qidiruvga kirmaydi
+        terms.update(tokenize(re.sub(r'\{[^}]+\}', ' ', description or '')))
+        return terms
+
+    def _remove_doc(self, product_id):
+        terms = self._doc_terms.pop(product_id, None)
+        if terms is None:
+            return
+        for term in terms:
+            posting = self._postings.get(term)
+            if posting is not None:
+                posting.pop(product_id, None)
+                if not posting:
+                    del self._postings[term]
+        self._total_len -= self._doc_len.pop(product_id, 0)
+
+    def _add_doc(self, product_id, name, description):
+        terms = self._terms(name, description)
+        self._doc_terms[product_id] = terms
+        for term, tf in terms.items():
+            self._postings.setdefault(term, {})[product_id] = tf
+        length = sum(terms.values())
+        self._doc_len[product_id] = length
+        self._total_len += length
+
+    def rebuild(self):
+        """Indeksni butun katalogdan qayta qurish"""
+        version = get_catalog_version()
+        conn = get_db_connection()
+        rows = conn.execute('SELECT id, name, description FROM products').fetchall()
+        conn.close()
+        with self._lock:
+            self._postings, self._doc_terms, self._doc_len, self._total_len = {}, {}, {}, 0
+            for r in rows:
+                self._add_doc(r['id'], r['name'], r['description'])
+            self.version = version
+
+    def update(self, product_id):
+        """Bitta mahsulotni qayta indekslash (o'chirilgan bo'lsa olib tashlash)"""
+        if self.version is None:
+            return  # hali qurilmagan — birinchi qidiruvda to'liq quriladi
+        conn = get_db_connection()
+        row = conn.execute('SELECT name, description FROM products WHERE id = ?', (product_id,)).fetchone()
+        conn.close()
+        with self._lock:
+            self._remove_doc(product_id)
+            if row is not None:
+                self._add_doc(product_id, row['name'], row['description'])
+
+    def _apply_changes(self, version):
+        """Oxirgi ko'rilgan versiyadan keyin o'zgargan hujjatlarni qayta indekslash"""
+        conn = get_db_connection()
+        rows = changed_products(conn, self.version, 'id, name, description')
+        with self._lock:
+            for r in rows:
+                self._remove_doc(r['id'])
+                self._add_doc(r['id'], r['name'], r['description'])
+            stale = len(self._doc_len) != count_products()
+        if stale:
+            live = {r[0] for r in conn.execute('SELECT id FROM products')}
+            with self._lock:
+                for product_id in [pid for pid in self._doc_len if pid not in live]:
+                    self._remove_doc(product_id)
+        conn.close()
+        with self._lock:
+            self.version = max(self.version, version)
+
+    def search(self, query, k):
+        """So'rovga eng mos k ta mahsulot id'si (BM25 bo'yicha kamayish tartibida)"""
+        version = get_catalog_version()
+        if self.version is None:
+            self.rebuild()
+        elif self.version != version:
+            self._apply_changes(version)
+        with self._lock:
+            n_docs = len(self._doc_len)
+            if not n_docs:
+                return []
+            avg_len = self._total_len / n_docs
+            scores = defaultdict(float)
+            for term in set(tokenize(query)):
+                posting = self._postings.get(term)
+                if not posting:
+                    continue
+                idf = math.log(1 + (n_docs - len(posting) + 0.5) / (len(posting) + 0.5))
+                for pid, tf in posting.items():
+                    norm = self.K1 * (1 - self.B + self.B * self._doc_len[pid] / avg_len)
+                    scores[pid] += idf * tf * (self.K1 + 1) / (tf + norm)
+        return heapq.nlargest(k, scores, key=scores.get)
+
+
+product_index = ProductSearchIndex()
+
+
+@on_catalog_change
+def _reindex_product(product_id):
+    product_index.update(product_id)
+
+
+def get_chat_products(message, k):
+    """Chat prompti uchun eng mos mahsulotlar (mos kelmasa — eng yangilari)"""
+    ids = product_index.search(message, k)
+    conn = get_db_connection()
+    if ids:
+        placeholders = ','.join('?' * len(ids))
+        rows = conn.execute(
+            f'SELECT id, name, price, description, stock FROM products WHERE id IN ({placeholders})', ids
+        ).fetchall()
+        order = {pid: i for i, pid in enumerate(ids)}
+        rows = sorted(rows, key=lambda r: order[r['id']])
+    else:
+        rows = conn.execute(
+            'SELECT id, name, price, description, stock FROM products ORDER BY id DESC LIMIT ?', (k,)
+        ).fetchall()
+    conn.close()
+    return rows
+
+
+# --- Suhbat xotirasi -----------------------------------------------------------
+
+app.config['CHAT_MEMORY_TURNS'] = int(os.getenv('CHAT_MEMORY_TURNS', 6))
+app.config['CHAT_SUMMARY_CHARS'] = int(os.getenv('CHAT_SUMMARY_CHARS', 600))
+CHAT_SUMMARY_ITEM_CHARS = 120  # xulosaga qo'shiladigan bitta xabar uzunligi
+CHAT_FOLD_BATCH = 8  # bitta so'rovda xulosaga qo'shiladigan eng ko'p xabar
+
+
+class ChatMemory:
+    """
+    Chegaralangan suhbat xotirasi: oxirgi N ta xabar (user_uuid, id)
+    indeksi orqali o'qiladi, oynadan chiqqan xabarlar esa foydalanuvchining
+    'chat_summary' qatoriga bosqichma-bosqich qo'shiladi. Har bir xabar uchun
+    xarajat suhbat uzunligiga bog'liq emas (eski tarix birinchi marta
+    CHAT_FOLD_BATCH bo'laklarda bir martagina qo'shiladi).
+    Xulosa write_queue orqali o'z ulanishida yoziladi — o'qish paytida
+    so'rovning umumiy ulanishida commit qilinmaydi.
+    """
+
+    @staticmethod
+    def _fold(summary, rows, limit):
+        """Xabarlarni xulosa oxiriga qo'shib, boshidan limitgacha qirqish"""
+        parts = [summary] if summary else []
+        for r in rows:
+            content = ' '.join(r['content'].split())[:CHAT_SUMMARY_ITEM_CHARS]
+            parts.append(f"{r['role'].capitalize()}: {content}")
+        text = ' | '.join(parts)
+        if len(text) > limit:
+            text = '…' + text[-limit:].split(' ', 1)[-1]
+        return text
+
+    def load(self, conn, user_uuid):
+        """(xulosa, oxirgi xabarlar) juftligini qaytarish"""
+        turns = app.config['CHAT_MEMORY_TURNS']
+        rows = conn.execute('''
+            SELECT id, role, content FROM chat_message
+            WHERE user_uuid=? ORDER BY id DESC LIMIT ?
+        ''', (user_uuid, turns)).fetchall()
+        recent = list(reversed(rows))
+        if not rows:
+            return '', recent
+
+        srow = conn.execute(
+            'SELECT summary, last_message_id FROM chat_summary WHERE user_uuid=?', (user_uuid,)
+        ).fetchone()
+        summary = srow['summary'] if srow else ''
+        last_id = srow['last_message_id'] if srow else 0
+
+        # Oynadan chiqqan, hali xulosaga kirmagan xabarlar — marker faqat haqiqatan
+        # qo'shilgan xabarlargacha suriladi, eski tarix bo'laklab to'liq qo'shiladi
+        boundary = min(r['id'] for r in rows)
+        folded = False
+        while True:
+            spilled = conn.execute('''
+                SELECT id, role, content FROM chat_message
+                WHERE user_uuid=? AND id > ? AND id < ? ORDER BY id LIMIT ?
+            ''', (user_uuid, last_id, boundary, CHAT_FOLD_BATCH)).fetchall()
+            if not spilled:
+                break
+            summary = self._fold(summary, spilled, app.config['CHAT_SUMMARY_CHARS'])
+            last_id = spilled[-1]['id']
+            folded = True
+            if len(spilled) < CHAT_FOLD_BATCH:
+                break
+        if folded:
+            self._save_summary(user_uuid, summary, last_id)
+        return summary, recent
+
+    @staticmethod
+    def _save_summary(user_uuid, summary, last_id):
+        """
+        Xulosani yozuvchi oqimga topshirish (kutilmaydi). Xulosa hosila
+        ma'lumot: commit'dan oldingi load() xuddi shu qatorlarni xuddi shu
+        natija bilan qayta qo'shadi, marker esa hech qachon orqaga qaytmaydi.
+        """
+        def job(conn):
+            conn.execute('''
+                INSERT INTO chat_summary (user_uuid, summary, last_message_id, updated_at)
+                VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(user_uuid) DO UPDATE SET
+                    summary=excluded.summary,
+                    last_message_id=excluded.last_message_id,
+                    updated_at=excluded.updated_at
+                WHERE excluded.last_message_id > chat_summary.last_message_id
+            ''', (user_uuid, summary, last_id))
+
+        write_queue.submit(job)
+
+
+chat_memory = ChatMemory()
+
+
+# --- Javoblar keshi ------------------------------------------------------------
+
+app.config['LLM_CACHE_SIZE'] = int(os.getenv('LLM_CACHE_SIZE', 1024))
+app.config['LLM_CACHE_TTL'] = int(os.getenv('LLM_CACHE_TTL', 3600))
+app.config['LLM_CACHE_PERSIST'] = os.getenv('LLM_CACHE_PERSIST', '0') == '1'
+
+
+def normalize_chat_message(text):
+    """Keshlash uchun xabarni normallashtirish: kichik harf, tinish belgilarisiz"""
+    return ' '.join(t for t in tokenize(text) if not t.endswith('*'))
+
+
+class ChatAnswerCache:
+    """
+    Takroriy savollar uchun LLM javoblari keshi (LRU + TTL).
+    Kalit: normallashtirilgan xabar + mos mahsulotlarning (id, narx, zaxira)
+    izi, shuning uchun narx yoki zaxira o'zgarsa eski javob ishlatilmaydi.
+    Suhbat tarixi bo'lsa (xulosa yoki oxirgi xabarlar), uning xeshi ham
+    kalitga kiradi — kontekstga bog'liq savolga boshqa suhbat javobi berilmaydi.
+    Ixtiyoriy SQLite qatlami worker qayta ishga tushganda ham saqlanadi.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._by_product = defaultdict(set)
+        self.stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'stores': 0, 'invalidations': 0}
+
+    @staticmethod
+    def make_key(message, product_rows, memory=('', ())):
+        fingerprint = ','.join(
+            f"{r['id']}:{r['price']}:{r['stock']}" for r in sorted(product_rows, key=lambda r: r['id'])
+        )
+        summary, turns = memory
+        context = ''
+        if summary or turns:
+            history = '\n'.join([summary] + [f"{m['role']}:{m['content']}" for m in turns])
+            context = hashlib.sha1(history.encode()).hexdigest()
+        raw = f"{model}|{normalize_chat_message(message)}|{fingerprint}|{context}"
+        return hashlib.sha1(raw.encode()).hexdigest()
+
+    def _store_memory(self, key, answer, product_ids, created_at):
+        self._entries[key] = (answer, product_ids, created_at)
+        self._entries.move_to_end(key)
+        for pid in product_ids:
+            self._by_product[pid].add(key)
+        while len(self._entries) > app.config['LLM_CACHE_SIZE']:
+            old_key, (_, old_ids, _) = self._entries.popitem(last=False)
+            for pid in old_ids:
+                self._by_product[pid].discard(old_key)
+
+    def get(self, key):
+        """Keshdagi javob yoki None"""
+        ttl = app.config['LLM_CACHE_TTL']
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[2] <= ttl:
+                self._entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return entry[0]
+            if entry is not None:
+                del self._entries[key]
+
+        if app.config['LLM_CACHE_PERSIST']:
+            conn = get_db_connection()
+            row = conn.execute(
+                'SELECT answer, product_ids, created_at FROM llm_answer_cache WHERE cache_key = ?', (key,)
+            ).fetchone()
+            conn.close()
+            if row is not None and now - row['created_at'] <= ttl:
+                ids = tuple(int(x) for x in row['product_ids'].split(',') if x)
+                with self._lock:
+                    self._store_memory(key, row['answer'], ids, row['created_at'])
+                    self.stats['disk_hits'] += 1
+                return row['answer']
+
+        with self._lock:
+            self.stats['misses'] += 1
+        return None
+
+    def put(self, key, answer, product_ids):
+        """Javobni keshga yozish"""
+        product_ids = tuple(product_ids)
+        now = time.time()
+        with self._lock:
+            self._store_memory(key, answer, product_ids, now)
+            self.stats['stores'] += 1
+        if app.config['LLM_CACHE_PERSIST']:
+            conn = get_db_connection()
+            conn.execute(
+                'INSERT OR REPLACE INTO llm_answer_cache (cache_key, answer, product_ids, created_at) VALUES (?, ?, ?, ?)',
+                (key, answer, ','.join(map(str, product_ids)), now)
+            )
+            conn.commit()
+            conn.close()
+
+    def invalidate_product(self, product_id):
+        """Shu mahsulotga tegishli barcha javoblarni o'chirish"""
+        with self._lock:
+            keys = self._by_product.pop(product_id, set())
+            for key in keys:
+                self._entries.pop(key, None)
+            self.stats['invalidations'] += len(keys)
+        if app.config['LLM_CACHE_PERSIST']:
+            conn = get_db_connection()
+            conn.execute(
+                "DELETE FROM llm_answer_cache WHERE ',' || product_ids || ',' LIKE ?", (f'%,{product_id},%',)
+            )
+            conn.commit()
+            conn.close()
+
+    def snapshot(self):
+        """Hisoblagichlar va hajm"""
+        with self._lock:
+            lookups = self.stats['hits'] + self.stats['disk_hits'] + self.stats['misses']
+            hit_ratio = (self.stats['hits'] + self.stats['disk_hits']) / lookups if lookups else 0.0
+            return dict(self.stats, size=len(self._entries), hit_ratio=round(hit_ratio, 4))
+
+
+answer_cache = ChatAnswerCache()
+
+
+@on_catalog_change
+def _invalidate_answers(product_id):
+    answer_cache.invalidate_product(product_id)
+
+
+def short_description(text, limit):
+    """Tavsifni prompt uchun qisqartirish ({rasm} va qator bo'linishlarisiz)"""
+    text = ' '.join(re.sub(r'\{[^}]+\}', ' ', text or '').split())
+    return text if len(text) <= limit else text[:limit].rsplit(' ', 1)[0] + '…'
+
+
 @app.route('/chat')
 def chat_ui():
     # Foydalanuvchi uchun yagona sessiya UUID yaratish
@@ -783,54 +4414,20 @@ def chat_ui():
     return render_template('chat.html')
 
 
-@app.route('/chat', methods=['POST'])
-def chat():
-    data = request.get_json()
-    user_message = data.get("message", "").strip()
-
-    # Sessiyadagi ma'lumotlarni olish
-    user_uuid = session.get("user_uuid", str(uuid4()))
-    user_name = session.get("user_name", "Anonim")
-
-    if not user_message:
-        return jsonify({"reply": "❗ Xabar bo'sh bo'lishi mumkin emas.", "user_uuid": user_uuid})
-
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # === Mahsulotlar ro'yxatini olish ===
-    cursor.execute("SELECT id, name, price, description, stock FROM products")
-    product_rows = cursor.fetchall()
-
-    # Barcha mahsulotlarni JSON ko‘rinishda saqlaymiz
-    products_info = []
-    for r in product_rows:
-        products_info.append({
-            "name": r["name"],
-            "price": r["price"],
-            "description": r["description"],
-            "stock": r["stock"]
-        })
+def build_chat_messages(user_message, product_rows, memory):
+    """Mos mahsulotlar va suhbat xotirasi (chat_memory.load) asosida LLM xabarlarini tayyorlash"""
+    desc_chars = app.config['CHAT_DESCRIPTION_CHARS']
 
     # Model uchun soddalashtirilgan matn
     products_context = "\n".join([
-        f"- id: {r['id']} | nomi: {r['name']} | narxi: {r['price']} so'm | tavsif: {r['description']} | mavjud: {r['stock']} dona"
+        f"- id: {r['id']} | nomi: {r['name']} | narxi: {r['price']} so'm | tavsif: {short_description(r['description'], desc_chars)} | mavjud: {r['stock']} dona"
         for r in product_rows
     ])
 
-    # === Avvalgi xabarlar ===
-    cursor.execute("""
-        SELECT role, content FROM chat_message 
-        WHERE user_uuid=? ORDER BY created_at ASC
-    """, (user_uuid,))
-    memory_rows = cursor.fetchall()
-
-    # === Xotirani qisqartirish ===
-    if len(memory_rows) > 6:
-        summary_text = "Avvalgi suhbat xulosasi: "
-        summary_text += " ".join([m["content"] for m in memory_rows[-6:]])[:400]
-    else:
-        summary_text = "".join([f"{m['role'].capitalize()}: {m['content']}\n" for m in memory_rows])
+    # === Avvalgi xabarlar (xulosa + oxirgi N ta xabar) ===
+    memory_summary, memory_rows = memory
+    summary_text = f"Avvalgi suhbat xulosasi: {memory_summary}\n" if memory_summary else ""
+    summary_text += "".join([f"{m['role'].capitalize()}: {m['content']}\n" for m in memory_rows])
 
     # === AI uchun PROMPT ===
     prompt = f"""
@@ -861,49 +4458,168 @@ def chat():
     {user_message}
     """
 
-    # === AI javobini olish ===
-    try:
-        response = client.chat.complete(
-            model=model,
-            messages=[
-                {"role": "system", "content": (
-                "Siz DonoAI nomli aqlli do‘kon operatorisiz. "
-                "Siz foydalanuvchi qaysi tilda so‘rasa — o‘sha tilda (o‘zbek yoki ruscha) javob bering. "
-                "Agar mahsulot bazada mavjud bo‘lsa, uning nomi, narxi va tavsifini qisqa ayting. "
-                "Agar foydalanuvchi mahsulotni ko'rsatishni so'rasa, so‘ngra HTML tugma sifatida link qo‘shing: "
-                "<button class='chat-btn' data-url='/product/9'>Mahsulotni ko‘rish</button>. "
-                "Faqat mavjud mahsulotlarga shunday tugma yarating."
-            )},
-                {"role": "user", "content": prompt},
-            ],
-            temperature=0.4,
-            max_tokens=512
-        )
-        reply = response.choices[0].message.content.strip()
-    except Exception as e:
-        reply = f"⚠️ Xatolik yuz berdi: {e}"
+    return [
+        {"role": "system", "content": (
+            "Siz DonoAI nomli aqlli do‘kon operatorisiz. "
+            "Siz foydalanuvchi qaysi tilda so‘rasa — o‘sha tilda (o‘zbek yoki ruscha) javob bering. "
+            "Agar mahsulot bazada mavjud bo‘lsa, uning nomi, narxi va tavsifini qisqa ayting. "
+            "Agar foydalanuvchi mahsulotni ko'rsatishni so'rasa, so‘ngra HTML tugma sifatida link qo‘shing: "
+            "<button class='chat-btn' data-url='/product/9'>Mahsulotni ko‘rish</button>. "
+            "Faqat mavjud mahsulotlarga shunday tugma yarating."
+        )},
+        {"role": "user", "content": prompt},
+    ]
 
-    # === Chatni bazaga yozish ===
-    cursor.execute("""
-        INSERT INTO chat_message (user_uuid, user_name, role, content) 
-        VALUES (?, ?, ?, ?)
-    """, (user_uuid, user_name, "user", user_message))
-    cursor.execute("""
-        INSERT INTO chat_message (user_uuid, user_name, role, content) 
-        VALUES (?, ?, ?, ?)
-    """, (user_uuid, user_name, "assistant", reply))
 
+def save_chat_exchange(user_uuid, user_name, user_message, reply):
+    """
+    Foydalanuvchi xabari va javobni bazaga yozish. WRITE_BEHIND yoqilgan
+    bo'lsa kutilmaydi: yozuvchi oqim ularni boshqa yozuvlar bilan guruhlaydi.
+    """
+    rows = [(user_uuid, user_name, "user", user_message),
+            (user_uuid, user_name, "assistant", reply)]
+
+    def job(conn):
+        conn.executemany(
+            "INSERT INTO chat_message (user_uuid, user_name, role, content) VALUES (?, ?, ?, ?)", rows
+        )
+
+    if app.config['WRITE_BEHIND']:
+        write_queue.submit(job)
+        return
+    conn = get_db_connection()
+    job(conn)
     conn.commit()
     conn.close()
 
+
+@app.route('/chat', methods=['POST'])
+def chat():
+    data = request.get_json()
+    user_message = data.get("message", "").strip()
+
+    # Sessiyadagi ma'lumotlarni olish
+    user_uuid = session.get("user_uuid", str(uuid4()))
+    user_name = session.get("user_name", "Anonim")
+
+    if not user_message:
+        return jsonify({"reply": "❗ Xabar bo'sh bo'lishi mumkin emas.", "user_uuid": user_uuid})
+
+    conn = get_db_connection()
+    product_rows = get_chat_products(user_message, app.config['CHAT_CONTEXT_TOP_K'])
+    memory = chat_memory.load(conn, user_uuid)
+    cache_key = answer_cache.make_key(user_message, product_rows, memory)
+    reply = answer_cache.get(cache_key)
+
+    # === AI javobini olish (keshda bo'lmasa) ===
+    if reply is None:
+        messages = build_chat_messages(user_message, product_rows, memory)
+        try:
+            with external_call('mistral'):
+                response = get_llm_client().chat.complete(
+                    model=model,
+                    messages=messages,
+                    temperature=0.4,
+                    max_tokens=512
+                )
+            reply = response.choices[0].message.content.strip()
+            answer_cache.put(cache_key, reply, [r['id'] for r in product_rows])
+        except Exception as e:
+            reply = f"⚠️ Xatolik yuz berdi: {e}"
+
+    # === Chatni bazaga yozish ===
+    save_chat_exchange(user_uuid, user_name, user_message, reply)
+    conn.close()
+
     return jsonify({"reply": reply, "user_uuid": user_uuid})
 
 
+@app.route('/api/chat/cache-stats')
+def api_chat_cache_stats():
+    """API: Chat javoblari keshi hisoblagichlari"""
+    return jsonify(answer_cache.snapshot())
+
+
+def sse_event(data, event=None):
+    """Server-Sent Events formatidagi bitta hodisa"""
+    head = f"event: {event}\n" if event else ""
+    return f"{head}data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    """Chat javobini token-token SSE orqali yuborish"""
+    data = request.get_json() or {}
+    user_message = data.get("message", "").strip()
+
+    user_uuid = session.get("user_uuid", str(uuid4()))
+    user_name = session.get("user_name", "Anonim")
+
+    if not user_message:
+        body = sse_event({"reply": "❗ Xabar bo'sh bo'lishi mumkin emas.", "user_uuid": user_uuid}, "done")
+        return Response(body, mimetype='text/event-stream')
+
+    conn = get_db_connection()
+    product_rows = get_chat_products(user_message, app.config['CHAT_CONTEXT_TOP_K'])
+    memory = chat_memory.load(conn, user_uuid)
+    cache_key = answer_cache.make_key(user_message, product_rows, memory)
+    cached_reply = answer_cache.get(cache_key)
+    messages = None if cached_reply is not None else build_chat_messages(user_message, product_rows, memory)
+    conn.close()
+
+    def generate():
+        started = time.perf_counter()
+        ttft_ms = None
+        parts = []
+        if cached_reply is not None:
+            # Keshdan: butun javob bitta delta sifatida
+            save_chat_exchange(user_uuid, user_name, user_message, cached_reply)
+            yield sse_event({"delta": cached_reply})
+            ttft_ms = round((time.perf_counter() - started) * 1000, 1)
+            yield sse_event({"reply": cached_reply, "user_uuid": user_uuid, "ttft_ms": ttft_ms, "cached": True}, "done")
+            return
+        reply = None
+        stream = external_stream('mistral_stream', lambda: get_llm_client().chat.stream(
+            model=model,
+            messages=messages,
+            temperature=0.4,
+            max_tokens=512
+        ))
+        try:
+            try:
+                for chunk in stream:
+                    delta = chunk.data.choices[0].delta.content
+                    if not delta:
+                        continue
+                    if ttft_ms is None:
+                        ttft_ms = round((time.perf_counter() - started) * 1000, 1)
+                    parts.append(delta)
+                    yield sse_event({"delta": delta})
+                reply = "".join(parts).strip()
+                answer_cache.put(cache_key, reply, [r['id'] for r in product_rows])
+            except Exception as e:
+                reply = f"⚠️ Xatolik yuz berdi: {e}"
+                yield sse_event({"error": reply}, "error")
+        finally:
+            stream.close()  # uzilishda yuqori oqim vaqti shu yerda, so'rov ichida yoziladi
+            # Mijoz oqim o'rtasida uzilsa ham (GeneratorExit) xabar va qisman javob saqlanadi
+            save_chat_exchange(user_uuid, user_name, user_message,
+                               reply if reply is not None else "".join(parts).strip())
+        yield sse_event({"reply": reply, "user_uuid": user_uuid, "ttft_ms": ttft_ms}, "done")
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
 # ==============================================================================
 # API ENDPOINTS - Mobile/Web API
 # ==============================================================================
 
 @app.route('/api/products')
+@catalog_conditional(lambda: (request.host_url,))
 def api_products():
     """API: Mahsulotlar ro'yxati"""
     base_url = request.host_url.rstrip('/')
@@ -916,28 +4632,43 @@ def api_products():
     except ValueError:
         offset, limit = 0, 24
     
+    # Kursor berilgan bo'lsa WHERE id < ? ishlatiladi, aks holda eski offset rejimi
+    after_id = get_page_cursor(request.args)
+    total_count = count_products()
     conn = get_db_connection()
     cur = conn.cursor()
-    cur.execute("SELECT * FROM products ORDER BY id DESC LIMIT ? OFFSET ?", (limit, offset))
+    if after_id is not None:
+        cur.execute("SELECT * FROM products WHERE id < ? ORDER BY id DESC LIMIT ?", (after_id, limit + 1))
+    else:
+        cur.execute("SELECT * FROM products ORDER BY id DESC LIMIT ? OFFSET ?", (limit + 1, offset))
     products = cur.fetchall()
-    cur.execute("SELECT COUNT(*) FROM products")
-    total_count = cur.fetchone()[0]
     conn.close()
     
+    has_more = len(products) > limit
+    products = products[:limit]
+    next_cursor = encode_cursor(products[-1]['id']) if has_more and products else None
+    
     product_list = []
     for p in products:
         p_dict = dict(p)
         filenames = [x.strip() for x in p_dict['image'].split(',') if x.strip()]
         p_dict['images'] = [f"{base_url}/static/images/{name}" for name in filenames]
+        # Kartalar uchun kichik variant va srcset
+        first = filenames[0] if filenames else ''
+        p_dict['thumbnail'] = base_url + image_url(first, 320, 'webp') if first else None
+        p_dict['srcset'] = ', '.join(
+            f"{base_url}{part}" for part in image_srcset(first).split(', ') if part
+        )
         del p_dict['image']
         product_list.append(p_dict)
     
     return jsonify({
         'items': product_list,
-        'offset': offset,
+        'offset': offset if after_id is None else None,
         'limit': limit,
         'total': total_count,
-        'has_more': offset + limit < total_count
+        'has_more': has_more,
+        'next_cursor': next_cursor
     })
 
 
@@ -954,21 +4685,7 @@ def api_add_to_cart(product_id):
 @app.route('/api/cart')
 def api_cart():
     """API: Savat ma'lumotlari"""
-    cart = normalize_cart(session.get('cart', {}))
-    conn = get_db_connection()
-    products = []
-    total = 0
-    
-    for pid, qty in cart.items():
-        product = conn.execute("SELECT * FROM products WHERE id = ?", (int(pid),)).fetchone()
-        if product:
-            p = dict(product)
-            p['quantity'] = qty
-            p['total_price'] = p['price'] * qty
-            total += p['total_price']
-            products.append(p)
-    
-    conn.close()
+    products, total = hydrate_cart(session.get('cart', {}))
     return jsonify({'products': products, 'total': total})
 
 
@@ -976,29 +4693,15 @@ def api_cart():
 def api_checkout():
     """API: Buyurtmani rasmiylashtirish"""
     data = request.json
-    cart = normalize_cart(session.get('cart', {}))
-    conn = get_db_connection()
-    products, total = [], 0
-    
-    for pid, qty in cart.items():
-        product = conn.execute("SELECT * FROM products WHERE id = ?", (int(pid),)).fetchone()
-        if product:
-            p = dict(product)
-            p['quantity'] = qty
-            p['total_price'] = p['price'] * qty
-            total += p['total_price']
-            products.append(p)
-    
-    c = conn.cursor()
-    product_list = ", ".join([f"(#{p['id']} {p['name']} x {p['quantity']})" for p in products])
-    c.execute(
-        "INSERT INTO orders (name, phone, address, location, products, total_price) VALUES (?, ?, ?, ?, ?, ?)",
-        (data['name'], data['phone'], data['address'], data.get('location', ''), product_list, total)
-    )
-    order_id = c.lastrowid
-    conn.commit()
-    conn.close()
-    
+    try:
+        order_id = place_order(data, session.get('cart', {}))
+    except OutOfStock as e:
+        return jsonify({'success': False, 'error': str(e), 'shortfalls': e.shortfalls}), 409
+    except OrderPending as e:
+        return jsonify({'success': False, 'pending': True, 'error': str(e)}), 202
+    except CheckoutError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
     session['cart'] = {}
     return jsonify({'success': True, 'order_id': order_id})
 
@@ -1013,12 +4716,12 @@ def api_reverse():
         return jsonify({'error': 'Koordinata topilmadi'}), 400
     
     try:
-        url = f"https://nominatim.openstreetmap.org/reverse?format=json&lat={lat}&lon={lon}&zoom=18&addressdetails=1"
-        headers = {"User-Agent": "webshop/1.0"}
-        r = requests.get(url, headers=headers, timeout=10)
-        data = r.json()
-        address = data.get("display_name", "Manzil topilmadi")
+        address = geocoder.lookup(lat, lon)
         return jsonify({'address': address})
+    except ValueError:
+        return jsonify({'error': 'Koordinata noto\'g\'ri'}), 400
+    except GeocodeTimeout as e:
+        return jsonify({'error': str(e)}), 504
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -1048,6 +4751,43 @@ def first_image_filter(image_string):
 # ILOVANI ISHGA TUSHIRISH
 # ==============================================================================
 
+def create_app(config=None, preload=None):
+    """
+    WSGI ilova fabrikasi (gunicorn: 'app:create_app()'). config — sozlamalar
+    ustidan yoziladigan qiymatlar (test va vositalar uchun); ular kengaytmalar
+    (CORS, sessiya interfeysi) o'rnatilishidan va migratsiyalardan oldin
+    qo'llanadi. Marshrutlar, hook'lar va jarayon keshlari modul darajasidagi
+    yagona 'app'ga bog'langan, shuning uchun fabrika har safar o'sha
+    ilovani qaytaradi; kengaytmalar faqat birinchi chaqiruvda o'rnatiladi.
+
+    Og'ir quyi tizimlar
+    (Mistral, PDF/shriftlar/QR, HTTP sessiya) odatda birinchi ishlatilganda
+    yuklanadi. preload=True (yoki APP_PRELOAD=1) bo'lsa kod va shriftlar shu
+    yerda yuklanadi — gunicorn --preload bilan master jarayonda bir marta,
+    worker'larga copy-on-write bo'lib o'tadi. Tarmoq mijozlari va baza
+    ulanishlari fork'dan keyin har bir worker'da alohida ochiladi.
+    Sxema migratsiyalari shu yerda bajariladi (fabrikasiz import qilinganda —
+    jarayondagi birinchi baza ulanishida).
+    """
+    if config:
+        app.config.update(config)
+    if 'webshop' not in app.extensions:
+        CORS(app)  # CORS - boshqa domenlardan so'rovlarga ruxsat
+        app.session_interface = make_session_interface()
+        app.extensions['webshop'] = True
+    run_migrations()
+    if preload is None:
+        preload = os.getenv('APP_PRELOAD', '0') == '1'
+    if preload:
+        pdf_stack()
+        if app.config['LLM_BACKEND'] != 'fake':
+            import mistralai  # faqat modul kodi; mijoz worker'da yaratiladi
+        import requests
+        from PIL import Image
+    return app
+
+
 if __name__ == '__main__':
+    create_app()
     app.run(debug=True, host='0.0.0.0', port=5000)
 
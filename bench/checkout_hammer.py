@@ -0,0 +1,125 @@
+"""
+Checkout bosim testi: ko'p oqim bir vaqtda cheklangan zaxiradagi mahsulotni
+sotib oladi. Ortiqcha sotuv yo'qligi tekshiriladi, buyurtma/soniya va
+kechikish (p50/p99) o'lchanadi. --direct write-behind navbatini o'chiradi
+(har bir buyurtma o'z commit'i bilan) — ikki rejimni solishtirish uchun.
+
+Baza nusxasi vaqtinchalik papkada ishlatiladi, asl database/shop.db o'zgarmaydi.
+
+    python bench/checkout_hammer.py --threads 16 --attempts 2000 --stock 500
+    python bench/checkout_hammer.py --threads 16 --attempts 2000 --stock 500 --direct
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+from common import ROOT, load_app as load_app_with_db, percentile
+
+
+def load_app(tmp_dir):
+    """Ilovani bazaning vaqtinchalik nusxasi bilan yuklash"""
+    db_path = os.path.join(tmp_dir, 'shop.db')
+    shutil.copy(os.path.join(ROOT, 'database', 'shop.db'), db_path)
+    return load_app_with_db(tmp_dir, db_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--attempts', type=int, default=2000, help="jami checkout urinishlari")
+    parser.add_argument('--stock', type=int, default=500, help="issiq mahsulot zaxirasi")
+    parser.add_argument('--max-qty', type=int, default=3, help="bitta buyurtmadagi eng ko'p dona")
+    parser.add_argument('--direct', action='store_true', help="write-behind navbatisiz")
+    args = parser.parse_args()
+    os.environ['WRITE_BEHIND'] = '0' if args.direct else '1'
+
+    tmp_dir = tempfile.mkdtemp(prefix='checkout-hammer-')
+    webshop = load_app(tmp_dir)
+    app = webshop.app
+
+    conn = webshop.get_db_connection()
+    cur = conn.execute(
+        "INSERT INTO products (name, price, image, description, stock) VALUES (?, ?, '', '', ?)",
+        ('Flash sale', 1000, args.stock)
+    )
+    hot_id = cur.lastrowid
+    conn.commit()
+    conn.close()
+
+    customer = {'name': 'Bench', 'phone': '+998000000000', 'address': 'Toshkent'}
+    remaining = iter(range(args.attempts))
+    remaining_lock = threading.Lock()
+    results = Counter()
+    latencies = []
+    results_lock = threading.Lock()
+    start = threading.Barrier(args.threads + 1)
+
+    def worker():
+        local = Counter()
+        local_latencies = []
+        rng = random.Random()
+        with app.app_context():
+            start.wait()
+            while True:
+                with remaining_lock:
+                    if next(remaining, None) is None:
+                        break
+                cart = {str(hot_id): rng.randint(1, args.max_qty)}
+                t = time.perf_counter()
+                try:
+                    webshop.place_order(customer, cart)
+                    local['ok'] += 1
+                    local_latencies.append(time.perf_counter() - t)
+                except webshop.OutOfStock:
+                    local['out_of_stock'] += 1
+                except Exception as e:
+                    local[f'error:{type(e).__name__}'] += 1
+        webshop.close_db_connection()
+        with results_lock:
+            results.update(local)
+            latencies.extend(local_latencies)
+
+    threads = [threading.Thread(target=worker) for _ in range(args.threads)]
+    for t in threads:
+        t.start()
+    start.wait()
+    t0 = time.perf_counter()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - t0
+
+    webshop.write_queue.close()
+    conn = webshop.get_db_connection()
+    final_stock = conn.execute('SELECT stock FROM products WHERE id = ?', (hot_id,)).fetchone()[0]
+    sold = conn.execute(
+        'SELECT COALESCE(SUM(quantity), 0) FROM order_items WHERE product_id = ?', (hot_id,)
+    ).fetchone()[0]
+    conn.close()
+
+    mode = 'direct' if args.direct else 'write-behind'
+    print(f"rejim: {mode}, oqimlar: {args.threads}, urinishlar: {args.attempts}, vaqt: {elapsed:.2f} s")
+    for key, value in sorted(results.items()):
+        print(f"  {key}: {value}")
+    print(f"buyurtma/soniya: {results['ok'] / elapsed:.1f}")
+    latencies.sort()
+    print(f"kechikish: p50 {percentile(latencies, 0.5) * 1000:.2f} ms, p99 {percentile(latencies, 0.99) * 1000:.2f} ms")
+    if not args.direct:
+        stats = webshop.write_queue.stats
+        print(f"commit'lar: {stats['batches']}, o'rtacha guruh: {stats['jobs'] / max(stats['batches'], 1):.1f}")
+    print(f"zaxira: {args.stock} -> {final_stock}, sotilgan: {sold}")
+
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    if final_stock < 0 or sold != args.stock - final_stock:
+        print("XATO: ortiqcha sotuv aniqlandi")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
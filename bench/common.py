@@ -0,0 +1,90 @@
+"""
+Benchmark skriptlari uchun umumiy yordamchilar: ilovani vaqtinchalik baza
+bilan yuklash, kechikish statistikasi va xotira o'lchovi.
+"""
+import os
+import resource
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def app_env(tmp_dir, db_path, **extra):
+    """Ilova uchun muhit o'zgaruvchilari: hamma narsa tmp_dir ichida, tarmoqsiz"""
+    env = {
+        'DATABASE_PATH': db_path,
+        'DATABASE_KEY': 'bench',
+        'SESSION_DB_PATH': os.path.join(tmp_dir, 'sessions.db'),
+        'RECEIPT_CACHE_DIR': os.path.join(tmp_dir, 'receipts'),
+        'UPLOAD_TMP_DIR': os.path.join(tmp_dir, 'uploads'),
+        'LLM_BACKEND': 'fake',
+        'FAKE_LLM_TOKEN_DELAY': '0',
+        'GEOCODE_MIN_INTERVAL': '0',
+    }
+    env.update({k: str(v) for k, v in extra.items()})
+    return env
+
+
+def load_app(tmp_dir, db_path, **extra):
+    """Ilovani (app.py) berilgan baza bilan import qilib, create_app() orqali sozlash"""
+    os.environ.update(app_env(tmp_dir, db_path, **extra))
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    import app as webshop
+    webshop.create_app()
+    return webshop
+
+
+def percentile(sorted_values, q):
+    """Saralangan ro'yxatdan q-kvantil (0..1)"""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def summarize(latencies, errors, elapsed):
+    """Soniyalardagi kechikishlardan hisobot (ms va so'rov/soniya)"""
+    latencies = sorted(latencies)
+    count = len(latencies)
+    return {
+        'requests': count,
+        'errors': errors,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'mean_ms': round(sum(latencies) / count * 1000, 3) if count else 0.0,
+        'rps': round(count / elapsed, 1) if elapsed > 0 else 0.0,
+    }
+
+
+def peak_rss_mb():
+    """Joriy jarayonning eng yuqori RSS'i (MB)"""
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def process_peak_rss_mb(pid):
+    """/proc orqali boshqa jarayonning eng yuqori RSS'i (VmHWM, MB)"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return 0.0
+
+
+def child_pids(pid):
+    """Berilgan jarayonning bevosita bolalari (Linux /proc)"""
+    children = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == pid:
+            children.append(int(entry))
+    return children
@@ -0,0 +1,56 @@
+"""
+Ikki benchmark natijasini (bench/run.py --out) solishtirish: har bir
+(hajm, rejim, marshrut) uchun p50/p99 va so'rov/soniya o'zgarishi foizda.
+
+    python bench/compare.py before.json after.json
+"""
+import argparse
+import json
+import sys
+
+
+def index_runs(report):
+    rows = {}
+    for run in report['runs']:
+        rows[(run['size'], run['mode'], '(rss)')] = {'peak_rss_mb': run.get('peak_rss_mb', 0.0)}
+        for route, stats in run['routes'].items():
+            rows[(run['size'], run['mode'], route)] = stats
+    return rows
+
+
+def change(old, new):
+    if not old:
+        return '   n/a'
+    return f"{(new - old) / old * 100:+6.1f}%"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ikki benchmark natijasini solishtirish")
+    parser.add_argument('before')
+    parser.add_argument('after')
+    args = parser.parse_args()
+    with open(args.before) as f:
+        before = index_runs(json.load(f))
+    with open(args.after) as f:
+        after = index_runs(json.load(f))
+
+    print(f"{'hajm':>7} {'rejim':<7}{'marshrut':<18}{'p50 ms':>18}{'p99 ms':>18}{'rps':>18}")
+    for key in sorted(before.keys() & after.keys(), key=lambda k: (k[0], k[1], k[2])):
+        old, new = before[key], after[key]
+        size, mode, route = key
+        if route == '(rss)':
+            print(f"{size:>7} {mode:<7}{'peak RSS MB':<18}"
+                  f"{old['peak_rss_mb']:>8} -> {new['peak_rss_mb']:<8}{change(old['peak_rss_mb'], new['peak_rss_mb'])}")
+            continue
+        cells = []
+        for metric in ('p50_ms', 'p99_ms', 'rps'):
+            cells.append(f"{new[metric]:>10} {change(old[metric], new[metric])}")
+        errors = f"  xato: {old['errors']} -> {new['errors']}" if old['errors'] or new['errors'] else ''
+        print(f"{size:>7} {mode:<7}{route:<18}" + ''.join(cells) + errors)
+    missing = before.keys() ^ after.keys()
+    if missing:
+        print(f"\nFaqat bittasida bor: {len(missing)} ta qator", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""
+Tashqi xizmatlarning lokal o'rinbosarlari. Mistral uchun ilovaning o'zidagi
+FakeLLMClient (LLM_BACKEND=fake) ishlatiladi; Nominatim uchun esa kichik HTTP server.
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class FakeNominatim:
+    """/reverse so'rovlariga Nominatim formatidagi JSON qaytaruvchi server"""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.calls = 0
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                fake.calls += 1
+                if fake.delay:
+                    time.sleep(fake.delay)
+                query = parse_qs(urlparse(self.path).query)
+                lat, lon = query.get('lat', ['0'])[0], query.get('lon', ['0'])[0]
+                body = json.dumps({'display_name': f"Benchmark ko'chasi, {lat}, {lon}, Toshkent"}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/reverse"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
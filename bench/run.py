@@ -0,0 +1,314 @@
+"""
+Oflayn benchmark to'plami. Har bir katalog hajmi uchun sintetik baza
+yaratiladi va asosiy marshrutlar ikki usulda o'lchanadi:
+
+  client — Flask test client orqali, bitta oqimda (mikro-benchmark);
+  http   — lokal gunicorn (bir nechta worker) ustida parallel HTTP yuklama.
+
+Mistral o'rniga FakeLLMClient (LLM_BACKEND=fake), Nominatim o'rniga lokal
+FakeNominatim ishlatiladi — tarmoq kerak emas. Natija JSON (p50/p95/p99,
+so'rov/soniya, eng yuqori RSS); ikki natijani bench/compare.py solishtiradi.
+
+    python bench/run.py --sizes 1000,10000,100000 --out before.json
+    python bench/run.py --sizes 1000 --modes client --routes product,chat
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import requests
+
+from common import ROOT, app_env, child_pids, load_app, peak_rss_mb, process_peak_rss_mb, summarize
+from fakes import FakeNominatim
+from synthetic import CHAT_QUESTIONS, generate
+
+# products_list faqat templates/products.html mavjud bo'lsa o'lchanadi —
+# shablonsiz har bir so'rov xato bo'lib, natijani buzadi
+HAS_PRODUCTS_TEMPLATE = os.path.exists(os.path.join(ROOT, 'templates', 'products.html'))
+ROUTES = tuple(
+    name for name in ('index', 'products_list', 'product', 'cart', 'checkout',
+                      'api_products', 'download_receipt', 'chat', 'reverse')
+    if name != 'products_list' or HAS_PRODUCTS_TEMPLATE
+)
+CUSTOMER = {'name': 'Bench', 'phone': '+998900000000', 'address': 'Toshkent', 'location': '41.31,69.24'}
+
+
+def build_routes(products, orders):
+    """
+    Marshrut nomi -> (bir_marta, har_so'rovdan_oldin, o'lchanadigan_chaqiruv).
+    Tayyorlash qadamlari (masalan, savatga qo'shish) vaqtga kirmaydi.
+    """
+    def product_id(rng):
+        return rng.randint(1, products)
+
+    def chat_message(rng):
+        # Har bir xabar noyob: aks holda birinchi aylanishdan keyin faqat
+        # ChatAnswerCache hit'lari o'lchanadi, chat yo'li emas
+        return f"{rng.choice(CHAT_QUESTIONS)} #{rng.randrange(10 ** 9)}"
+
+    def fill_cart(client, rng):
+        for _ in range(3):
+            client.post(f'/add-to-cart/{product_id(rng)}', data={'quantity': 1})
+
+    return {
+        'index': (None, None, lambda c, rng: c.get('/')),
+        'products_list': (None, None, lambda c, rng: c.get(f'/products?page={rng.randint(1, max(1, products // 24))}')),
+        'product': (None, None, lambda c, rng: c.get(f'/product/{product_id(rng)}')),
+        'cart': (fill_cart, None, lambda c, rng: c.get('/cart')),
+        'checkout': (None,
+                     lambda c, rng: c.post(f'/add-to-cart/{product_id(rng)}', data={'quantity': 1}),
+                     lambda c, rng: c.post('/checkout', data=CUSTOMER)),
+        'api_products': (None, None, lambda c, rng: c.get(f'/api/products?limit=24&offset={rng.randint(0, max(0, products - 24))}')),
+        'download_receipt': (None, None, lambda c, rng: c.get(f'/download_receipt/{rng.randint(1, orders)}')),
+        'chat': (None, None, lambda c, rng: c.post('/chat', json={'message': chat_message(rng)})),
+        'reverse': (None, None, lambda c, rng: c.get(
+            f'/reverse?lat={41.2 + rng.random() / 5:.5f}&lon={69.1 + rng.random() / 5:.5f}')),
+    }
+
+
+def run_route(client, rng, spec, count, warmup):
+    """Bitta mijoz bilan ketma-ket so'rovlar: (kechikishlar, xatolar soni)"""
+    once, before_each, call = spec
+    if once:
+        once(client, rng)
+    latencies, errors = [], 0
+    for i in range(warmup + count):
+        if before_each:
+            before_each(client, rng)
+        t0 = time.perf_counter()
+        response = call(client, rng)
+        elapsed = time.perf_counter() - t0
+        if i < warmup:
+            continue
+        if response.status_code >= 400:
+            errors += 1
+        latencies.append(elapsed)
+    return latencies, errors
+
+
+# --- client rejimi (alohida jarayonda) -----------------------------------------
+
+def child_prepare(args):
+    """Ilova orqali bazani tayyorlash: migratsiyalar va order_items backfill"""
+    webshop = load_app(args.tmp, args.db)
+    webshop.backfill_order_items()
+    webshop.close_db_connection()
+
+
+def child_client(args):
+    """Flask test client bilan barcha marshrutlarni o'lchash; JSON stdout'ga"""
+    fake = FakeNominatim().start()
+    webshop = load_app(args.tmp, args.db, NOMINATIM_URL=fake.url)
+    routes = build_routes(args.products, args.orders)
+    results = {}
+    for name in args.routes.split(','):
+        rng = random.Random(f"{args.seed}:{name}")
+        client = webshop.app.test_client()
+        latencies, errors = run_route(client, rng, routes[name], args.requests, args.warmup)
+        results[name] = summarize(latencies, errors, sum(latencies))
+    webshop.write_queue.close()
+    fake.stop()
+    print(json.dumps({'routes': results, 'peak_rss_mb': peak_rss_mb()}))
+
+
+def run_child(mode, args, db, tmp, size):
+    cmd = [sys.executable, os.path.abspath(__file__), '--child', mode, '--db', db, '--tmp', tmp,
+           '--products', str(size), '--orders', str(args.orders), '--requests', str(args.requests),
+           '--warmup', str(args.warmup), '--routes', args.routes, '--seed', str(args.seed)]
+    out = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, text=True, cwd=ROOT).stdout
+    lines = [line for line in out.splitlines() if line.startswith('{')]
+    return json.loads(lines[-1]) if lines else None
+
+
+# --- http rejimi (gunicorn) ----------------------------------------------------
+
+class HttpClient:
+    """requests.Session ustida test client'ga o'xshash interfeys (cookie'lar saqlanadi)"""
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.session = requests.Session()
+
+    def get(self, path):
+        return self.session.get(self.base_url + path, allow_redirects=False)
+
+    def post(self, path, data=None, json=None):
+        return self.session.post(self.base_url + path, data=data, json=json, allow_redirects=False)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_ready(base_url, proc, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError("gunicorn ishga tushmadi")
+        try:
+            requests.get(base_url + '/api/products?limit=1', timeout=2)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError("gunicorn javob bermadi")
+
+
+def run_http(args, db, tmp, size):
+    """gunicorn'ni ishga tushirib, har bir marshrutni parallel mijozlar bilan o'lchash"""
+    fake = FakeNominatim().start()
+    port = free_port()
+    env = dict(os.environ, **app_env(tmp, db, NOMINATIM_URL=fake.url))
+    log = open(os.path.join(tmp, 'gunicorn.log'), 'w')
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-w', str(args.workers), '--threads', str(args.threads),
+         '-b', f'127.0.0.1:{port}', 'app:create_app()'],
+        cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+    base_url = f'http://127.0.0.1:{port}'
+    results = {}
+    try:
+        wait_ready(base_url, proc)
+        routes = build_routes(size, args.orders)
+        per_client = max(1, args.requests // args.concurrency)
+        warmup = max(1, args.warmup // args.concurrency)
+        for name in args.routes.split(','):
+            collected, errors = [], [0]
+            lock = threading.Lock()
+
+            def worker(i):
+                rng = random.Random(f"{args.seed}:{name}:{i}")
+                latencies, errs = run_route(HttpClient(base_url), rng, routes[name], per_client, warmup)
+                with lock:
+                    collected.extend(latencies)
+                    errors[0] += errs
+
+            threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.concurrency)]
+            t0 = time.perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            results[name] = summarize(collected, errors[0], time.perf_counter() - t0)
+        workers = child_pids(proc.pid)
+        rss = {
+            'peak_rss_mb': round(sum(process_peak_rss_mb(pid) for pid in [proc.pid] + workers), 1),
+            'worker_peak_rss_mb': max((process_peak_rss_mb(pid) for pid in workers), default=0.0),
+        }
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        try:
+            proc.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        log.close()
+        fake.stop()
+    return dict(routes=results, **rss)
+
+
+# --- asosiy qism ---------------------------------------------------------------
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, check=True,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_table(runs):
+    """Qisqa jadval (stderr'ga — stdout JSON uchun bo'sh qoladi)"""
+    out = sys.stderr
+    for run in runs:
+        print(f"\n== {run['size']} mahsulot, {run['mode']} (RSS {run['peak_rss_mb']} MB) ==", file=out)
+        print(f"{'marshrut':<18}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'rps':>10}{'xato':>7}", file=out)
+        for name, r in run['routes'].items():
+            print(f"{name:<18}{r['p50_ms']:>10}{r['p95_ms']:>10}{r['p99_ms']:>10}{r['rps']:>10}{r['errors']:>7}", file=out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Oflayn benchmark to'plami")
+    parser.add_argument('--sizes', default='1000,10000,100000', help="katalog hajmlari (vergul bilan)")
+    parser.add_argument('--modes', default='client,http')
+    parser.add_argument('--routes', default=','.join(ROUTES))
+    parser.add_argument('--requests', type=int, default=200, help="har bir marshrut uchun o'lchanadigan so'rovlar")
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--orders', type=int, default=2000)
+    parser.add_argument('--chat-users', type=int, default=200)
+    parser.add_argument('--workers', type=int, default=2, help="gunicorn worker'lari")
+    parser.add_argument('--threads', type=int, default=4, help="har bir worker oqimlari")
+    parser.add_argument('--concurrency', type=int, default=8, help="parallel HTTP mijozlar")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--out', help="JSON natija fayli (berilmasa stdout)")
+    parser.add_argument('--keep', action='store_true', help="vaqtinchalik papkani o'chirmaslik")
+    # Ichki: bitta o'lchovni alohida jarayonda bajarish
+    parser.add_argument('--child', choices=['prepare', 'client'], help=argparse.SUPPRESS)
+    parser.add_argument('--db', help=argparse.SUPPRESS)
+    parser.add_argument('--tmp', help=argparse.SUPPRESS)
+    parser.add_argument('--products', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    unknown = set(args.routes.split(',')) - set(ROUTES)
+    if unknown:
+        parser.error(f"noma'lum marshrutlar: {', '.join(sorted(unknown))}")
+    if args.child == 'prepare':
+        return child_prepare(args)
+    if args.child == 'client':
+        return child_client(args)
+
+    runs = []
+    for size in [int(s) for s in args.sizes.split(',') if s]:
+        tmp = tempfile.mkdtemp(prefix=f'webshop-bench-{size}-')
+        db = os.path.join(tmp, 'shop.db')
+        try:
+            t0 = time.perf_counter()
+            generate(db, products=size, orders=args.orders, chat_users=args.chat_users, seed=args.seed)
+            run_child('prepare', args, db, tmp, size)
+            print(f"[{size}] baza tayyor: {time.perf_counter() - t0:.1f} s", file=sys.stderr)
+            for mode in args.modes.split(','):
+                if mode == 'client':
+                    result = run_child('client', args, db, tmp, size)
+                elif mode == 'http':
+                    result = run_http(args, db, tmp, size)
+                else:
+                    parser.error(f"noma'lum rejim: {mode}")
+                runs.append(dict(size=size, mode=mode, **result))
+                print(f"[{size}] {mode}: tayyor", file=sys.stderr)
+        finally:
+            if not args.keep:
+                shutil.rmtree(tmp, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'git': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'args': {k: v for k, v in vars(args).items() if k not in ('child', 'db', 'tmp', 'products', 'out', 'keep')},
+        },
+        'runs': runs,
+    }
+    print_table(runs)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"\nNatija: {args.out}", file=sys.stderr)
+    else:
+        print(json.dumps(report, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,118 @@
+"""
+Sintetik katalog, buyurtmalar va chat tarixi bilan SQLite bazasini yaratish.
+Sxema database/shop.db'dan ko'chiriladi (qatorlarsiz), qo'shimcha jadvallarni
+(order_items, products_fts, ...) ilovaning o'zi yaratadi.
+
+    python bench/synthetic.py /tmp/shop-10k.db --products 10000
+"""
+import argparse
+import os
+import random
+import sqlite3
+from datetime import datetime, timedelta
+
+from common import ROOT
+
+BRANDS = ['Samsung', 'Xiaomi', 'Lenovo', 'Lexar', 'Kingston', 'Logitech', 'Artel', 'HP', 'Asus', 'Sony']
+KINDS = ['SSD', 'HDD', 'fleshka', 'quloqchin', 'klaviatura', 'sichqoncha', 'monitor', 'router',
+         'zaryadlovchi', 'kabel', 'колонка', 'роутер', 'переходник', 'ноутбук', 'планшет']
+ADJECTIVES = ['tezkor', 'simsiz', 'ixcham', 'professional', "o'yin", 'ofis', 'portativ', 'мощный', 'новый']
+SPECS = ['Xotira - {n}Gb', 'Quvvat - {n}W', 'Kafolat - {n} oy', "Og'irligi - {n} g", 'Скорость - {n} MB/s']
+CHAT_QUESTIONS = ['SSD bormi?', 'Eng arzon fleshka qaysi?', 'Simsiz quloqchin narxi qancha?',
+                  'Роутер есть?', 'Monitor kafolati bormi?', 'Yetkazib berish qancha turadi?']
+
+
+def product_images():
+    """static/images ichidagi haqiqiy rasmlar (tavsif va kartalar uchun)"""
+    folder = os.path.join(ROOT, 'static', 'images')
+    names = sorted(
+        n for n in os.listdir(folder)
+        if os.path.isfile(os.path.join(folder, n)) and n.lower().endswith(('.jpg', '.jpeg', '.png'))
+    )
+    return names or ['default-product.jpg']
+
+
+def create_schema(conn):
+    """database/shop.db'dagi jadval va indekslarni bo'sh holda yaratish"""
+    source = sqlite3.connect(os.path.join(ROOT, 'database', 'shop.db'))
+    statements = source.execute(
+        "SELECT sql FROM sqlite_master WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%' "
+        "ORDER BY type = 'index'"
+    ).fetchall()
+    source.close()
+    for (sql,) in statements:
+        conn.execute(sql)
+
+
+def generate(path, products=1000, orders=2000, chat_users=200, chat_turns=10, seed=42):
+    """Bazani yaratish; (mahsulotlar, buyurtmalar, chat xabarlari) sonini qaytaradi"""
+    rng = random.Random(seed)
+    images = product_images()
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode=WAL')
+    create_schema(conn)
+
+    def product_row(i):
+        name = f"{rng.choice(BRANDS)} {rng.choice(ADJECTIVES)} {rng.choice(KINDS)} {rng.randint(10, 999)}"
+        pictures = rng.sample(images, k=min(len(images), rng.randint(1, 3)))
+        specs = '\n'.join(rng.choice(SPECS).format(n=rng.randint(1, 512)) for _ in range(rng.randint(2, 6)))
+        description = f"{name}\n{specs}\n{{{pictures[0]}}}"
+        return (name, rng.randint(10, 5000) * 1000, ','.join(pictures), description, rng.randint(50, 500))
+
+    conn.executemany(
+        'INSERT INTO products (name, price, image, description, stock) VALUES (?, ?, ?, ?, ?)',
+        (product_row(i) for i in range(products))
+    )
+    catalog = conn.execute('SELECT id, name, price FROM products').fetchall()
+
+    # Buyurtmalar eski matn formatida; order_items'ni ilovaning backfill'i to'ldiradi
+    start = datetime.now() - timedelta(days=365)
+
+    def order_row(i):
+        lines = rng.sample(catalog, k=rng.randint(1, 4))
+        qty = [rng.randint(1, 3) for _ in lines]
+        text = ', '.join(f"(#{pid} {name} x {q})" for (pid, name, _), q in zip(lines, qty))
+        total = sum(price * q for (_, _, price), q in zip(lines, qty))
+        when = start + timedelta(minutes=rng.randint(0, 365 * 24 * 60))
+        return (f"Mijoz {i}", f"+99890{rng.randint(1000000, 9999999)}", 'Toshkent', '41.31,69.24',
+                text, total, when.strftime("%Y-%m-%d %H:%M:%S"), rng.choice(['YANGI', 'YETKAZILDI']))
+
+    conn.executemany(
+        'INSERT INTO orders (name, phone, address, location, products, total_price, data_add, status) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+        (order_row(i) for i in range(orders))
+    )
+
+    def chat_rows():
+        for u in range(chat_users):
+            uuid = f"bench-user-{u}"
+            for _ in range(chat_turns):
+                pid, name, _ = rng.choice(catalog)
+                yield (uuid, 'Anonim', 'user', rng.choice(CHAT_QUESTIONS))
+                yield (uuid, 'Anonim', 'assistant', f"{name}. <button class='chat-btn' data-url='/product/{pid}'>")
+
+    conn.executemany(
+        'INSERT INTO chat_message (user_uuid, user_name, role, content) VALUES (?, ?, ?, ?)', chat_rows()
+    )
+    conn.commit()
+    conn.close()
+    return products, orders, chat_users * chat_turns * 2
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sintetik benchmark bazasini yaratish")
+    parser.add_argument('path')
+    parser.add_argument('--products', type=int, default=1000)
+    parser.add_argument('--orders', type=int, default=2000)
+    parser.add_argument('--chat-users', type=int, default=200)
+    parser.add_argument('--chat-turns', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    counts = generate(args.path, args.products, args.orders, args.chat_users, args.chat_turns, args.seed)
+    print("mahsulotlar: %d, buyurtmalar: %d, chat xabarlari: %d" % counts)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,17 @@
+# gunicorn sozlamalari: gunicorn -c gunicorn.conf.py
+# Ilova master jarayonda bir marta yuklanadi (preload), shriftlar va modul kodi
+# worker'larga fork orqali copy-on-write bo'lib o'tadi.
+import gc
+import os
+
+wsgi_app = 'app:create_app(preload=True)'
+preload_app = True
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.getenv('GUNICORN_WORKERS', '2'))
+threads = int(os.getenv('GUNICORN_THREADS', '4'))
+
+
+def when_ready(server):
+    # preload'dan keyin yaratilgan obyektlarni GC skanidan chiqaramiz — aks holda
+    # worker'lardagi birinchi yig'ish sahifalarga yozib, CoW ulushini buzadi
+    gc.freeze()
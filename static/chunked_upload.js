@@ -0,0 +1,86 @@
+// ==============================================================================
+// BO'LAKLAB VIDEO YUKLASH - davom ettiriladigan (resumable) yuklash
+// ==============================================================================
+(function () {
+  async function uploadFile(file, onProgress) {
+    // Sahifa yangilansa ham shu fayl uchun yuklash davom etadi
+    const key = `upload:${file.name}:${file.size}:${file.lastModified}`;
+    let uploadId = localStorage.getItem(key);
+    let chunkSize = 4 * 1024 * 1024;
+    let offset = 0;
+
+    if (uploadId) {
+      const res = await fetch(`/admin/uploads/${uploadId}`);
+      if (res.ok) {
+        const data = await res.json();
+        offset = data.received;
+        chunkSize = data.chunk_size || chunkSize; // server sozlamasi ustun
+      } else {
+        uploadId = null;
+      }
+    }
+    if (!uploadId) {
+      const res = await fetch('/admin/uploads', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ filename: file.name, size: file.size }),
+      });
+      if (!res.ok) throw new Error((await res.json()).error || 'Yuklashni boshlab bo‘lmadi');
+      const data = await res.json();
+      uploadId = data.upload_id;
+      chunkSize = data.chunk_size;
+      localStorage.setItem(key, uploadId);
+    }
+
+    while (offset < file.size) {
+      const end = Math.min(offset + chunkSize, file.size);
+      const res = await fetch(`/admin/uploads/${uploadId}`, {
+        method: 'PUT',
+        headers: {
+          'Content-Type': 'application/octet-stream',
+          'Content-Range': `bytes ${offset}-${end - 1}/${file.size}`,
+        },
+        body: file.slice(offset, end),
+      });
+      const data = await res.json();
+      if (!res.ok && res.status !== 409) throw new Error(data.error || 'Bo‘lak yuklanmadi');
+      offset = data.received;
+      if (onProgress) onProgress(file, offset / file.size);
+    }
+
+    const done = await fetch(`/admin/uploads/${uploadId}/complete`, { method: 'POST' });
+    if (!done.ok) throw new Error((await done.json()).error || 'Yuklash yakunlanmadi');
+    localStorage.removeItem(key);
+    return uploadId;
+  }
+
+  // Forma yuborilishidan oldin videolarni bo'laklab yuklaydi va
+  // faqat upload id'larini yashirin maydonda yuboradi
+  window.attachChunkedUpload = function (form, fileInput, getFiles, idsInput) {
+    form.addEventListener('submit', async (e) => {
+      const files = getFiles();
+      if (!files.length) return;
+      e.preventDefault();
+
+      const button = form.querySelector('button[type="submit"]');
+      const label = button.textContent;
+      button.disabled = true;
+      try {
+        const ids = [];
+        for (const file of files) {
+          ids.push(await uploadFile(file, (f, p) => {
+            button.textContent = `⏳ ${f.name}: ${Math.round(p * 100)}%`;
+          }));
+        }
+        idsInput.value = ids.join(',');
+        fileInput.disabled = true; // videolar multipart so'rovda qayta yuborilmaydi
+        form.submit();
+      } catch (err) {
+        console.error(err);
+        alert(`Video yuklashda xatolik: ${err.message}`);
+        button.disabled = false;
+        button.textContent = label;
+      }
+    });
+  };
+})();